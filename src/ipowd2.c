@@ -2,8 +2,67 @@
 // sockets are technically bidirectional, we're using them only in one
 // direction. The sockets are nonblocking – they will drop any datagrams they
 // can't handle.
+//
+// The main loop is an epoll loop which moves packets in batches: up to BATCH
+// reads from TUN go to the client with one sendmmsg(), and one recvmmsg()
+// takes up to BATCH packets from the client. Nothing is logged per packet
+// unless -v is given; what went where is counted instead (see -m).
+//
+// Any number (well, up to MAX_CLIENTS) of clients can register by sending
+// anything to tun_out. By default packets from TUN are spread among them by a
+// hash of their flow (addresses, protocol, ports), so that e.g. several
+// processes of a transport can share the traffic while each flow sticks to one
+// of them; with -c last everything goes to the most recently registered one
+// (the way it used to be with a single client). A client is forgotten once
+// its socket is gone, or - with -e - when it hasn't registered again for a
+// while.
+//
+// With -n N the TUN interface gets N queues (IFF_MULTI_QUEUE), each with its
+// own pair of sockets (/var/run/tun_in.<queue>.fifo, /var/run/tun_out.<queue>
+// .fifo), clients and thread. The kernel spreads flows sent to the interface
+// among the queues, and takes what's written to any of them, so every queue
+// can have its own transport process (on its own core), independent of the
+// others.
+//
+// With -g the TUN interface does offloads (IFF_VNET_HDR, TUNSETOFFLOAD with
+// checksums and TSO/USO): the kernel hands over TCP/UDP "super-packets" of up
+// to 64 KB, each with a virtio_net_hdr in front, instead of MTU-sized ones.
+// Clients which register with "gso" (instead of "hi") get them as they are,
+// header and all, and can send them back the same way - the other end's
+// kernel does the segmentation. Other clients still get plain packets: their
+// checksums are finished, and super-packets are cut into segments, here.
+// From clients, datagrams which start like an IP packet are taken as plain
+// packets, anything else as a virtio_net_hdr and a (super-)packet.
+//
+// Clients can also skip the sockets (and the copies and syscalls which come
+// with them) and exchange packets through shared memory: registering with
+// "ring" (or "ring gso") and three file descriptors passed along with it
+// (SCM_RIGHTS) - a memfd with two rings, an eventfd we signal and one which
+// the client signals - see ../transports/shmring.py. Each ring has a single
+// producer and a single consumer, and holds records of a 32-bit length and
+// the packet, 8-byte aligned; a length of RING_WRAP means "continued from the
+// start". Whoever puts something into a ring signals the other side only if
+// the ring was empty before. As the Python side can't do memory fences, a
+// wakeup can in theory get lost; so both sides look at the rings every
+// RING_POLL_MS anyway. A ring client is gone when its socket is, which is
+// checked every second (with an empty datagram).
+//
+// Options:
+//   -v       log every packet (well, every batch)
+//   -q       log only warnings and errors
+//   -c MODE  how to share TUN traffic among clients: "hash" (by flow,
+//            default) or "last" (all to the most recently registered one)
+//   -e SECS  forget clients which haven't registered again for SECS seconds
+//            (default: only once their socket is gone; ring clients register
+//            just once)
+//   -g       TUN offloads, see above
+//   -n N     use N TUN queues (and N pairs of sockets), default 1
+//   -m PATH  serve metrics (Prometheus text format) on a UNIX stream socket,
+//            e.g. "socat - UNIX-CONNECT:PATH"
+#define _GNU_SOURCE  // recvmmsg/sendmmsg
 #include <linux/if.h>
 #include <linux/if_tun.h>
+#include <linux/virtio_net.h>
 #include <sys/ioctl.h>
 #include <string.h>
 #include <fcntl.h>
@@ -13,6 +72,10 @@
 #include <stdlib.h>
 #include <sys/socket.h>
 #include <sys/un.h>
+#include <sys/epoll.h>
+#include <sys/uio.h>
+#include <sys/mman.h>
+#include <netinet/in.h>
 #include <errno.h>
 #include <sys/types.h>
 #include <sys/stat.h>
@@ -21,19 +84,150 @@
 #include <time.h>
 #include <stdint.h>
 #include <stdbool.h>
+#include <inttypes.h>
+#include <pthread.h>
 
 #define BUFSIZE 20480
 #define MAX_PACKET_SZ (BUFSIZE-2)  // Should be larger than MTU.
+#define METRICS_SZ 8192
+#define BATCH 64  // Packets moved per syscall (and per wakeup) at most.
+#define MAX_CLIENTS 16
+#define MAX_QUEUES 256  // The kernel's limit.
+#define VNET_HDR_SZ sizeof(struct virtio_net_hdr)
+#define GSO_BUFSIZE (65536 + VNET_HDR_SZ)
+#define SEGMENTS_SZ (4 * GSO_BUFSIZE)  // For super-packets cut into segments.
+
+// Older headers don't know about UDP segmentation offload.
+#ifndef TUN_F_USO4
+#define TUN_F_USO4 0x20
+#define TUN_F_USO6 0x40
+#endif
+#define RING_HEADER_SZ 192  // head, tail and size, each on its own cache line.
+#define RING_WRAP 0xffffffffu
+#define RING_POLL_MS 50
+#define RING_PROBE_INTERVAL 1  // Seconds.
+
+#ifndef VIRTIO_NET_HDR_GSO_UDP_L4
+#define VIRTIO_NET_HDR_GSO_UDP_L4 5
+#endif
+
+// Counters for -m, per queue. Only the queue's thread writes them; the
+// metrics are read from another one without locking, they're just counters.
+struct stats {
+  uint64_t wakeups;
+  uint64_t tun_packets;     // Read from TUN (and sent to the client).
+  uint64_t tun_bytes;
+  uint64_t tun_batches;
+  uint64_t client_packets;  // Received from the client (and written to TUN).
+  uint64_t client_bytes;
+  uint64_t client_batches;
+  uint64_t dropped_no_client;
+  uint64_t dropped_client_busy;
+  uint64_t dropped_tun_busy;  // From the client, TUN didn't take it.
+  uint64_t dropped_bad_gso;   // Super-packets we couldn't segment.
+  uint64_t dropped_invalid;   // From the client, TUN said it's invalid.
+  uint64_t gso_packets;       // Super-packets from TUN.
+  uint64_t gso_segmented;     // ...which were segmented for a client.
+  uint64_t ring_signals_out;  // Eventfd writes to ring clients.
+  uint64_t ring_wakeups_in;   // Times a ring client woke us up.
+  uint64_t registrations;
+  uint64_t clients_lost;
+};
+
+// Shared with a client; see the top of the file.
+struct ring {
+  uint64_t head;       // Written by the producer.
+  uint8_t pad1[56];
+  uint64_t tail;       // Written by the consumer.
+  uint8_t pad2[56];
+  uint32_t size;       // Of data, a power of two.
+  uint8_t pad3[60];
+  uint8_t data[];
+};
+
+// Registered clients, in no particular order (the first n are used).
+struct client {
+  struct sockaddr_un addr;
+  socklen_t addr_sz;
+  uint32_t id;         // Hash of the address, for the flow hash.
+  time_t registered;   // Last time we heard from it.
+  uint64_t packets;
+  uint64_t bytes;
+  bool lost;           // Sending to it failed, to be removed.
+  bool gso;            // Takes super-packets (with -g).
+  // With "ring": the mapping, the rings to and from it (and their sizes and
+  // our positions in them, which we don't take from the shared memory), the
+  // eventfds to wake it up and to get woken up.
+  uint8_t *ring_map;
+  size_t ring_map_sz;
+  struct ring *ring_out;
+  struct ring *ring_in;
+  uint32_t ring_out_sz;
+  uint32_t ring_in_sz;
+  uint64_t out_head;
+  uint64_t in_tail;
+  int efd_out;
+  int efd_in;
+  bool signal;         // Its ring was empty, it needs a wakeup.
+};
+
+struct clients {
+  struct client c[MAX_CLIENTS];
+  int n;
+  int last;            // Most recently registered, -1 if none.
+};
+
+// A TUN queue, its sockets and its clients. Each one has its own thread.
+struct queue {
+  int index;
+  int tun_fd;
+  int fifo_fd_in;
+  int fifo_fd_out;
+  int metrics_fd;      // Only for one of them.
+  int epoll_fd;
+  struct sockaddr_un addr_tun_in;
+  struct sockaddr_un addr_tun_out;
+  struct stats stats;
+  struct clients clients;
+  // For changes to clients, which the metrics read from another thread. The
+  // queue's own thread reads them without it.
+  pthread_mutex_t lock;
+  pthread_t thread;
+};
+
+struct queue *queues;
+int nqueues = 1;
+
+enum { MODE_HASH, MODE_LAST } mode = MODE_HASH;
+int expiry = 0;
+bool gso = false;
+int bufsize = BUFSIZE;  // GSO_BUFSIZE with -g.
+
+enum { LEVEL_DEBUG, LEVEL_INFO, LEVEL_WARNING };
+int loglevel = LEVEL_INFO;
+
+// Checked before the call, so that there's no formatting done for nothing.
+#define debuglog(...) do { if (loglevel <= LEVEL_DEBUG) writelog("DEBUG", __VA_ARGS__); } while (0)
 
 void writelog(const char *level, const char *format, ...) {
     char time_str[20]; // Buffer for time string
-    strftime(time_str, 20, "%Y-%m-%d %H:%M:%S", localtime(&(time_t){time(NULL)}));
+    struct tm tm;
+    int value = !strcmp(level, "DEBUG") ? LEVEL_DEBUG :
+                !strcmp(level, "INFO") ? LEVEL_INFO : LEVEL_WARNING;
+
+    if (value < loglevel) {
+        return;
+    }
+
+    strftime(time_str, 20, "%Y-%m-%d %H:%M:%S", localtime_r(&(time_t){time(NULL)}, &tm));
+    flockfile(stdout);  // The queues' threads log too.
     printf("[%s] [%s] ", time_str, level);
 
     va_list args;
     va_start(args, format);
     vprintf(format, args);
     va_end(args);
+    funlockfile(stdout);
 }
 
 int create_unix_dgram_socket(struct sockaddr_un *addr) {
@@ -68,35 +262,764 @@ int create_unix_dgram_socket(struct sockaddr_un *addr) {
   return s;
 }
 
-int fifo_out_write(
-    int fifo_fd, struct sockaddr_un *fifo_addr,
-    void *buff, int len
-) {
-  int rv = -1;
+uint32_t fnv1a(uint32_t h, const uint8_t *data, size_t len) {
+  while (len--) {
+    h = (h ^ *data++) * 16777619u;
+  }
+  return h;
+}
+
+// Hash of the packet's flow: addresses and protocol, plus the ports for TCP,
+// UDP, UDP-Lite and SCTP (unless it's a fragment - only the first one has
+// them, and all of them should go the same way).
+uint32_t flow_hash(const uint8_t *packet, size_t len) {
+  uint32_t h = 2166136261u;
+  size_t header;
+  uint8_t proto;
+
+  if (len >= 20 && packet[0] >> 4 == 4) {
+    header = (packet[0] & 0x0f) * 4;
+    proto = packet[9];
+    h = fnv1a(h, packet + 12, 8);
+    if ((packet[6] & 0x3f) || packet[7]) {  // More fragments, or an offset.
+      return fnv1a(h, &proto, 1);
+    }
+  } else if (len >= 40 && packet[0] >> 4 == 6) {
+    header = 40;
+    proto = packet[6];
+    h = fnv1a(h, packet + 8, 32);
+  } else {
+    return fnv1a(h, packet, len < 20 ? len : 20);
+  }
+
+  h = fnv1a(h, &proto, 1);
+  if ((proto == 6 || proto == 17 || proto == 136 || proto == 132) &&
+      len >= header + 4) {
+    h = fnv1a(h, packet + header, 4);
+  }
+  return h;
+}
+
+uint16_t get16(const uint8_t *p) {
+  return (p[0] << 8) | p[1];
+}
+
+void put16(uint8_t *p, uint16_t value) {
+  p[0] = value >> 8;
+  p[1] = value & 0xff;
+}
+
+uint32_t csum_add(uint32_t sum, const uint8_t *data, size_t len) {
+  size_t i;
+
+  for (i = 0; i + 1 < len; i += 2) {
+    sum += get16(data + i);
+  }
+  if (len & 1) {
+    sum += data[len - 1] << 8;
+  }
+  return sum;
+}
+
+uint16_t csum_fold(uint32_t sum) {
+  while (sum >> 16) {
+    sum = (sum & 0xffff) + (sum >> 16);
+  }
+  return ~sum & 0xffff;
+}
+
+// Packets from an offloading TUN can come with their TCP/UDP checksum left to
+// be done: from csum_start to the end, stored at csum_start + csum_offset
+// (where there's the pseudo header's sum already).
+void finish_checksum(uint8_t *packet, size_t len, const struct virtio_net_hdr *h) {
+  uint16_t sum;
+
+  if (h->csum_start + h->csum_offset + 2 > len) {
+    return;
+  }
+  sum = csum_fold(csum_add(0, packet + h->csum_start, len - h->csum_start));
+  put16(packet + h->csum_start + h->csum_offset, sum ? sum : 0xffff);
+}
+
+size_t ring_align(size_t len) {
+  return (len + 7) & ~(size_t)7;
+}
+
+// Maps the client's rings, fds are the memfd and the eventfds (out, in).
+bool attach_ring(struct queue *q, struct client *c, int *fds) {
+  struct stat st;
+  struct epoll_event ev;
+  struct ring *r;
+
+  if (fstat(fds[0], &st) == -1 || st.st_size < 2 * RING_HEADER_SZ) {
+    return false;
+  }
+
+  c->ring_map = mmap(NULL, st.st_size, PROT_READ | PROT_WRITE, MAP_SHARED, fds[0], 0);
+  if (c->ring_map == MAP_FAILED) {
+    perror("mmap()");
+    c->ring_map = NULL;
+    return false;
+  }
+  c->ring_map_sz = st.st_size;
+
+  r = (struct ring*)c->ring_map;
+  c->ring_out = r;
+  c->ring_out_sz = r->size;
+  if (c->ring_out_sz < 4096 || (c->ring_out_sz & (c->ring_out_sz - 1)) ||
+      2 * RING_HEADER_SZ + (size_t)c->ring_out_sz > c->ring_map_sz) {
+    goto bad;
+  }
+  c->ring_in = (struct ring*)(c->ring_map + RING_HEADER_SZ + c->ring_out_sz);
+  c->ring_in_sz = c->ring_in->size;
+  if (c->ring_in_sz < 4096 || (c->ring_in_sz & (c->ring_in_sz - 1)) ||
+      2 * RING_HEADER_SZ + (size_t)c->ring_out_sz + c->ring_in_sz > c->ring_map_sz) {
+    goto bad;
+  }
+
+  c->out_head = __atomic_load_n(&c->ring_out->head, __ATOMIC_ACQUIRE);
+  c->in_tail = __atomic_load_n(&c->ring_in->tail, __ATOMIC_ACQUIRE);
+  c->efd_out = fds[1];
+  c->efd_in = fds[2];
+  fcntl(c->efd_out, F_SETFL, O_NONBLOCK);
+  fcntl(c->efd_in, F_SETFL, O_NONBLOCK);
+
+  memset(&ev, 0, sizeof(ev));
+  ev.events = EPOLLIN;
+  ev.data.fd = c->efd_in;
+  if (epoll_ctl(q->epoll_fd, EPOLL_CTL_ADD, c->efd_in, &ev) == -1) {
+    perror("epoll_ctl()");
+    goto bad;
+  }
+
+  close(fds[0]);
+  return true;
+
+bad:
+  writelog("WARNING", "fifo_fd_out: bad rings from %s\n", c->addr.sun_path);
+  munmap(c->ring_map, c->ring_map_sz);
+  c->ring_map = NULL;
+  c->ring_out = c->ring_in = NULL;
+  return false;
+}
+
+void detach_ring(struct queue *q, struct client *c) {
+  if (!c->ring_map) {
+    return;
+  }
+  epoll_ctl(q->epoll_fd, EPOLL_CTL_DEL, c->efd_in, NULL);
+  close(c->efd_in);
+  close(c->efd_out);
+  munmap(c->ring_map, c->ring_map_sz);
+  c->ring_map = NULL;
+  c->ring_out = c->ring_in = NULL;
+}
+
+// Puts a packet into the ring to the client; false if there's no room.
+bool ring_put(struct client *c, const uint8_t *data, size_t len) {
+  struct ring *r = c->ring_out;
+  uint32_t size = c->ring_out_sz;
+  uint64_t head = c->out_head;
+  uint64_t tail = __atomic_load_n(&r->tail, __ATOMIC_ACQUIRE);
+  size_t need = ring_align(4 + len);
+  size_t offset = head & (size - 1);
+  size_t skip = size - offset < need ? size - offset : 0;
+  uint32_t len32 = len;
+
+  if (head - tail > size || need + skip > size - (head - tail)) {
+    return false;
+  }
+
+  if (skip) {
+    uint32_t wrap = RING_WRAP;
+
+    memcpy(r->data + offset, &wrap, 4);
+    offset = 0;
+  }
+  memcpy(r->data + offset, &len32, 4);
+  memcpy(r->data + offset + 4, data, len);
+
+  c->out_head = head + skip + need;
+  __atomic_store_n(&r->head, c->out_head, __ATOMIC_RELEASE);
+
+  // Was it empty before? Then the client may be asleep.
+  __atomic_thread_fence(__ATOMIC_SEQ_CST);
+  if (__atomic_load_n(&r->tail, __ATOMIC_ACQUIRE) == head) {
+    c->signal = true;
+  }
+  return true;
+}
+
+void ring_signal(struct queue *q, struct client *c) {
+  uint64_t one = 1;
+
+  if (c->signal) {
+    c->signal = false;
+    q->stats.ring_signals_out++;
+    if (write(c->efd_out, &one, sizeof(one)) == -1 && errno != EAGAIN) {
+      perror("Can't signal a ring client");
+    }
+  }
+}
+
+int tun_write(struct queue *q, uint8_t *data, int len);
+
+// Writes what the client put into its ring to TUN, up to limit packets.
+// Returns the number of packets, -1 if TUN failed for good, -2 if the ring
+// doesn't make sense (the client's lost then).
+int ring_drain(struct queue *q, struct client *c, int limit) {
+  struct ring *r = c->ring_in;
+  uint32_t size = c->ring_in_sz;
+  uint64_t tail = c->in_tail;
+  uint64_t head;
+  uint32_t len;
+  size_t offset;
+  int n = 0;
+
+  while (n < limit) {
+    head = __atomic_load_n(&r->head, __ATOMIC_ACQUIRE);
+    if (head == tail) {
+      break;
+    }
+    if (head - tail > size) {
+      return -2;
+    }
+
+    offset = tail & (size - 1);
+    memcpy(&len, r->data + offset, 4);
+    if (len == RING_WRAP) {
+      tail += size - offset;
+      continue;
+    }
+    if (len > (uint32_t)bufsize || 4 + (size_t)len > size - offset) {
+      return -2;
+    }
+
+    if (tun_write(q, r->data + offset + 4, len) == -1) {
+      return -1;
+    }
+    q->stats.client_packets++;
+    q->stats.client_bytes += len;
+    tail += ring_align(4 + len);
+    n++;
+  }
+
+  c->in_tail = tail;
+  __atomic_store_n(&r->tail, tail, __ATOMIC_RELEASE);
+
+  // The client signals only when it finds the ring empty; if it put something
+  // in just before it saw the new tail, it didn't.
+  __atomic_thread_fence(__ATOMIC_SEQ_CST);
+  if (n < limit && __atomic_load_n(&r->head, __ATOMIC_ACQUIRE) != tail) {
+    int more = ring_drain(q, c, limit - n);
+
+    return more < 0 ? more : n + more;
+  }
+  return n;
+}
+
+// The client for a packet. Rendezvous hashing: the client with the highest
+// hash of (flow, client) gets it, so when a client comes or goes only the
+// flows going to it move.
+int pick_client(struct queue *q, const uint8_t *packet, size_t len) {
+  struct clients *clients = &q->clients;
+  uint32_t flow, best_score = 0, score;
+  int i, best = -1;
+
+  if (mode == MODE_LAST || clients->n == 1) {
+    return clients->last;
+  }
+
+  flow = flow_hash(packet, len);
+  for (i = 0; i < clients->n; i++) {
+    score = fnv1a(flow, (const uint8_t*)&clients->c[i].id, sizeof(uint32_t));
+    if (best == -1 || score > best_score) {
+      best = i;
+      best_score = score;
+    }
+  }
+  return best;
+}
+
+// fds: a ring client's memfd and eventfds, or NULL.
+void register_client(struct queue *q, struct sockaddr_un *addr,
+                     socklen_t addr_sz, time_t now, bool wants_gso, int *fds) {
+  struct clients *clients = &q->clients;
+  int i;
 
-  if (fifo_fd >= 0) {
-    rv = sendto(fifo_fd, buff, len, 0,
-                (struct sockaddr*)fifo_addr, sizeof(*fifo_addr));
+  pthread_mutex_lock(&q->lock);
 
-    if (rv == -1) {
-      if (errno == EAGAIN || errno == EWOULDBLOCK) {
-        writelog("INFO", "dropping outgoing packet of %i bytes\n", len);
-        return 0;
+  for (i = 0; i < clients->n; i++) {
+    if (clients->c[i].addr_sz == addr_sz &&
+        !memcmp(&clients->c[i].addr, addr, addr_sz)) {
+      debuglog("fifo_fd_out: client %s registered again\n", addr->sun_path);
+      break;
+    }
+  }
+
+  if (i == clients->n) {
+    if (clients->n == MAX_CLIENTS) {
+      writelog("WARNING", "fifo_fd_out: too many clients, ignoring %s\n",
+                          addr->sun_path);
+      pthread_mutex_unlock(&q->lock);
+      if (fds) {
+        close(fds[0]);
+        close(fds[1]);
+        close(fds[2]);
       }
+      return;
+    }
+    memset(&clients->c[i], 0, sizeof(clients->c[i]));
+    memcpy(&clients->c[i].addr, addr, addr_sz);
+    clients->c[i].addr_sz = addr_sz;
+    clients->c[i].id = fnv1a(2166136261u, (const uint8_t*)addr, addr_sz);
+    clients->n++;
+    q->stats.registrations++;
+    writelog("INFO", "fifo_fd_out: new client %s, %u%s%s (%d clients on queue %d)\n",
+                     addr->sun_path, addr_sz, wants_gso && gso ? " (gso)" : "",
+                     fds ? " (ring)" : "", clients->n, q->index);
+  }
 
-      if (errno == ENOENT) {
-        return -1;  // Client lost.
+  clients->c[i].registered = now;
+  clients->c[i].gso = wants_gso;
+  if (fds) {
+    // New rings, if it had any they're gone.
+    detach_ring(q, &clients->c[i]);
+    if (!attach_ring(q, &clients->c[i], fds)) {
+      // Not as a plain client either, it wouldn't be reading its socket.
+      clients->c[i].lost = true;
+      close(fds[0]);
+      close(fds[1]);
+      close(fds[2]);
+    }
+  }
+  clients->last = i;
+
+  pthread_mutex_unlock(&q->lock);
+}
+
+// Removes the lost clients, and with -e the ones which haven't registered
+// again for too long.
+void remove_clients(struct queue *q, time_t now) {
+  struct clients *clients = &q->clients;
+  int i = 0;
+
+  pthread_mutex_lock(&q->lock);
+
+  while (i < clients->n) {
+    struct client *c = &clients->c[i];
+
+    if (!c->lost && !(expiry && !c->ring_map && now - c->registered > expiry)) {
+      i++;
+      continue;
+    }
+
+    q->stats.clients_lost++;
+    writelog("INFO", "fifo_out_write: client %s %s (%d clients left on queue %d)\n",
+                     c->addr.sun_path, c->lost ? "lost" : "expired",
+                     clients->n - 1, q->index);
+    detach_ring(q, c);
+    clients->n--;
+    if (clients->last == i) {
+      clients->last = -1;
+    } else if (clients->last == clients->n) {
+      clients->last = i;
+    }
+    *c = clients->c[clients->n];
+  }
+
+  // The most recently registered of the rest.
+  if (clients->last == -1) {
+    for (i = 0; i < clients->n; i++) {
+      if (clients->last == -1 ||
+          clients->c[i].registered >= clients->c[clients->last].registered) {
+        clients->last = i;
       }
+    }
+  }
 
-      perror("Can't send to fifo_out: ");
-      return -1;
+  pthread_mutex_unlock(&q->lock);
+}
+
+// Sends the n packets in msgs, to the clients in targets. What a client can't
+// take right away is dropped; a client which is gone is marked as lost.
+// Returns the number of packets dropped.
+int fifo_out_write(struct queue *q, struct mmsghdr *msgs, int *targets, int n) {
+  int sent = 0;
+  int dropped = 0;
+
+  while (sent < n) {
+    int rv = sendmmsg(q->fifo_fd_out, msgs + sent, n - sent, MSG_DONTWAIT);
+
+    if (rv >= 0) {
+      sent += rv;
+      continue;
+    }
+
+    if (errno == EINTR) {
+      continue;
+    }
+
+    // It's the first one which failed, the others may still go through.
+    dropped++;
+    if (errno == EAGAIN || errno == EWOULDBLOCK) {
+      debuglog("dropping outgoing packet of %zu bytes\n",
+               msgs[sent].msg_hdr.msg_iov->iov_len);
+      q->stats.dropped_client_busy++;
+    } else if (errno == ENOENT || errno == ECONNREFUSED) {
+      q->clients.c[targets[sent]].lost = true;
+      q->stats.dropped_no_client++;
+    } else {
+      perror("Can't send to fifo_out");
+      q->stats.dropped_client_busy++;
+    }
+    sent++;
+  }
+
+  return dropped;
+}
+
+// Datagrams on their way to the clients, sent with one sendmmsg() once
+// there's BATCH of them (or no room for more segments).
+struct outbox {
+  struct mmsghdr msgs[BATCH];
+  struct iovec iovecs[BATCH];
+  int targets[BATCH];
+  int n;
+  uint8_t *segments;   // SEGMENTS_SZ, for cutting super-packets.
+  size_t used;
+  int dropped;
+};
+
+void outbox_flush(struct queue *q, struct outbox *o) {
+  int i;
+
+  if (o->n) {
+    o->dropped += fifo_out_write(q, o->msgs, o->targets, o->n);
+  }
+  o->n = 0;
+  o->used = 0;
+
+  for (i = 0; i < q->clients.n; i++) {
+    ring_signal(q, &q->clients.c[i]);
+  }
+}
+
+void outbox_add(struct queue *q, struct outbox *o, int target,
+                uint8_t *data, size_t len) {
+  struct client *c = &q->clients.c[target];
+
+  if (c->ring_map) {
+    // Straight into its ring, no need to wait.
+    if (ring_put(c, data, len)) {
+      c->packets++;
+      c->bytes += len;
+    } else {
+      q->stats.dropped_client_busy++;
+      o->dropped++;
     }
+    return;
   }
 
-  return rv;
+  if (o->n == BATCH) {
+    outbox_flush(q, o);
+  }
+
+  c->packets++;
+  c->bytes += len;
+  o->targets[o->n] = target;
+  o->iovecs[o->n].iov_base = data;
+  o->iovecs[o->n].iov_len = len;
+  memset(&o->msgs[o->n], 0, sizeof(o->msgs[o->n]));
+  o->msgs[o->n].msg_hdr.msg_name = &c->addr;
+  o->msgs[o->n].msg_hdr.msg_namelen = c->addr_sz;
+  o->msgs[o->n].msg_hdr.msg_iov = &o->iovecs[o->n];
+  o->msgs[o->n].msg_hdr.msg_iovlen = 1;
+  o->n++;
 }
 
-int tun_alloc(char *dev) {
+// Cuts a TCP or UDP super-packet into gso_size segments (what the kernel would
+// have done, had it not been for -g) and adds them to the outbox. Returns the
+// number of segments, -1 if it's not something we know how to cut.
+int segment(struct queue *q, struct outbox *o, int target,
+            const struct virtio_net_hdr *h, const uint8_t *packet, size_t len) {
+  int version = packet[0] >> 4;
+  int proto, i;
+  size_t l3, l4, header, offset, seglen;
+  uint32_t pseudo, seq;
+  uint16_t sum;
+  uint8_t *s;
+
+  if (version == 4 && len >= 20) {
+    l3 = (packet[0] & 0x0f) * 4;
+    proto = packet[9];
+  } else if (version == 6 && len >= 40) {
+    l3 = 40;  // No extension headers with TSO/USO.
+    proto = packet[6];
+  } else {
+    return -1;
+  }
+
+  if (proto == IPPROTO_TCP && len >= l3 + 20) {
+    l4 = (packet[l3 + 12] >> 4) * 4;
+  } else if (proto == IPPROTO_UDP) {
+    l4 = 8;
+  } else {
+    return -1;
+  }
+
+  header = l3 + l4;
+  if (len <= header || h->gso_size == 0 || header + h->gso_size > GSO_BUFSIZE) {
+    return -1;
+  }
+
+  // Pseudo header, but for the length: addresses and protocol.
+  pseudo = csum_add(proto, packet + (version == 4 ? 12 : 8), version == 4 ? 8 : 32);
+  seq = ((uint32_t)get16(packet + l3 + 4) << 16) | get16(packet + l3 + 6);
+
+  for (i = 0, offset = header; offset < len; i++, offset += seglen) {
+    seglen = len - offset < h->gso_size ? len - offset : h->gso_size;
+
+    if (o->n == BATCH || o->used + header + seglen > SEGMENTS_SZ) {
+      outbox_flush(q, o);
+    }
+    s = o->segments + o->used;
+    memcpy(s, packet, header);
+    memcpy(s + header, packet + offset, seglen);
+
+    if (version == 4) {
+      put16(s + 2, header + seglen);
+      put16(s + 4, get16(packet + 4) + i);  // ID
+      put16(s + 10, 0);
+      put16(s + 10, csum_fold(csum_add(0, s, l3)));
+    } else {
+      put16(s + 4, l4 + seglen);
+    }
+
+    if (proto == IPPROTO_TCP) {
+      uint32_t segseq = seq + (offset - header);
+
+      put16(s + l3 + 4, segseq >> 16);
+      put16(s + l3 + 6, segseq & 0xffff);
+      if (offset + seglen < len) {
+        s[l3 + 13] &= ~0x09;  // FIN and PSH only on the last one,
+      }
+      if (i > 0) {
+        s[l3 + 13] &= ~0x80;  // CWR only on the first one.
+      }
+      put16(s + l3 + 16, 0);
+      sum = csum_fold(csum_add(pseudo + l4 + seglen, s + l3, l4 + seglen));
+      put16(s + l3 + 16, sum);
+    } else {
+      put16(s + l3 + 4, l4 + seglen);
+      put16(s + l3 + 6, 0);
+      sum = csum_fold(csum_add(pseudo + l4 + seglen, s + l3, l4 + seglen));
+      put16(s + l3 + 6, sum ? sum : 0xffff);
+    }
+
+    outbox_add(q, o, target, s, header + seglen);
+    o->used += header + seglen;
+  }
+
+  return i;
+}
+
+// A packet read from TUN, for the client. With -g it's got a virtio_net_hdr,
+// which only the clients which asked for it get.
+void send_to_client(struct queue *q, struct outbox *o, int target,
+                    uint8_t *data, size_t len) {
+  struct virtio_net_hdr *h = (struct virtio_net_hdr*)data;
+
+  if (!gso || q->clients.c[target].gso) {
+    outbox_add(q, o, target, data, len);
+    return;
+  }
+
+  data += VNET_HDR_SZ;
+  len -= VNET_HDR_SZ;
+
+  if ((h->gso_type & ~VIRTIO_NET_HDR_GSO_ECN) == VIRTIO_NET_HDR_GSO_NONE) {
+    if (h->flags & VIRTIO_NET_HDR_F_NEEDS_CSUM) {
+      finish_checksum(data, len, h);
+    }
+    outbox_add(q, o, target, data, len);
+  } else if (segment(q, o, target, h, data, len) < 0) {
+    debuglog("dropping a super-packet of %zu bytes, can't segment it\n", len);
+    q->stats.dropped_bad_gso++;
+    o->dropped++;
+  } else {
+    q->stats.gso_segmented++;
+  }
+}
+
+int create_metrics_socket(const char *path) {
+  int s;
+  struct sockaddr_un addr;
+
+  memset(&addr, 0, sizeof(addr));
+  addr.sun_family = AF_UNIX;
+  strncpy(addr.sun_path, path, sizeof(addr.sun_path) - 1);
+
+  if ((s = socket(AF_UNIX, SOCK_STREAM, 0)) == -1) {
+    perror("Can't create metrics socket");
+    return -1;
+  }
+
+  unlink(addr.sun_path);
+  if (bind(s, (struct sockaddr*)&addr, SUN_LEN(&addr)) == -1 ||
+      listen(s, 4) == -1) {
+    fprintf(stderr, "Can't listen on %s: ", addr.sun_path);
+    perror(NULL);
+    close(s);
+    return -1;
+  }
+
+  fcntl(s, F_SETFL, O_NONBLOCK);
+  chmod(addr.sun_path, 0666);  // Best effort.
+  return s;
+}
+
+void serve_metrics(int metrics_fd) {
+  char text[METRICS_SZ];
+  int len, i, j;
+  int nclients = 0;
+  struct stats total;
+  int fd = accept(metrics_fd, NULL, NULL);
+
+  if (fd == -1) {
+    return;
+  }
+
+  memset(&total, 0, sizeof(total));
+  for (i = 0; i < nqueues; i++) {
+    struct stats *stats = &queues[i].stats;
+
+    total.wakeups += stats->wakeups;
+    total.tun_packets += stats->tun_packets;
+    total.tun_bytes += stats->tun_bytes;
+    total.tun_batches += stats->tun_batches;
+    total.client_packets += stats->client_packets;
+    total.client_bytes += stats->client_bytes;
+    total.client_batches += stats->client_batches;
+    total.dropped_no_client += stats->dropped_no_client;
+    total.dropped_client_busy += stats->dropped_client_busy;
+    total.dropped_tun_busy += stats->dropped_tun_busy;
+    total.dropped_bad_gso += stats->dropped_bad_gso;
+    total.dropped_invalid += stats->dropped_invalid;
+    total.gso_packets += stats->gso_packets;
+    total.gso_segmented += stats->gso_segmented;
+    total.ring_signals_out += stats->ring_signals_out;
+    total.ring_wakeups_in += stats->ring_wakeups_in;
+    total.registrations += stats->registrations;
+    total.clients_lost += stats->clients_lost;
+    nclients += queues[i].clients.n;
+  }
+
+  len = snprintf(text, sizeof(text),
+      "# HELP ipowd_wakeups_total Main loop wakeups\n"
+      "# TYPE ipowd_wakeups_total counter\n"
+      "ipowd_wakeups_total %" PRIu64 "\n"
+      "# HELP ipowd_packets_total Packets passed between TUN and the client\n"
+      "# TYPE ipowd_packets_total counter\n"
+      "ipowd_packets_total{direction=\"tun_to_client\"} %" PRIu64 "\n"
+      "ipowd_packets_total{direction=\"client_to_tun\"} %" PRIu64 "\n"
+      "# HELP ipowd_bytes_total Bytes passed between TUN and the client\n"
+      "# TYPE ipowd_bytes_total counter\n"
+      "ipowd_bytes_total{direction=\"tun_to_client\"} %" PRIu64 "\n"
+      "ipowd_bytes_total{direction=\"client_to_tun\"} %" PRIu64 "\n"
+      "# HELP ipowd_batches_total Batches the packets were moved in\n"
+      "# TYPE ipowd_batches_total counter\n"
+      "ipowd_batches_total{direction=\"tun_to_client\"} %" PRIu64 "\n"
+      "ipowd_batches_total{direction=\"client_to_tun\"} %" PRIu64 "\n"
+      "# HELP ipowd_dropped_total Packets which were dropped\n"
+      "# TYPE ipowd_dropped_total counter\n"
+      "ipowd_dropped_total{direction=\"tun_to_client\",reason=\"no_client\"} %" PRIu64 "\n"
+      "ipowd_dropped_total{direction=\"tun_to_client\",reason=\"client_busy\"} %" PRIu64 "\n"
+      "ipowd_dropped_total{direction=\"client_to_tun\",reason=\"tun_busy\"} %" PRIu64 "\n"
+      "ipowd_dropped_total{direction=\"tun_to_client\",reason=\"bad_gso\"} %" PRIu64 "\n"
+      "ipowd_dropped_total{direction=\"client_to_tun\",reason=\"invalid\"} %" PRIu64 "\n"
+      "# HELP ipowd_gso_packets_total Super-packets read from TUN (with -g)\n"
+      "# TYPE ipowd_gso_packets_total counter\n"
+      "ipowd_gso_packets_total %" PRIu64 "\n"
+      "# HELP ipowd_gso_segmented_total Super-packets segmented for a client\n"
+      "# TYPE ipowd_gso_segmented_total counter\n"
+      "ipowd_gso_segmented_total %" PRIu64 "\n"
+      "# HELP ipowd_ring_wakeups_total Eventfd wakeups for ring clients\n"
+      "# TYPE ipowd_ring_wakeups_total counter\n"
+      "ipowd_ring_wakeups_total{direction=\"tun_to_client\"} %" PRIu64 "\n"
+      "ipowd_ring_wakeups_total{direction=\"client_to_tun\"} %" PRIu64 "\n"
+      "# HELP ipowd_registrations_total Client registrations\n"
+      "# TYPE ipowd_registrations_total counter\n"
+      "ipowd_registrations_total %" PRIu64 "\n"
+      "# HELP ipowd_clients_lost_total Clients which went away\n"
+      "# TYPE ipowd_clients_lost_total counter\n"
+      "ipowd_clients_lost_total %" PRIu64 "\n"
+      "# HELP ipowd_client_known Whether there's a client to send to\n"
+      "# TYPE ipowd_client_known gauge\n"
+      "ipowd_client_known %d\n"
+      "# HELP ipowd_clients Registered clients\n"
+      "# TYPE ipowd_clients gauge\n"
+      "ipowd_clients %d\n"
+      "# HELP ipowd_queue_packets_total Packets passed through each TUN queue\n"
+      "# TYPE ipowd_queue_packets_total counter\n",
+      total.wakeups,
+      total.tun_packets, total.client_packets,
+      total.tun_bytes, total.client_bytes,
+      total.tun_batches, total.client_batches,
+      total.dropped_no_client, total.dropped_client_busy,
+      total.dropped_tun_busy, total.dropped_bad_gso, total.dropped_invalid,
+      total.gso_packets, total.gso_segmented,
+      total.ring_signals_out, total.ring_wakeups_in,
+      total.registrations, total.clients_lost,
+      nclients > 0 ? 1 : 0, nclients);
+
+  for (i = 0; i < nqueues && len > 0 && len < METRICS_SZ; i++) {
+    len += snprintf(text + len, sizeof(text) - len,
+        "ipowd_queue_packets_total{queue=\"%d\",direction=\"tun_to_client\"} %" PRIu64 "\n"
+        "ipowd_queue_packets_total{queue=\"%d\",direction=\"client_to_tun\"} %" PRIu64 "\n",
+        i, queues[i].stats.tun_packets, i, queues[i].stats.client_packets);
+  }
+
+  if (len > 0 && len < METRICS_SZ) {
+    len += snprintf(text + len, sizeof(text) - len,
+        "# HELP ipowd_client_packets_total Packets sent to each client\n"
+        "# TYPE ipowd_client_packets_total counter\n");
+  }
+
+  for (i = 0; i < nqueues; i++) {
+    struct queue *q = &queues[i];
+
+    pthread_mutex_lock(&q->lock);
+    for (j = 0; j < q->clients.n && len > 0 && len < METRICS_SZ; j++) {
+      len += snprintf(text + len, sizeof(text) - len,
+          "ipowd_client_packets_total{queue=\"%d\",client=\"%s\"} %" PRIu64 "\n",
+          i, q->clients.c[j].addr.sun_path, q->clients.c[j].packets);
+    }
+    pthread_mutex_unlock(&q->lock);
+  }
+
+  // Best effort - it's small enough to fit into the socket's buffer.
+  if (len > 0) {
+    send(fd, text, len < METRICS_SZ ? len : METRICS_SZ - 1, MSG_DONTWAIT | MSG_NOSIGNAL);
+  }
+  close(fd);
+}
+
+int epoll_add(int epoll_fd, int fd) {
+  struct epoll_event ev;
+
+  memset(&ev, 0, sizeof(ev));
+  ev.events = EPOLLIN;
+  ev.data.fd = fd;
+  if (epoll_ctl(epoll_fd, EPOLL_CTL_ADD, fd, &ev) == -1) {
+    perror("epoll_ctl()");
+    return -1;
+  }
+  return 0;
+}
+
+// With multi_queue, every call (with the same dev) adds a queue.
+int tun_alloc(char *dev, bool multi_queue) {
   struct ifreq ifr;
   int fd, err;
 
@@ -109,6 +1032,12 @@ int tun_alloc(char *dev) {
   memset(&ifr, 0, sizeof(ifr));
 
   ifr.ifr_flags = IFF_TUN | IFF_NO_PI;
+  if (multi_queue) {
+    ifr.ifr_flags |= IFF_MULTI_QUEUE;
+  }
+  if (gso) {
+    ifr.ifr_flags |= IFF_VNET_HDR;
+  }
   if (*dev) {
     strncpy(ifr.ifr_name, dev, IFNAMSIZ);
   }
@@ -119,142 +1048,498 @@ int tun_alloc(char *dev) {
     return err;
   }
 
+  if (gso) {
+    int hdr_sz = VNET_HDR_SZ;
+    unsigned int offload = TUN_F_CSUM | TUN_F_TSO4 | TUN_F_TSO6 | TUN_F_TSO_ECN;
+
+    // USO needs a newer kernel (6.2); TSO will do without it.
+    if (ioctl(fd, TUNSETVNETHDRSZ, &hdr_sz) < 0 ||
+        (ioctl(fd, TUNSETOFFLOAD, offload | TUN_F_USO4 | TUN_F_USO6) < 0 &&
+         ioctl(fd, TUNSETOFFLOAD, offload) < 0)) {
+      perror("tun_alloc: can't set up offloads");
+      close(fd);
+      return -1;
+    }
+  }
+
   strcpy(dev, ifr.ifr_name);
   return fd;
 }
 
-int main(int argc, char **argv) {
+// "/var/run/tun_in" -> "/var/run/tun_in.fifo", or "/var/run/tun_in.3.fifo"
+// for queue 3 of several.
+void socket_path(struct sockaddr_un *addr, const char *base, int index) {
+  memset(addr, 0, sizeof(*addr));
+  addr->sun_family = AF_UNIX;
+  if (nqueues == 1) {
+    snprintf(addr->sun_path, sizeof(addr->sun_path), "%s.fifo", base);
+  } else {
+    snprintf(addr->sun_path, sizeof(addr->sun_path), "%s.%d.fifo", base, index);
+  }
+}
+
+// Writes a packet from a client to TUN. Returns -1 if that failed for good.
+int tun_write(struct queue *q, uint8_t *data, int len) {
+  static const uint8_t no_vnet_hdr[VNET_HDR_SZ];  // All zeros: nothing to do.
   int rv;
-  char ifname[IFNAMSIZ] = "";
-  const char *fifo_in = "/var/run/tun_in.fifo";
-  const char *fifo_out = "/var/run/tun_out.fifo";
-  int fifo_fd_in, fifo_fd_out, tun_fd;
-  int maxfd;
 
-  uint8_t *buff = (uint8_t*)malloc(BUFSIZE);
+  if (gso && (*data >> 4 == 4 || *data >> 4 == 6)) {
+    // A plain packet, TUN wants a header anyway.
+    struct iovec parts[2] = {
+      {(void*)no_vnet_hdr, VNET_HDR_SZ}, {data, len}
+    };
+    rv = writev(q->tun_fd, parts, 2);
+  } else {
+    rv = write(q->tun_fd, data, len);
+  }
 
-  struct sockaddr_un addr_tun_in;
-  memset(&addr_tun_in, 0, sizeof(addr_tun_in));
-  addr_tun_in.sun_family = AF_UNIX;
-  strncpy(addr_tun_in.sun_path, fifo_in, sizeof(addr_tun_in.sun_path) - 1);
+  if (rv <= 0) {
+    if (errno == EAGAIN || errno == EWOULDBLOCK) {
+      q->stats.dropped_tun_busy++;
+      return 0;
+    }
+    if (gso && errno == EINVAL) {
+      // A virtio_net_hdr which doesn't make sense.
+      debuglog("TUN didn't take a packet of %d bytes\n", len);
+      q->stats.dropped_invalid++;
+      return 0;
+    }
+    writelog("WARN", "tun_fd=%d, nread=%d\n", q->tun_fd, len);
+    perror("Write tun_fd error");
+    // TODO: Isn't this a critical error?
+    return -1;
+  }
+  return 0;
+}
 
-  struct sockaddr_un addr_tun_out;
-  memset(&addr_tun_out, 0, sizeof(addr_tun_out));
-  addr_tun_out.sun_family = AF_UNIX;
-  strncpy(addr_tun_out.sun_path, fifo_out, sizeof(addr_tun_out.sun_path) - 1);
+// Checks on the ring clients: drains their rings (in case a wakeup got lost)
+// and, every now and then, whether they're still there.
+int poll_rings(struct queue *q, time_t now, time_t *next_probe) {
+  int i, rv;
+  bool lost = false;
+
+  for (i = 0; i < q->clients.n; i++) {
+    struct client *c = &q->clients.c[i];
+
+    if (!c->ring_map) {
+      continue;
+    }
+    if ((rv = ring_drain(q, c, BATCH)) == -1) {
+      return -1;
+    }
+    if (rv == -2) {
+      c->lost = true;
+    }
+    if (now >= *next_probe &&
+        sendto(q->fifo_fd_out, "", 0, MSG_DONTWAIT, (struct sockaddr*)&c->addr,
+               c->addr_sz) == -1 &&
+        (errno == ENOENT || errno == ECONNREFUSED)) {
+      c->lost = true;
+    }
+    lost |= c->lost;
+  }
+
+  if (now >= *next_probe) {
+    *next_probe = now + RING_PROBE_INTERVAL;
+  }
+  if (lost) {
+    remove_clients(q, now);
+  }
+  return 0;
+}
+
+bool has_rings(struct queue *q) {
+  int i;
+
+  for (i = 0; i < q->clients.n; i++) {
+    if (q->clients.c[i].ring_map) {
+      return true;
+    }
+  }
+  return false;
+}
 
-  bool tun_out_client_known = false;
+// The main loop of a queue. Returns only if something went badly wrong.
+void serve(struct queue *q) {
+  int rv;
+  int epoll_fd;
+  int i, j;
+  time_t next_probe = 0;
+  char control[CMSG_SPACE(3 * sizeof(int))];
+  uint8_t *buff = (uint8_t*)malloc(BATCH * bufsize);
+  struct iovec iovecs[BATCH];
+  struct mmsghdr msgs[BATCH];
   struct sockaddr_un addr_tun_out_client;
-  memset(&addr_tun_out_client, 0, sizeof(addr_tun_out_client));
+  struct outbox *out = (struct outbox*)calloc(1, sizeof(struct outbox));
 
-  tun_fd = tun_alloc(ifname);
-  writelog("INFO", "tun_alloc: tun_fd=%d, ifname=%s\n", tun_fd, ifname);
+  out->segments = gso ? (uint8_t*)malloc(SEGMENTS_SZ) : NULL;
 
-  fifo_fd_in = create_unix_dgram_socket(&addr_tun_in);
-  writelog("INFO", "fifo_in_prepare: fifo_in=%s, fifo_fd_in=%d\n", fifo_in, fifo_fd_in);
+  // Everything is nonblocking and drained up to BATCH packets at a time, so
+  // under load there's one epoll_wait (and one recvmmsg/sendmmsg) per batch
+  // rather than per packet. Level triggered: whatever's left over wakes us up
+  // again right away.
+  if (fcntl(q->tun_fd, F_SETFL, O_NONBLOCK) == -1) {
+    perror("Failed to make tun_fd nonblocking");
+    return;
+  }
 
-  fifo_fd_out = create_unix_dgram_socket(&addr_tun_out);
-  writelog("INFO", "fifo_out_prepare: fifo_out=%s, fifo_fd_out=%d\n", fifo_out, fifo_fd_out);
+  if ((epoll_fd = epoll_create1(0)) == -1) {
+    perror("epoll_create1()");
+    return;
+  }
+  q->epoll_fd = epoll_fd;
 
-  if (fifo_fd_in == -1 || fifo_fd_out == -1) {
-    writelog("ERROR", "failed to create sockets\n");
-    return 1;
+  if (epoll_add(epoll_fd, q->tun_fd) == -1 ||
+      epoll_add(epoll_fd, q->fifo_fd_in) == -1 ||
+      epoll_add(epoll_fd, q->fifo_fd_out) == -1 ||
+      (q->metrics_fd != -1 && epoll_add(epoll_fd, q->metrics_fd) == -1)) {
+    return;
   }
 
-  writelog("INFO", "Setup done, perhaps you want to set up a tunnel, for example with something like:\n\tip addr add 10.0.0.1 peer 10.0.0.2 dev %s\n\tip link set %s up\nor with the old ifconfig:\n\tifconfig %s 10.0.0.1 pointopoint 10.0.0.2 netmask 255.255.255.255 up\nand something similar on the other end..\n", ifname, ifname, ifname);
- 
-  maxfd = (tun_fd > fifo_fd_in) ? tun_fd : fifo_fd_in;
-  maxfd = (maxfd > fifo_fd_out) ? maxfd : fifo_fd_out;
+  for (i = 0; i < BATCH; i++) {
+    iovecs[i].iov_base = buff + i * bufsize;
+    iovecs[i].iov_len = bufsize;
+  }
 
   while (1) {
     int ret;
     int nread;
-    fd_set rd_set;
+    int n;
+    size_t bytes;
+    struct epoll_event events[4 + MAX_CLIENTS];
+    bool rings = has_rings(q);
 
-    FD_ZERO(&rd_set);
-    FD_SET(tun_fd, &rd_set);
-    FD_SET(fifo_fd_in, &rd_set);
-    FD_SET(fifo_fd_out, &rd_set);
-
-    ret = select(maxfd + 1, &rd_set, NULL, NULL, NULL);
+    ret = epoll_wait(epoll_fd, events, 4 + MAX_CLIENTS, rings ? RING_POLL_MS : -1);
+    q->stats.wakeups++;
 
     if (ret < 0 && errno == EINTR) {
       continue;
     }
 
     if (ret < 0) {
-      perror("select()");
+      perror("epoll_wait()");
+      continue;
     }
 
-    if (FD_ISSET(tun_fd, &rd_set)) {
-      if ((nread = read(tun_fd, buff, BUFSIZE)) < 0) {
-        perror("tun_fd read error");
-        continue;
-      }
-      writelog("INFO", "Read bytes from tun_fd: %d\n", nread);
+    if (rings && poll_rings(q, time(NULL), &next_probe) == -1) {
+      break;
+    }
 
-      if (tun_out_client_known) {
-        rv = fifo_out_write(fifo_fd_out, &addr_tun_out_client, buff, nread);
-        writelog("INFO", "fifo_out_write: %d, fifo_fd_out = %d, fifo_out = %s\n", rv, fifo_fd_out, fifo_out);
+    for (i = 0; i < ret; i++) {
+      int fd = events[i].data.fd;
 
-        if (rv == -1) {
-          tun_out_client_known = false;
-          memset(&addr_tun_out_client, 0, sizeof(addr_tun_out_client));
-          writelog("INFO", "fifo_out_write: client lost\n");
+      if (fd == q->tun_fd) {
+        // TUN gives one packet per read, no way around that here.
+        bytes = 0;
+        for (n = 0; n < BATCH; n++) {
+          if ((nread = read(q->tun_fd, iovecs[n].iov_base, bufsize)) < 0) {
+            if (errno != EAGAIN && errno != EWOULDBLOCK && errno != EINTR) {
+              perror("tun_fd read error");
+            }
+            break;
+          }
+          iovecs[n].iov_len = nread;
+          bytes += nread;
+        }
+
+        if (n == 0) {
+          continue;
+        }
+
+        debuglog("Read %d packets, %zu bytes from tun_fd (queue %d)\n", n, bytes, q->index);
+        q->stats.tun_batches++;
+        q->stats.tun_packets += n;
+        q->stats.tun_bytes += bytes;
+
+        if (expiry) {
+          remove_clients(q, time(NULL));
+        }
+
+        if (q->clients.n) {
+          size_t skip = gso ? VNET_HDR_SZ : 0;
+
+          out->dropped = 0;
+          for (j = 0; j < n; j++) {
+            uint8_t *packet = iovecs[j].iov_base;
+            size_t len = iovecs[j].iov_len;
+
+            if (len <= skip) {
+              continue;
+            }
+            if (gso && ((struct virtio_net_hdr*)packet)->gso_type != VIRTIO_NET_HDR_GSO_NONE) {
+              q->stats.gso_packets++;
+            }
+            send_to_client(q, out, pick_client(q, packet + skip, len - skip),
+                           packet, len);
+          }
+
+          outbox_flush(q, out);
+          rv = out->dropped;
+          debuglog("fifo_out_write: %d dropped, fifo_fd_out = %d, fifo_out = %s\n", rv, q->fifo_fd_out, q->addr_tun_out.sun_path);
+
+          if (rv) {
+            remove_clients(q, time(NULL));
+          }
+        } else {
+          q->stats.dropped_no_client += n;
+          debuglog("fifo_out_write: dropped %d packets - no one to receive them\n", n);
+        }
+
+        for (j = 0; j < n; j++) {
+          iovecs[j].iov_len = bufsize;
         }
-      } else {
-        writelog("INFO", "fifo_out_write: dropped packet - no one to receive it\n");
       }
-    }
 
-    if (FD_ISSET(fifo_fd_out, &rd_set)) {
-      // We don't care about the data, but we need to save the address - it's
-      // the client telling us where to send the data.
-      socklen_t addr_sz = sizeof(addr_tun_out_client);
-      nread = recvfrom(fifo_fd_out, buff, BUFSIZE, 0,
-                       (struct sockaddr*)&addr_tun_out_client, &addr_sz);
+      if (fd == q->fifo_fd_out) {
+        // We don't care about the data (but for "gso"/"ring"), but we need to
+        // save the address - it's the client telling us where to send the
+        // data. Ring clients send the file descriptors along.
+        struct iovec iov = {buff, bufsize};
+        struct msghdr msg;
+        struct cmsghdr *cmsg;
+        int fds[3];
+        bool ring = false;
 
-      if (nread != -1) {
-        tun_out_client_known = true;
-        writelog("INFO", "fifo_fd_out: new client %s, %u\n",
-                         addr_tun_out_client.sun_path, addr_sz);
-      } else {
-        writelog("INFO", "fifo_fd_out: client came and got lost again\n");
+        memset(&msg, 0, sizeof(msg));
+        msg.msg_name = &addr_tun_out_client;
+        msg.msg_namelen = sizeof(addr_tun_out_client);
+        msg.msg_iov = &iov;
+        msg.msg_iovlen = 1;
+        msg.msg_control = control;
+        msg.msg_controllen = sizeof(control);
+        nread = recvmsg(q->fifo_fd_out, &msg, MSG_DONTWAIT | MSG_CMSG_CLOEXEC);
+
+        for (cmsg = nread != -1 ? CMSG_FIRSTHDR(&msg) : NULL; cmsg;
+             cmsg = CMSG_NXTHDR(&msg, cmsg)) {
+          if (cmsg->cmsg_level == SOL_SOCKET && cmsg->cmsg_type == SCM_RIGHTS) {
+            int count = (cmsg->cmsg_len - CMSG_LEN(0)) / sizeof(int);
+
+            if (count == 3 && nread >= 4 && !memcmp(buff, "ring", 4)) {
+              memcpy(fds, CMSG_DATA(cmsg), sizeof(fds));
+              ring = true;
+            } else {
+              for (j = 0; j < count; j++) {
+                close(((int*)CMSG_DATA(cmsg))[j]);
+              }
+            }
+          }
+        }
+
+        if (nread != -1 && msg.msg_namelen <= sizeof(sa_family_t)) {
+          writelog("INFO", "fifo_fd_out: client without an address, ignoring it\n");
+          if (ring) {
+            close(fds[0]);
+            close(fds[1]);
+            close(fds[2]);
+          }
+        } else if (nread != -1) {
+          register_client(q, &addr_tun_out_client, msg.msg_namelen, time(NULL),
+                          memmem(buff, nread, "gso", 3) != NULL,
+                          ring ? fds : NULL);
+        } else if (errno != EAGAIN && errno != EWOULDBLOCK) {
+          writelog("INFO", "fifo_fd_out: client came and got lost again\n");
+        }
       }
-    }
 
+      if (fd == q->fifo_fd_in) {
+        for (j = 0; j < BATCH; j++) {
+          memset(&msgs[j], 0, sizeof(msgs[j]));
+          msgs[j].msg_hdr.msg_iov = &iovecs[j];
+          msgs[j].msg_hdr.msg_iovlen = 1;
+        }
 
-    if (FD_ISSET(fifo_fd_in, &rd_set)) {
-      nread = recvfrom(fifo_fd_in, buff, BUFSIZE, 0, NULL, NULL);
-      if (nread == 0) {
-        // fifo closed on the other end
-        writelog("WARNING", "fifo_fd_in, remote end closed, let's reopen it\n");
-        FD_CLR(fifo_fd_in, &rd_set);
-        close(fifo_fd_in);
-        fifo_fd_in = create_unix_dgram_socket(&addr_tun_in);
-        FD_SET(fifo_fd_in, &rd_set);
-        maxfd = (tun_fd > fifo_fd_in) ? tun_fd : fifo_fd_in;
-        continue;
+        if ((n = recvmmsg(q->fifo_fd_in, msgs, BATCH, MSG_DONTWAIT, NULL)) < 0) {
+          if (errno != EAGAIN && errno != EWOULDBLOCK && errno != EINTR) {
+            perror("fifo_fd_in read error");
+          }
+          continue;
+        }
+
+        bytes = 0;
+        for (j = 0; j < n; j++) {
+          nread = msgs[j].msg_len;
+
+          if (nread == 0) {
+            // fifo closed on the other end
+            writelog("WARNING", "fifo_fd_in, remote end closed, let's reopen it\n");
+            epoll_ctl(epoll_fd, EPOLL_CTL_DEL, q->fifo_fd_in, NULL);
+            close(q->fifo_fd_in);
+            if ((q->fifo_fd_in = create_unix_dgram_socket(&q->addr_tun_in)) == -1 ||
+                epoll_add(epoll_fd, q->fifo_fd_in) == -1) {
+              return;
+            }
+            break;
+          }
+
+          bytes += nread;
+          if (tun_write(q, iovecs[j].iov_base, nread) == -1) {
+            goto out;
+          }
+        }
+
+        debuglog("Read %d packets, %zu bytes from fifo_fd_in (queue %d)\n", j, bytes, q->index);
+        q->stats.client_batches++;
+        q->stats.client_packets += j;
+        q->stats.client_bytes += bytes;
       }
 
-      if (nread < 0) {
-        perror("fifo_fd_in read error");
-        continue;
+      if (fd == q->metrics_fd) {
+        serve_metrics(q->metrics_fd);
       }
 
-      writelog("INFO", "Read bytes from fifo_fd_in: %d\n", nread);
+      // A ring client's eventfd: there's something in its ring.
+      for (j = 0; j < q->clients.n; j++) {
+        struct client *c = &q->clients.c[j];
+        uint64_t count;
 
-      if ((rv = write(tun_fd, buff, nread)) <= 0) {
-        writelog("WARN", "tun_fd=%d, nread=%zu\n", tun_fd, nread);
-        perror("Write tun_fd error");
-        // TODO: Isn't this a critical error?
+        if (!c->ring_map || fd != c->efd_in) {
+          continue;
+        }
+
+        q->stats.ring_wakeups_in++;
+        if (read(c->efd_in, &count, sizeof(count)) == -1 && errno != EAGAIN) {
+          perror("Can't read a ring client's eventfd");
+        }
+
+        // At most a few batches, then whatever else wants attention; what's
+        // left waits for the next round (see poll_rings) or a wakeup, which
+        // we give ourselves.
+        rv = ring_drain(q, c, 4 * BATCH);
+        if (rv == -1) {
+          goto out;
+        }
+        if (rv == -2) {
+          c->lost = true;
+          remove_clients(q, time(NULL));
+        } else if (rv == 4 * BATCH) {
+          count = 1;
+          if (write(c->efd_in, &count, sizeof(count)) == -1) {
+            perror("Can't signal ourselves");
+          }
+        } else if (rv > 0) {
+          q->stats.client_batches++;
+        }
         break;
       }
     }
   }
 
+out:
+  close(epoll_fd);
   free(buff);
+  free(out->segments);
+  free(out);
+}
 
+// Whichever queue stops first takes everything down with it.
+void *run_queue(void *arg) {
+  serve((struct queue*)arg);
   writelog("INFO", "Do widzenia\n");
+  exit(0);
+}
+
+int main(int argc, char **argv) {
+  char ifname[IFNAMSIZ] = "";
+  const char *fifo_in = "/var/run/tun_in";
+  const char *fifo_out = "/var/run/tun_out";
+  const char *metrics_path = NULL;
+  int metrics_fd = -1;
+  int opt;
+  bool usage = false;
+  int i;
+
+  while ((opt = getopt(argc, argv, "vqgm:c:e:n:")) != -1) {
+    switch (opt) {
+      case 'v':
+        loglevel = LEVEL_DEBUG;
+        break;
+      case 'q':
+        loglevel = LEVEL_WARNING;
+        break;
+      case 'g':
+        gso = true;
+        bufsize = GSO_BUFSIZE;
+        break;
+      case 'm':
+        metrics_path = optarg;
+        break;
+      case 'c':
+        if (!strcmp(optarg, "hash")) {
+          mode = MODE_HASH;
+        } else if (!strcmp(optarg, "last")) {
+          mode = MODE_LAST;
+        } else {
+          usage = true;
+        }
+        break;
+      case 'e':
+        if ((expiry = atoi(optarg)) <= 0) {
+          usage = true;
+        }
+        break;
+      case 'n':
+        nqueues = atoi(optarg);
+        if (nqueues < 1 || nqueues > MAX_QUEUES) {
+          usage = true;
+        }
+        break;
+      default:
+        usage = true;
+    }
+  }
+
+  if (usage) {
+    fprintf(stderr, "usage: %s [-v|-q] [-g] [-m metrics_socket_path] [-c hash|last] [-e seconds] [-n queues]\n", argv[0]);
+    return 1;
+  }
+
+  queues = (struct queue*)calloc(nqueues, sizeof(struct queue));
+
+  for (i = 0; i < nqueues; i++) {
+    struct queue *q = &queues[i];
+
+    q->index = i;
+    q->metrics_fd = -1;
+    q->clients.last = -1;
+    pthread_mutex_init(&q->lock, NULL);
+
+    // A single queue is the plain old TUN, without IFF_MULTI_QUEUE.
+    if ((q->tun_fd = tun_alloc(ifname, nqueues > 1)) < 0) {
+      return 1;
+    }
+    writelog("INFO", "tun_alloc: tun_fd=%d, ifname=%s, queue=%d\n", q->tun_fd, ifname, i);
+
+    socket_path(&q->addr_tun_in, fifo_in, i);
+    q->fifo_fd_in = create_unix_dgram_socket(&q->addr_tun_in);
+    writelog("INFO", "fifo_in_prepare: fifo_in=%s, fifo_fd_in=%d\n", q->addr_tun_in.sun_path, q->fifo_fd_in);
+
+    socket_path(&q->addr_tun_out, fifo_out, i);
+    q->fifo_fd_out = create_unix_dgram_socket(&q->addr_tun_out);
+    writelog("INFO", "fifo_out_prepare: fifo_out=%s, fifo_fd_out=%d\n", q->addr_tun_out.sun_path, q->fifo_fd_out);
+
+    if (q->fifo_fd_in == -1 || q->fifo_fd_out == -1) {
+      writelog("ERROR", "failed to create sockets\n");
+      return 1;
+    }
+  }
+
+  if (metrics_path) {
+    if ((metrics_fd = create_metrics_socket(metrics_path)) == -1) {
+      return 1;
+    }
+    queues[0].metrics_fd = metrics_fd;
+    writelog("INFO", "metrics: %s\n", metrics_path);
+  }
+
+  writelog("INFO", "Setup done, perhaps you want to set up a tunnel, for example with something like:\n\tip addr add 10.0.0.1 peer 10.0.0.2 dev %s\n\tip link set %s up\nor with the old ifconfig:\n\tifconfig %s 10.0.0.1 pointopoint 10.0.0.2 netmask 255.255.255.255 up\nand something similar on the other end..\n", ifname, ifname, ifname);
+
+  for (i = 1; i < nqueues; i++) {
+    if (pthread_create(&queues[i].thread, NULL, run_queue, &queues[i])) {
+      writelog("ERROR", "can't start a thread for queue %d\n", i);
+      return 1;
+    }
+  }
+
+  run_queue(&queues[0]);
   return 0;
 }
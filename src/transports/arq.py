@@ -0,0 +1,317 @@
+# Optional link-layer reliability (selective repeat ARQ) for the lossy
+# transports. Every packet gets a sequence number, and every frame going the
+# other way carries a cumulative ACK plus a bitmap of what arrived after it
+# (so ACKs ride along with the reverse traffic for free; a pure ACK frame is
+# only sent when there's nothing else to send for ACK_DELAY).
+#
+# Lost packets are sent again after an RTO (estimated like TCP does, RFC
+# 6298), or right away when DUP_THRESHOLD later packets were ACKed (fast
+# retransmit). But only until their deadline - after that a packet is given
+# up, so this never adds more than that much latency (inner TCP takes it from
+# there). Packets wait for an ACK only while they're among the last WINDOW
+# sent; the oldest one is given up to make room.
+#
+# Packets are delivered as soon as they arrive, i.e. possibly out of order
+# (IP doesn't mind), duplicates are dropped. Frames which aren't ARQ frames
+# pass through as they are.
+#
+# Frames:
+#   DATA: 0x20, seq (2), seq - oldest unACKed seq (1), ACK (2), bitmap (4),
+#         payload
+#   DATA: 0x22, same, but nothing was received yet (ACK fields are unused)
+#   ACK:  0x21, ACK (2), bitmap (4)
+# ACK is the next expected sequence number, bit i of the bitmap is ACK+1+i.
+import collections
+import struct
+import threading
+import time
+
+import metrics
+
+FRAME_DATA = 0x20
+FRAME_ACK = 0x21
+FRAME_DATA_NO_ACK = 0x22
+DATA_FORMAT = "!BHBHI"
+ACK_FORMAT = "!BHI"
+DATA_HEADER_SIZE = struct.calcsize(DATA_FORMAT)
+ACK_SIZE = struct.calcsize(ACK_FORMAT)
+
+WINDOW = 32  # Packets; has to fit into the bitmap.
+DEADLINE = 2.0  # Seconds.
+INITIAL_RTO = 1.0
+MIN_RTO = 0.2
+ACK_DELAY = 0.2
+DUP_THRESHOLD = 3
+STATS_INTERVAL = 10.0
+
+
+def seq_diff(a, b):
+    # a - b, with the 16-bit wraparound.
+    d = (a - b) & 0xffff
+    return d - 0x10000 if d >= 0x8000 else d
+
+
+class Outstanding:
+    def __init__(self, seq, data, now, deadline):
+        self.seq = seq
+        self.data = data
+        self.first_sent = now
+        self.last_sent = now
+        self.deadline = now + deadline
+        self.retries = 0
+        self.fast_retransmitted = False
+        self.due = False  # For fast retransmit.
+
+
+class ARQ:
+    def __init__(self, deadline=DEADLINE, window=WINDOW,
+                 initial_rto=INITIAL_RTO, logger=None):
+        self.deadline = deadline
+        self.initial_rto = initial_rto
+        self.window = min(window, WINDOW)
+        self.logger = logger
+        self.lock = threading.Lock()
+
+        # Sending side.
+        self.next_seq = 0
+        self.outstanding = collections.OrderedDict()  # Seq -> Outstanding.
+        self.srtt = None
+        self.rttvar = None
+
+        # Receiving side.
+        self.expected = None  # Next expected seq (None: nothing received).
+        self.received = set()  # Seqs received after expected.
+        self.ack_due = None  # When to send a pure ACK.
+
+        # Statistics (since the last report).
+        self.stats_time = time.monotonic()
+        self.sent = 0
+        self.retransmitted = 0
+        self.given_up = 0
+        self.delivered = 0
+        self.duplicates = 0
+
+        # The same, for metrics.py (never reset).
+        self.retransmitted_counter = metrics.counter(
+            "ipow_arq_retransmitted_total", "Packets sent again by ARQ"
+        )
+        self.given_up_counter = metrics.counter(
+            "ipow_arq_given_up_total", "Packets ARQ gave up on"
+        )
+        self.duplicates_counter = metrics.counter(
+            "ipow_arq_duplicates_total", "Duplicate packets dropped by ARQ"
+        )
+        self.rtt_histogram = metrics.histogram(
+            "ipow_arq_rtt_seconds", "Time until a packet was ACKed"
+        )
+
+    def rto(self):
+        if self.srtt is None:
+            return self.initial_rto
+        return max(MIN_RTO, self.srtt + 4 * self.rttvar)
+
+    def ack_fields(self):
+        if self.expected is None:
+            return 0, 0
+        bitmap = 0
+        for seq in self.received:
+            bitmap |= 1 << (seq_diff(seq, self.expected) - 1)
+        return self.expected, bitmap
+
+    def data_frame(self, entry):
+        ack, bitmap = self.ack_fields()
+        self.ack_due = None  # This one carries the ACK.
+        base = next(iter(self.outstanding))
+        frame_type = FRAME_DATA if self.expected is not None else FRAME_DATA_NO_ACK
+        return struct.pack(
+            DATA_FORMAT, frame_type, entry.seq, seq_diff(entry.seq, base), ack,
+            bitmap
+        ) + entry.data
+
+    def give_up(self, seq):
+        del self.outstanding[seq]
+        self.given_up += 1
+        self.given_up_counter.inc()
+
+    def wrap(self, data):
+        # Returns the frame to send in place of the packet.
+        with self.lock:
+            now = time.monotonic()
+            # The other side's bitmap only covers WINDOW packets after the
+            # oldest one we're still waiting for.
+            while (self.outstanding and seq_diff(
+                    self.next_seq, next(iter(self.outstanding))) >= self.window):
+                self.give_up(next(iter(self.outstanding)))
+
+            entry = Outstanding(self.next_seq, data, now, self.deadline)
+            self.outstanding[entry.seq] = entry
+            self.next_seq = (self.next_seq + 1) & 0xffff
+            self.sent += 1
+            self.report(now)
+            return self.data_frame(entry)
+
+    def poll(self):
+        # Returns the frames which should be sent now: retransmissions, and a
+        # pure ACK if one is due.
+        frames = []
+        with self.lock:
+            now = time.monotonic()
+            for seq, entry in list(self.outstanding.items()):
+                if now >= entry.deadline:
+                    self.give_up(seq)
+
+            rto = self.rto()
+            for entry in list(self.outstanding.values()):
+                timeout = rto * (1 << min(entry.retries, 6))
+                if entry.due or now - entry.last_sent >= timeout:
+                    entry.due = False
+                    entry.retries += 1
+                    entry.last_sent = now
+                    self.retransmitted += 1
+                    self.retransmitted_counter.inc()
+                    frames.append(self.data_frame(entry))
+
+            if self.ack_due is not None and now >= self.ack_due:
+                ack, bitmap = self.ack_fields()
+                frames.append(struct.pack(ACK_FORMAT, FRAME_ACK, ack, bitmap))
+                self.ack_due = None
+
+            self.report(now)
+        return frames
+
+    def next_timeout(self):
+        # Seconds until poll() might have something to send, or None.
+        with self.lock:
+            now = time.monotonic()
+            times = []
+            if self.ack_due is not None:
+                times.append(self.ack_due)
+            rto = self.rto()
+            for entry in self.outstanding.values():
+                if entry.due:
+                    return 0
+                times.append(min(
+                    entry.deadline,
+                    entry.last_sent + rto * (1 << min(entry.retries, 6))
+                ))
+            return max(0, min(times) - now) if times else None
+
+    def acked(self, ack, bitmap, now):
+        acked = []
+        for seq, entry in self.outstanding.items():
+            d = seq_diff(seq, ack)
+            if d < 0 or (0 < d <= WINDOW and bitmap & (1 << (d - 1))):
+                acked.append(entry)
+
+        for entry in acked:
+            del self.outstanding[entry.seq]
+            if entry.retries == 0:
+                # Karn: only packets which weren't retransmitted say anything
+                # about the RTT.
+                rtt = now - entry.first_sent
+                self.rtt_histogram.observe(rtt)
+                if self.srtt is None:
+                    self.srtt = rtt
+                    self.rttvar = rtt / 2
+                else:
+                    self.rttvar = 0.75 * self.rttvar + 0.25 * abs(self.srtt - rtt)
+                    self.srtt = 0.875 * self.srtt + 0.125 * rtt
+
+        # Fast retransmit the ones which DUP_THRESHOLD later packets overtook.
+        for entry in self.outstanding.values():
+            d = seq_diff(entry.seq, ack)
+            if d < 0 or entry.fast_retransmitted:
+                continue
+            later = bin(bitmap >> d).count("1")
+            if later >= DUP_THRESHOLD:
+                entry.fast_retransmitted = True
+                entry.due = True
+
+    def unwrap(self, frame):
+        # Returns the packet to deliver, or None (duplicate, or just an ACK).
+        if not frame or frame[0] not in (FRAME_DATA, FRAME_ACK, FRAME_DATA_NO_ACK):
+            return frame
+
+        with self.lock:
+            now = time.monotonic()
+
+            if frame[0] == FRAME_ACK:
+                if len(frame) == ACK_SIZE:
+                    _, ack, bitmap = struct.unpack(ACK_FORMAT, frame)
+                    self.acked(ack, bitmap, now)
+                return None
+
+            if len(frame) < DATA_HEADER_SIZE:
+                return None
+            frame_type, seq, back, ack, bitmap = struct.unpack(
+                DATA_FORMAT, frame[:DATA_HEADER_SIZE]
+            )
+            if frame_type == FRAME_DATA:
+                self.acked(ack, bitmap, now)
+
+            base = (seq - back) & 0xffff
+            if (self.expected is None or
+                    abs(seq_diff(seq, self.expected)) > 2 * WINDOW):
+                # First packet, or the other side started over.
+                self.expected = base
+                self.received.clear()
+            elif seq_diff(base, self.expected) > 0:
+                # The other side gave up on what we're still missing.
+                self.expected = base
+                self.received = {
+                    s for s in self.received if seq_diff(s, base) > 0
+                }
+
+            d = seq_diff(seq, self.expected)
+            if d < 0 or seq in self.received:
+                self.duplicates += 1
+                self.duplicates_counter.inc()
+                self.ack_due = now  # Our ACK got lost, apparently.
+                return None
+
+            if d == 0:
+                self.expected = (self.expected + 1) & 0xffff
+                while self.expected in self.received:
+                    self.received.remove(self.expected)
+                    self.expected = (self.expected + 1) & 0xffff
+            else:
+                self.received.add(seq)
+
+            if d > 0 or self.received:
+                self.ack_due = now  # Something's missing, tell them ASAP.
+            elif self.ack_due is None:
+                self.ack_due = now + ACK_DELAY
+
+            self.delivered += 1
+            return frame[DATA_HEADER_SIZE:]
+
+    def stats(self):
+        return {
+            "sent": self.sent,
+            "retransmitted": self.retransmitted,
+            "given_up": self.given_up,
+            "delivered": self.delivered,
+            "duplicates": self.duplicates,
+            "unacked": len(self.outstanding),
+            "rtt": self.srtt,
+        }
+
+    def report(self, now):
+        if not self.logger or now - self.stats_time < STATS_INTERVAL:
+            return
+
+        stats = self.stats()
+        rtt = f"{stats['rtt'] * 1000:.0f} ms" if stats["rtt"] is not None else "?"
+        self.logger.info(
+            f"ARQ: {stats['sent']} sent, {stats['retransmitted']} "
+            f"retransmitted, {stats['given_up']} given up, "
+            f"{stats['delivered']} delivered, {stats['duplicates']} duplicates, "
+            f"{stats['unacked']} waiting for ACK, RTT {rtt}"
+        )
+
+        self.stats_time = now
+        self.sent = 0
+        self.retransmitted = 0
+        self.given_up = 0
+        self.delivered = 0
+        self.duplicates = 0
@@ -13,31 +13,132 @@ import argparse
 import logging
 import socket
 import queue
+import collections
+import multiprocessing
+from multiprocessing import shared_memory
 import sys
-import pasimple
+import backends
 import time
 from struct import pack, unpack
+import fec
+
+# Header compression is shared by all the transports.
+sys.path.insert(
+    0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..")
+)
+import arq
+import codel
+import hdrcomp
+import ipowwriter
+import lanes
+import metrics
+import tracing
 
 logging.basicConfig(level=logging.INFO)
 
-AUDIO_CHANNELS = 1  # We only support 1 channel.
-AUDIO_SAMPLE_FORMAT = pasimple.PA_SAMPLE_S16LE
-AUDIO_SAMPLES_PER_SECOND = 44100
+# Default number of channels. With 2 channels (stereo) left and right carry
+# two independent symbol streams, i.e. twice the throughput on the same cable.
+AUDIO_CHANNELS = 1
+
+# Peak amplitude of the generated waveforms (i.e. half of int16's range).
+AUDIO_FULL_SCALE = 0x7fff // 2
+
+
+class ModemProfile:
+  # Describes how symbols are turned into audio (and back): the sample rate,
+  # how long a symbol is, how many samples we FFT and how many data bits there
+  # are per symbol. The frequency plan is derived from these.
+  #
+  # Note: a "symbol" for us is a (data_bits + 2)-bit "word" – bits 1 to
+  # data_bits are data, and bit 0 and the top-most bit are control bits used
+  # to denote when data is sent, etc.
+  def __init__(self, profile_id, name, sample_rate, fft_sample_count,
+               samples_per_symbol, data_bits):
+    self.profile_id = profile_id
+    self.name = name
+    self.sample_rate = sample_rate
+
+    # From how many audio sample will we determine the frequencies? Note that
+    # this also determines which exact frequencies we use (as calculated
+    # below).
+    self.fft_sample_count = fft_sample_count
+
+    # How long (in samples) do we hold a given frequency pattern when sending?
+    # This also determines the "step" we use while decoding the samples.
+    self.samples_per_symbol = samples_per_symbol
+    assert samples_per_symbol >= fft_sample_count
+
+    self.data_bits = data_bits
+    self.bytes_per_symbol = data_bits // 8
+
+    # Which frequencies should we use? We're making this easy for ourselves
+    # since numpy's FFT works nicely with these frequencies.
+    freq_offset = sample_rate / fft_sample_count
+    self.freq_indexes = [4 + i * 3 for i in range(1 + data_bits + 1)]
+    self.frequencies = [freq_offset * idx for idx in self.freq_indexes]
+    assert self.freq_indexes[-1] < fft_sample_count // 2
+
+    # Where in a symbol do we sample it (when we know where it starts)?
+    self.window_offset = (samples_per_symbol - fft_sample_count) // 2
+
+    # How strong must the signal be (as seen by the FFT) to bother with it?
+    self.weak_signal = 50000 * fft_sample_count // 64
+
+    # Symbol bits.
+    data_mask = (1 << data_bits) - 1
+    self.ctrl_hi = 1 << (data_bits + 1)
+    self.ctrl_lo = 1
+    self.ctrl_mask = self.ctrl_hi | self.ctrl_lo
+    self.size_mask = self.ctrl_mask | ((data_mask & ~0x3f) << 1)
+    self.size_lo = 0b01000000 << 1
+    self.size_hi = 0b10000000 << 1
+    self.end = data_mask << 1
+
+  def same_plan(self, other):
+    return (
+        self.sample_rate == other.sample_rate and
+        self.fft_sample_count == other.fft_sample_count and
+        self.samples_per_symbol == other.samples_per_symbol and
+        self.data_bits == other.data_bits
+    )
+
+  def bytes_per_second(self):
+    return self.bytes_per_symbol * self.sample_rate / self.samples_per_symbol
+
+  def symbol_to_str(self, s):
+    data = (s >> 1) & ((1 << self.data_bits) - 1)
+    return (
+        f"{(s >> (self.data_bits + 1)) & 1}_"
+        f"{data:0{self.data_bits // 4}x}_{s & 1}"
+    )
 
-# From how many audio sample will we determine the frequencies? Note that this
-# also determines which exact frequencies we use (as calculated below).
-FFT_SAMPLE_COUNT = 64
 
-# Which frequencies should we use? We're making this easy for ourselves since
-# numpy's FFT works nicely with these frequencies.
-FREQ_OFFSET = AUDIO_SAMPLES_PER_SECOND / FFT_SAMPLE_COUNT
-FREQUENCIES = [FREQ_OFFSET * (4 + i * 3) for i in range(1 + 8 + 1)]
-# FREQUENCIES = [FREQ_OFFSET * (5 + i * 3) for i in range(1 + 4 + 1 + 1) if i != 5]
-FREQ_INDEXES = [round(freq * FFT_SAMPLE_COUNT / AUDIO_SAMPLES_PER_SECOND)
-                for freq in FREQUENCIES]
+# The lead (and the header symbol which says which profile follows) is always
+# sent using the classic 8 data bits per symbol plan, so that the receiver can
+# find it without knowing the profile. For sample rates above 44100 Hz, symbols
+# and FFT windows are stretched so that the frequencies stay the same.
+def lead_profile(sample_rate):
+  scale = max(1, sample_rate // 44100)
+  return ModemProfile(None, "lead", sample_rate, 64 * scale, 256 * scale, 8)
+
+
+PROFILES = [
+    # Classic ~170 bytes/s profile, same as the lead (so no header symbol).
+    ModemProfile(0, "classic", 44100, 64, 256, 8),
+    # Shorter symbols at 48 kHz, ~375 bytes/s.
+    ModemProfile(1, "48k", 48000, 64, 128, 8),
+    # Two data bytes per symbol at 48 kHz, ~500 bytes/s.
+    ModemProfile(2, "48k-wide", 48000, 128, 192, 16),
+    # Two data bytes per symbol at 96 kHz, ~750 bytes/s.
+    ModemProfile(3, "96k-wide", 96000, 128, 256, 16),
+    # Two data bytes per symbol at 96 kHz with short symbols, ~1200 bytes/s.
+    ModemProfile(4, "96k-fast", 96000, 128, 160, 16),
+]
+PROFILES_BY_NAME = {profile.name: profile for profile in PROFILES}
 
 """
 # Debug code to play with frequencies.
+FREQUENCIES = PROFILES_BY_NAME["48k-wide"].frequencies
 print(FREQUENCIES)
 for i in FREQUENCIES:
   for j in FREQUENCIES:
@@ -46,17 +147,55 @@ for i in FREQUENCIES:
 sys.exit()
 """
 
-# How long (in samples) do we hold a given frequency pattern when sending?
-# This also determines the "step" we use while decoding the samples.
-SAMPLES_PER_SYMBOL = 256
-assert SAMPLES_PER_SYMBOL >= FFT_SAMPLE_COUNT
-
-# Note: a "symbol" for us is a 10-bit "byte" – bits 1-8 are byte data, and bits
-# 0 and 9 are control bits used to denote when data is sent, etc.
-
 # How many calibration/lead symbols to send before sending the payload.
 LEAD_SIZE = 5
 
+# Lead symbols (both control bits set, alternating 0xAA and 0x55 data bits),
+# and the header symbol (both control bits set, top two data bits cleared)
+# which follows the leads if the profile isn't the same as the lead's, or if
+# FEC is used:
+#   1_00rrpppp_1 - pppp is the profile ID, rr is the FEC scheme ID
+LEAD_SYMBOLS = (0b1_10101010_1, 0b1_01010101_1)
+HEADER_MASK = 0b1_11000000_1
+HEADER = 0b1_00000000_1
+
+# Packets waiting in IPOW's outbound socket are sent together as one "burst",
+# i.e. back-to-back after a single lead and followed by a single end symbol.
+# These limit how much we pack into one burst.
+BURST_MAX_PACKETS = 16
+BURST_MAX_BYTES = 2048
+
+# A packet in the middle of a burst is waited for until there's this many
+# symbols' worth of audio more than it takes. Past that, it's not coming.
+BURST_WAIT_SLACK = 8
+
+# If nothing was transmitted for this long (in seconds), send an empty packet
+# so that the other side can calibrate.
+CALIBRATION_INTERVAL = 1.5
+
+# The demodulator tracks the minimum/maximum amplitude over this many seconds
+# of audio (i.e. a sliding window). If the difference is below AGC_MIN_SNR
+# times the noise floor (the smallest one of a single chunk over the last
+# AGC_NOISE_WINDOW seconds), or below AGC_MIN_SIGNAL, there's just noise (or
+# nothing at all), and the last good calibration is kept. Until there's
+# AGC_NOISE_WINDOW of audio, the noise floor isn't known and only
+# AGC_MIN_SIGNAL counts (a sender may well start talking right away).
+AGC_WINDOW = 0.5
+AGC_NOISE_WINDOW = 5.0
+AGC_MIN_SNR = 4
+AGC_MIN_SIGNAL = 256
+
+# How many synthesized waveforms can wait for the audio sink. While one is
+# being played, the next one is already being prepared.
+OUTPUT_BUFFERS = 2
+
+# How many samples do we read from the audio source at a time.
+CAPTURE_CHUNK = 1024
+
+# How many seconds of audio does the capture ring buffer hold when
+# demodulating in a separate process.
+CAPTURE_RING_SECONDS = 4
+
 ABSOLUTELY_MAX_MTU = 20 * 1024
 
 
@@ -65,113 +204,315 @@ logger_mo = logging.getLogger("audio-[mo]dem")
 logger_dem = logging.getLogger("audio-mo[dem]")
 
 
-class AudioModulator(threading.Thread):
-  def __init__(self, audio_sink, tun_outbound_path, the_end):
+class AudioWriter(threading.Thread):
+  # Streams waveforms synthesized by AudioModulator to the audio sink. As we
+  # never drain() in between, the sink plays them back-to-back while the
+  # modulator is already working on the next one.
+  # Waveforms are (frames, channels) arrays, i.e. already interleaved.
+  def __init__(self, audio_sink, sample_rate, the_end):
     super().__init__()
     self.audio_sink = audio_sink
+    self.sample_rate = sample_rate
+    self.the_end = the_end
+    self.buffers = queue.Queue(maxsize=OUTPUT_BUFFERS)
+
+    # When (roughly) will everything that was put so far be done playing?
+    self.busy_until = 0
+
+  def put(self, waveform):
+    # Note: This blocks while all the buffers are taken, i.e. while the sink
+    # is behind.
+    while not self.the_end.is_set():
+      try:
+        self.buffers.put(waveform, timeout=0.5)
+        break
+      except queue.Full:
+        continue
+    else:
+      return
+
+    duration = len(waveform) / self.sample_rate
+    self.busy_until = max(time.monotonic(), self.busy_until) + duration
+
+  def run(self):
+    logger_mo.info(f"Audio writer thread online")
+
+    while not self.the_end.is_set():
+      try:
+        waveform = self.buffers.get(timeout=0.5)
+      except queue.Empty:
+        continue
+
+      # Play it.
+      # Note: write() blocks once the sink's buffer is full.
+      self.audio_sink.write(waveform.tobytes())
+
+    logger_mo.info(f"Audio writer thread offline")
+
+
+class AudioModulator(threading.Thread):
+  def __init__(self, audio_sink, tun_outbound_path, the_end, profile,
+               channels=AUDIO_CHANNELS, fec_scheme=fec.SCHEMES[0],
+               compress_headers=False, arq_link=None):
+    super().__init__()
+    self.writer = AudioWriter(audio_sink, profile.sample_rate, the_end)
     self.tun_outbound_path = tun_outbound_path
     self.the_end = the_end
+    self.profile = profile
+    self.channels = channels
+    self.fec_scheme = fec_scheme
+    self.lead_profile = lead_profile(profile.sample_rate)
+    self.compressor = hdrcomp.HeaderCompressor() if compress_headers else None
+    self.arq = arq_link  # Shared with the demodulator, which gets the ACKs.
+
+    self.stats = metrics.LinkMetrics()
+    self.bursts = metrics.counter(
+        "ipow_audio_bursts_total", "Bursts (or calibration packets) sent"
+    )
+
+    # Packets from IPOW wait here, interactive ones go first. CoDel's target
+    # has to be at least the time it takes to send a full-sized packet.
+    target = max(
+        codel.TARGET, codel.MTU / (profile.bytes_per_second() * channels)
+    )
+    self.queue = lanes.LaneQueue(
+        target=target, interval=10 * target, logger=logger_mo
+    )
 
     self.tun_outbound = None
 
     self.t = 0  # Let's at least pretend we have some sinus continuity.
 
-    # Calculate the duration of a symbol in seconds.
-    self.t_step = SAMPLES_PER_SYMBOL / AUDIO_SAMPLES_PER_SECOND
-
     self.available_data = b""
     self.packet_sz = None
     self.packet = b""
 
-  def generate_waveform(self, symbol):
-    # This basically generates SAMPLES_PER_SYMBOL symbols which mix sin(freq)
+  def generate_waveform(self, symbol, profile):
+    # This basically generates samples_per_symbol symbols which mix sin(freq)
     # for each set bit of the symbol.
-    t_next = self.t + self.t_step
+    samples_per_symbol = profile.samples_per_symbol
 
-    t = np.linspace(self.t, t_next, SAMPLES_PER_SYMBOL, endpoint=False)
+    # Calculate the duration of a symbol in seconds.
+    t_next = self.t + samples_per_symbol / profile.sample_rate
+
+    t = np.linspace(self.t, t_next, samples_per_symbol, endpoint=False)
     self.t = t_next
 
     waveform = np.zeros_like(t)
-    for i, freq in enumerate(FREQUENCIES):
+    for i, freq in enumerate(profile.frequencies):
       if symbol & (1 << i):
         waveform += np.sin(2 * np.pi * freq * t)
 
     # Normalize the waveform and encode it as int16.
-    if (symbol & ((1 << len(FREQUENCIES)) - 1)) != 0:
+    if (symbol & ((1 << len(profile.frequencies)) - 1)) != 0:
       waveform /= np.max(np.abs(waveform))
 
-    waveform_i16 = np.int16(waveform * (0x7fff // 2))
+    waveform_i16 = np.int16(waveform * AUDIO_FULL_SCALE)
     return waveform_i16
 
-  def transmit(self, packet):
-    packet_sz = len(packet)
-    if packet_sz == 0:
+  def transmit(self, packets):
+    originals = [packet for packet in packets if packet]
+
+    if self.compressor:
+      packets = [self.compressor.compress(packet) for packet in packets]
+
+    if self.arq:
+      # Retransmissions (and a pure ACK, if one is due) go first.
+      packets = self.arq.poll() + [
+          self.arq.wrap(packet) for packet in packets if packet
+      ] or [b""]
+
+    burst_sz = sum(len(packet) for packet in packets)
+    if burst_sz == 0:
       logger_mo.debug(f"Transmitting empty (calibration) packet")
+    elif len(packets) == 1:
+      logger_mo.debug("Transmitting a packet of %d bytes", burst_sz)
     else:
-      logger_mo.info(f"Transmitting a packet of {packet_sz} bytes")
+      logger_mo.debug(
+          "Transmitting a burst of %d packets, %d bytes", len(packets), burst_sz
+      )
 
-    symbols = []
+    for packet in packets:
+      if packet:
+        self.stats.sent(packet)
+    self.bursts.inc()
+
+    waveform = self.modulate(packets)
+    for packet in originals:
+      tracing.mark("encoded", packet)
+
+    # Hand it over to the writer thread (this blocks if it's behind).
+    self.writer.put(waveform)
+    for packet in originals:
+      tracing.mark("sent", packet)
+
+  def modulate(self, packets):
+    # Returns the (frames, channels) waveform of a burst of the given packets.
+    # Each channel gets its own burst. Channels which got nothing to send
+    # stay silent.
+    t = self.t
+    t_end = t
+    waveforms = []
+    for channel_packets in self.split_burst(packets):
+      self.t = t
+      if channel_packets:
+        waveforms.append(self.modulate_burst(channel_packets))
+      else:
+        waveforms.append(np.zeros(0, dtype=np.int16))
+      t_end = max(t_end, self.t)
+    self.t = t_end
+
+    # Pad them to the same length and interleave.
+    frames = max(len(waveform) for waveform in waveforms)
+    waveform = np.zeros((frames, self.channels), dtype=np.int16)
+    for channel, channel_waveform in enumerate(waveforms):
+      waveform[:len(channel_waveform), channel] = channel_waveform
+
+    return waveform
+
+  def split_burst(self, packets):
+    # Spread the packets between the channels, i.e. each packet goes to the
+    # channel which has the least bytes to send so far. Note that this means
+    # packets might arrive in a different order than they were sent in.
+    if all(len(packet) == 0 for packet in packets):
+      # Calibration goes out on all channels.
+      return [packets] * self.channels
+
+    lanes = [[] for _ in range(self.channels)]
+    lane_sz = [0] * self.channels
+    for packet in packets:
+      channel = lane_sz.index(min(lane_sz))
+      lanes[channel].append(packet)
+      lane_sz[channel] += len(packet)
+
+    return lanes
+
+  def modulate_burst(self, packets):
+    # All the packets are sent as a single burst: the lead symbols are sent
+    # once, then each packet's size and payload symbols follow back-to-back,
+    # and a single end symbol finishes the whole burst.
+    lead_symbols = []
     for i in range(LEAD_SIZE):
       # Alternate between sending 0x55 and 0xAA with both control bits set.
       # The lead should both allow for carrier detection, as well as signal
       # calibration.
-      if i & 1:
-        symbols.append(0b1_01010101_1)
-      else:
-        symbols.append(0b1_10101010_1)
-
-    # Add size - little endian, 6 bits per symbol, using the following pattern:
-    #   0_01bbbbbb_0 - bits 0-5 of size (i.e. bottom 6 bits)
-    #   0_10bbbbbb_0 - bits 6-11 of size
-    # As such, the size is limited to 4095 bytes of payload.
-    symbols.append(0b0_01000000_0 | (((packet_sz >> 0) & 0x3f) << 1))
-    symbols.append(0b0_10000000_0 | (((packet_sz >> 6) & 0x3f) << 1))
-
-    # Add payload alternating control bits.
-    for i, b in enumerate(packet):
-      if i & 1:
-        symbols.append(0b0_00000000_1 | (b << 1))
-      else:
-        symbols.append(0b1_00000000_0 | (b << 1))
+      lead_symbols.append(LEAD_SYMBOLS[i & 1])
+
+    # Let the other side know which profile and FEC scheme the rest of the
+    # burst uses (unless it's the same as the lead's, without FEC).
+    profile = self.profile
+    fec_scheme = self.fec_scheme
+    if not profile.same_plan(self.lead_profile) or fec_scheme.scheme_id != 0:
+      lead_symbols.append(
+          HEADER | (fec_scheme.scheme_id << 5) | (profile.profile_id << 1)
+      )
 
-    # Finish up with 0xff with both control bits off.
-    symbols.append(0b0_11111111_0)
+    symbols = []
+    for packet in packets:
+      packet_sz = len(packet)
+
+      # Add size - little endian, 6 bits per symbol, using the following
+      # pattern (extra data bits of wider profiles are zero):
+      #   0_01bbbbbb_0 - bits 0-5 of size (i.e. bottom 6 bits)
+      #   0_10bbbbbb_0 - bits 6-11 of size
+      # As such, the size is limited to 4095 bytes of payload. Note that this
+      # is the size before FEC encoding.
+      symbols.append(profile.size_lo | (((packet_sz >> 0) & 0x3f) << 1))
+      symbols.append(profile.size_hi | (((packet_sz >> 6) & 0x3f) << 1))
+
+      packet = fec_scheme.encode(packet)
+
+      # Add payload alternating control bits. Each symbol carries
+      # bytes_per_symbol bytes (little endian), the last one is zero-padded.
+      step = profile.bytes_per_symbol
+      for i in range(0, len(packet), step):
+        data = int.from_bytes(packet[i:i + step], "little")
+        if (i // step) & 1:
+          symbols.append(profile.ctrl_lo | (data << 1))
+        else:
+          symbols.append(profile.ctrl_hi | (data << 1))
+
+    # Finish up with all data bits set and both control bits off.
+    symbols.append(profile.end)
 
     # Convert symbols to waveforms and send it.
-    waveforms = [self.generate_waveform(s) for s in symbols]
-    waveform = np.concatenate(waveforms)
+    waveforms = [self.generate_waveform(s, self.lead_profile)
+                 for s in lead_symbols]
+    waveforms.extend(self.generate_waveform(s, profile) for s in symbols)
+    return np.concatenate(waveforms)
+
+  def receive_packets(self):
+    # Moves whatever is waiting in IPOW's outbound socket into the queue
+    # (without blocking). Returns False if IPOW went away.
+    while True:
+      try:
+        packet = self.tun_outbound.recv(ABSOLUTELY_MAX_MTU, socket.MSG_DONTWAIT)
+      except BlockingIOError:
+        return True
 
-    # Check just in case if we shouldn't end before we start blocking.
-    if self.the_end.is_set():
-      return
+      if not packet:
+        logger_mo.error(f"Something went wrong with getting data from IPOW")
+        return False
+
+      tracing.mark("ipow_in", packet)
+      self.queue.put(packet)
+
+  def collect_burst(self):
+    # Takes as much from the queue as fits in a burst (see lanes.py for the
+    # order).
+    packets = []
+    burst_sz = 0
 
-    # Play it.
-    # Note: Either write() or drain() will be blocking.
-    self.audio_sink.write(waveform.tobytes())
-    self.audio_sink.drain()
+    # Each channel carries its own burst.
+    max_packets = BURST_MAX_PACKETS * self.channels
+    max_bytes = BURST_MAX_BYTES * self.channels
+
+    while len(packets) < max_packets and burst_sz < max_bytes:
+      try:
+        packet = self.queue.get_nowait()
+      except queue.Empty:
+        break
+
+      tracing.mark("dequeued", packet)
+      packets.append(packet)
+      burst_sz += len(packet)
+
+    return packets
 
   def worker(self):
     while not self.the_end.is_set():
-      rlist, wlist, xlist = select.select([self.tun_outbound], [], [], 0.5)
-      if not rlist and not wlist and not xlist:
-        # Nothing to send, but still send an empty packet to help the other
-        # side calibrate if they just connected.
-        self.transmit(b'')
-        continue
+      if self.queue.empty():
+        # Only wake up for calibration if the link has been silent long
+        # enough.
+        silent_for = time.monotonic() - self.writer.busy_until
+        timeout = max(0, CALIBRATION_INTERVAL - silent_for)
+      else:
+        timeout = 0
+
+      arq_timeout = self.arq.next_timeout() if self.arq else None
+      if arq_timeout is not None:
+        timeout = min(timeout, arq_timeout)
+
+      rlist, wlist, xlist = select.select([self.tun_outbound], [], [], timeout)
 
       if xlist:
         logger_mo.error(f"Disconnected from IPOW's outbound pipe")
         return
 
-      packet, _ = self.tun_outbound.recvfrom(ABSOLUTELY_MAX_MTU)
-      if not packet:
-        logger_mo.error(f"Something went wrong with getting data from IPOW")
+      if rlist and not self.receive_packets():
         return
 
-      self.transmit(packet)
+      packets = self.collect_burst()
+      if packets or (self.arq and self.arq.next_timeout() == 0):
+        self.transmit(packets)
+      elif not rlist:
+        # Nothing to send, but still send an empty packet to help the other
+        # side calibrate if they just connected.
+        self.transmit([b''])
 
   def run(self):
     logger_mo.info(f"Audio modulator (sender) thread online")
+    self.writer.start()
 
     while not self.the_end.is_set():
       with tempfile.TemporaryDirectory() as d:
@@ -194,68 +535,152 @@ class AudioModulator(threading.Thread):
 
     logger_mo.info(f"Audio modulator (sender) thread offline")
     self.the_end.set()  # If I exit, everyone exits.
+    self.writer.join()
 
 
-class AudioDemodulator(threading.Thread):
-  def __init__(self, tun_inbound_path, audio_source, the_end):
-    super().__init__()
-    self.audio_source = audio_source
-    self.tun_inbound_path = tun_inbound_path
-    self.the_end = the_end
+class Demodulator:
+  # Turns audio samples into packets. This doesn't do any I/O by itself, so
+  # that it can be run either by AudioDemodulator's thread directly, or in a
+  # separate process (see demodulator_process).
+  def __init__(self, sample_rate):
+    self.sample_rate = sample_rate
+    self.lead_profile = lead_profile(sample_rate)
+    self.profile = self.lead_profile  # Profile of the burst being received.
+    self.fec_scheme = fec.SCHEMES[0]  # FEC scheme of the burst being received.
+
     self.state = "NOT_CALIBRATED"
-    self.unprocessed_audio_data = []
+    self.unprocessed_audio_data = np.zeros(0, dtype=np.int16)
+    self.packets = []
 
     self.amp_max = -100000
     self.amp_min =  100000
     self.amp_zero = 0
     self.amp_silence = 100000
+    self.amp_gain = 1.0  # Signal amplitude relative to what we send.
+
+    # Minimum/maximum amplitude of each recently processed chunk of audio, as
+    # (sample count, min, max). See track_amplitude.
+    self.amp_history = collections.deque()
+    self.amp_history_sz = 0
+    # Same for the noise floor, as (sample count, max - min).
+    self.noise_history = collections.deque()
+    self.noise_history_sz = 0
 
     self.packet_sz = None
-    self.samples_to_fetch = 1024
+    self.samples_to_fetch = CAPTURE_CHUNK
+
+  def discard(self):
+    # Forget all the unprocessed data, e.g. because some samples were lost.
+    self.unprocessed_audio_data = self.unprocessed_audio_data[:0]
+    if self.state == "RECV_BURST":
+      self.end_burst()
 
-  def send_packet(self, s, payload):
-    s.sendto(payload, self.tun_inbound_path)
+  def end_burst(self):
+    self.profile = self.lead_profile
+    self.fec_scheme = fec.SCHEMES[0]
+    self.state = "RECV_FIRST"
 
-  def get_frequency_magnituted(self, chunk):
+  def get_frequency_magnituted(self, chunk, profile):
     fft_result = fft.fft(chunk)
     fft_magnitude = np.abs(fft_result)[:len(chunk) // 2]
-    return [fft_magnitude[idx] for idx in FREQ_INDEXES]
+    return [fft_magnitude[idx] for idx in profile.freq_indexes]
 
-  def symbol_to_str(self, s):
-    return f"{(s >> 9) & 1}_{(s >> 1) & 0xff:02x}_{s & 1}"
+  def audio_to_symbols(self, data, profile, aligned=False):
+    # If aligned is set, the data is known to start exactly where a symbol
+    # should be sampled (e.g. in the middle of a burst), so there's no need to
+    # look for the right offset.
+    samples_per_symbol = profile.samples_per_symbol
+    fft_sample_count = profile.fft_sample_count
 
-  def audio_to_symbols(self, data):
-    if len(data) < 512:  # We need some data to work with.
+    if len(data) < 2 * samples_per_symbol:  # We need some data to work with.
       return [], 0
 
-    # Use the first 256 bytes of data to get the right offset.
     best_idx = 0
-    best_diff = 0
-    for i in range(256 - 64):
-      freqs = self.get_frequency_magnituted(data[i:i+64])
-      diff = max(freqs) - min(freqs)
-
-      if diff > best_diff:
-        best_diff = diff
-        best_idx = i
-
-    # Sanity check – is this signal strong enough?
-    best_diff = int(best_diff)
-    if best_diff < 50000:
-      # Not really...
-      logger_dem.warning(f"FM signal too weak, best_diff={best_diff}")
-      return [], 256
+    if not aligned:
+      # Find the right offset in the first symbol's worth of data. For each
+      # candidate offset we check how "clean" a few symbols in a row look, i.e.
+      # whether each frequency is clearly on or clearly off. A window which
+      # straddles two symbols has some frequencies half-way, and just looking
+      # for the strongest window would happily pick one when we don't start in
+      # silence (e.g. when bursts are played back-to-back).
+      samples = np.asarray(
+          data[:samples_per_symbol * 4 + fft_sample_count], dtype=np.float64
+      )
+      offsets = np.arange(samples_per_symbol)
+      symbol_count = min(
+          4,
+          (len(samples) - fft_sample_count - offsets[-1]) // samples_per_symbol
+          + 1
+      )
+      starts = (offsets[:, None] +
+                np.arange(symbol_count)[None, :] * samples_per_symbol)
 
-    logger_dem.debug(
-        f"FM signal best_diff={best_diff}, best_idx={best_idx}"
-    )
+      windows = np.lib.stride_tricks.sliding_window_view(
+          samples, fft_sample_count
+      )
+      mags = np.abs(fft.rfft(windows[starts], axis=-1))
+      mags = mags[..., profile.freq_indexes]
+      mag_min = mags.min(axis=-1, keepdims=True)
+      mag_max = mags.max(axis=-1, keepdims=True)
+      mag_diff = np.maximum(mag_max - mag_min, 1)
+      ambiguity = (
+          np.minimum(mags - mag_min, mag_max - mags) / mag_diff
+      ).max(axis=-1)
+      # Silence isn't clean at all.
+      ambiguity[mag_diff[..., 0] < self.weak_signal(profile)] = 1
+      ambiguity = ambiguity.sum(axis=-1)
+
+      # That said, a window straddling two lead symbols has all the
+      # frequencies at about the same level (0xAA + 0x55), which can look
+      # cleaner than the real thing on an actual cable. So if there are any
+      # leads here, the offsets which read the most of them win instead.
+      bits = mags > (mag_min + (mag_max - mag_min) / 5)
+      decoded = (bits << np.arange(bits.shape[-1])).sum(axis=-1)
+      leads = np.isin(decoded, LEAD_SYMBOLS).sum(axis=-1)
+
+      # Pick the middle of the longest run of (almost) equally clean offsets,
+      # i.e. sample the symbols in their middle. Later we rely on this to know
+      # where the symbols start. Note that the run can wrap around, since the
+      # offsets cover a whole symbol.
+      if leads.max() > 0:
+        clean = leads == leads.max()
+      else:
+        clean = ambiguity <= ambiguity.min() + 0.05 * symbol_count
+      clean = np.concatenate((clean, clean))
+      run_start, run_len = 0, 0
+      i = 0
+      while i < samples_per_symbol:
+        if not clean[i]:
+          i += 1
+          continue
+        j = i
+        while j < i + samples_per_symbol and clean[j]:
+          j += 1
+        if j - i > run_len:
+          run_start, run_len = i, j - i
+        i = j
+
+      best_idx = (run_start + run_len // 2) % samples_per_symbol
+      best_diff = int(mag_diff[best_idx, 0, 0])
+
+      # Sanity check – is this signal strong enough?
+      if best_diff < self.weak_signal(profile):
+        # Not really...
+        logger_dem.warning(f"FM signal too weak, best_diff={best_diff}")
+        return [], samples_per_symbol
+
+      logger_dem.debug(
+          f"FM signal best_diff={best_diff}, best_idx={best_idx}"
+      )
 
     # Read all the symbols until an end symbol.
     symbols = []
     idx = best_idx
-    while idx < len(data) - 63:
+    while idx < len(data) - fft_sample_count + 1:
 
-      freqs = self.get_frequency_magnituted(data[idx:idx+64])
+      freqs = self.get_frequency_magnituted(
+          data[idx:idx + fft_sample_count], profile
+      )
 
       # We are relying here on there always being a zero sent.
       mag_min = min(freqs)
@@ -268,231 +693,652 @@ class AudioDemodulator(threading.Thread):
         if f > mid:
           s |= 1 << i
 
-      # print(self.symbol_to_str(s), freqs)
+      # print(profile.symbol_to_str(s), freqs)
 
-      idx += SAMPLES_PER_SYMBOL
+      idx += samples_per_symbol
 
       symbols.append(s)
 
-      if s == 0b0_11111111_0:  # Break on end symbol.
+      if s == profile.end:  # Break on end symbol.
         break
 
     logger_dem.debug(
         f"Received symbols "
-        f"{' '.join([self.symbol_to_str(s) for s in symbols])}"
+        f"{' '.join([profile.symbol_to_str(s) for s in symbols])}"
     )
 
     return symbols, idx
 
-  def worker(self, s_unix):
-    while not self.the_end.is_set():
-      audio_data = self.audio_source.read(2 * self.samples_to_fetch)
-      audio_data = unpack(f"<{len(audio_data)//2}h", audio_data)
-      self.samples_to_fetch = 1024
+  def track_amplitude(self, *audio_data):
+    # A simple AGC: the amplitude range is the min/max over the last
+    # AGC_WINDOW seconds of audio. This way we lock on the very first chunk
+    # which has a signal in it, and follow any changes (e.g. after somebody
+    # touched the cable or the volume) within AGC_WINDOW.
+    for samples in audio_data:
+      if len(samples) == 0:
+        continue
+      self.amp_history.append(
+          (len(samples), int(samples.min()), int(samples.max()))
+      )
+      self.amp_history_sz += len(samples)
+      self.noise_history.append(
+          (len(samples), self.amp_history[-1][2] - self.amp_history[-1][1])
+      )
+      self.noise_history_sz += len(samples)
 
-      self.unprocessed_audio_data.extend(audio_data)
+    if not self.amp_history:
+      return
 
-      if self.state == "NOT_CALIBRATED":
-        # Wait for at least 2 seconds worth of data.
-        if len(self.unprocessed_audio_data) < AUDIO_SAMPLES_PER_SECOND * 2:
-          continue
+    window = int(AGC_WINDOW * self.sample_rate)
+    while self.amp_history_sz - self.amp_history[0][0] >= window:
+      self.amp_history_sz -= self.amp_history.popleft()[0]
 
-        # Figure out maximum/minimum amplitude.
-        self.amp_max = max(self.unprocessed_audio_data)
-        self.amp_min = min(self.unprocessed_audio_data)
+    noise_window = int(AGC_NOISE_WINDOW * self.sample_rate)
+    noise_floor = 0
+    if self.noise_history_sz >= noise_window:
+      while self.noise_history_sz - self.noise_history[0][0] >= noise_window:
+        self.noise_history_sz -= self.noise_history.popleft()[0]
+      noise_floor = min(chunk[1] for chunk in self.noise_history)
 
-        amp_diff = self.amp_max - self.amp_min
+    amp_min = min(chunk[1] for chunk in self.amp_history)
+    amp_max = max(chunk[2] for chunk in self.amp_history)
+    amp_diff = amp_max - amp_min
 
-        if amp_diff < 5000:
-          logger_dem.warning(
-              f"Failed to calibrate, signal to weak "
-              f"({100*amp_diff/0x10000:.2f}%)."
-          )
-          self.unprocessed_audio_data = []
-          continue
+    if amp_diff < max(AGC_MIN_SIGNAL, AGC_MIN_SNR * noise_floor):
+      # Just noise (or nothing) lately. Keep whatever we had.
+      return
 
-        self.amp_zero = (self.amp_max + self.amp_min) // 2
-        self.amp_silence = int(self.amp_zero + (amp_diff / 2) / 10)
+    self.amp_max = amp_max
+    self.amp_min = amp_min
+    self.amp_zero = (amp_max + amp_min) // 2
+    self.amp_silence = int(self.amp_zero + (amp_diff / 2) / 10)
+    self.amp_gain = (amp_diff / 2) / AUDIO_FULL_SCALE
+
+  def weak_signal(self, profile):
+    # The FFT magnitudes scale with the amplitude, so does the threshold.
+    return profile.weak_signal * self.amp_gain
+
+  def process(self, *audio_data):
+    # Adds the given samples (one or more arrays) to the unprocessed data and
+    # processes it. Returns the payloads of all the packets received.
+    self.samples_to_fetch = CAPTURE_CHUNK
+    self.track_amplitude(*audio_data)
+    self.unprocessed_audio_data = np.concatenate(
+        (self.unprocessed_audio_data, *audio_data)
+    )
 
-        logger_dem.info(
-            f"Calibrated: "
-            f"diff={100*amp_diff/0x10000:.2f}% "
-            f"zero(i16)={self.amp_zero} "
-            f"silence(i16)={self.amp_silence} "
-        )
+    self.step()
 
-        # Discard all the unprocessed data.
-        self.unprocessed_audio_data = []
-        self.state = "RECV_FIRST"
-        continue
+    packets = self.packets
+    self.packets = []
+    return packets
 
-      if self.state == "RECV_FIRST":
-        # Find first data which is not silence.
-        i = 0
-        unprocessed = self.unprocessed_audio_data
-        silence = self.amp_silence
-        while i < len(unprocessed):
-          if unprocessed[i] > self.amp_silence:
-            break
-          i += 1
+  def step(self):
+    if self.state == "NOT_CALIBRATED":
+      # Wait for the AGC to see any signal (see track_amplitude).
+      if self.amp_max < self.amp_min:
+        # Nothing yet. Keep a lead's worth of data though, since the signal
+        # might have just started.
+        keep = LEAD_SIZE * self.lead_profile.samples_per_symbol + 32
+        self.unprocessed_audio_data = self.unprocessed_audio_data[-keep:]
+        return
 
-        # Was there anything found?
-        if i == len(unprocessed):
-          # Only silence. Leave a few samples, discard the rest.
-          self.unprocessed_audio_data = self.unprocessed_audio_data[-32:]
-          continue
+      amp_diff = self.amp_max - self.amp_min
+      logger_dem.info(
+          f"Calibrated: "
+          f"diff={100*amp_diff/0x10000:.2f}% "
+          f"zero(i16)={self.amp_zero} "
+          f"silence(i16)={self.amp_silence} "
+      )
 
-        i = max(0, i - 32)  # Leave a few samples.
-        if i != 0:
-          self.unprocessed_audio_data = self.unprocessed_audio_data[i:]
+      # Go straight to looking for the lead in the data we already have.
+      self.state = "RECV_FIRST"
 
-        # Do we have enough data to get at least an empty packet?
-        if (len(self.unprocessed_audio_data) <
-            (LEAD_SIZE + 2 + 1) * SAMPLES_PER_SYMBOL + 64):
-          # Read a bit more to make it easy on ourselves.
-          continue
+    if self.state == "RECV_FIRST":
+      lead = self.lead_profile
+
+      # Find first data which is not silence.
+      unprocessed = self.unprocessed_audio_data
+      not_silence = np.flatnonzero(unprocessed > self.amp_silence)
+
+      # Was there anything found?
+      if len(not_silence) == 0:
+        # Only silence. Leave a few samples, discard the rest.
+        self.unprocessed_audio_data = self.unprocessed_audio_data[-32:]
+        return
 
-        # Attempt to read size.
-        symbols, last_i = self.audio_to_symbols(self.unprocessed_audio_data)
+      i = max(0, not_silence[0] - 32)  # Leave a few samples.
+      if i != 0:
+        self.unprocessed_audio_data = self.unprocessed_audio_data[i:]
 
-        # Check if we can find any lead symbol in symbols.
-        idx = None
+      # Do we have enough data to get at least an empty packet?
+      if (len(self.unprocessed_audio_data) <
+          (LEAD_SIZE + 2 + 1) * lead.samples_per_symbol +
+          lead.fft_sample_count):
+        # Read a bit more to make it easy on ourselves.
+        return
+
+      # Attempt to read size.
+      symbols, last_i = self.audio_to_symbols(self.unprocessed_audio_data, lead)
+
+      if not symbols:
+        # Too weak to be a lead yet. Skip just that bit, since a whole burst
+        # might be right behind it.
+        self.unprocessed_audio_data = self.unprocessed_audio_data[last_i:]
+        return
+
+      # Check if we can find any lead symbol in symbols.
+      idx = None
+      try:
+        idx = symbols.index(LEAD_SYMBOLS[0])
+      except ValueError:
+        pass
+
+      if idx is None:
         try:
-          idx = symbols.index(0b1_10101010_1)
+          idx = symbols.index(LEAD_SYMBOLS[1])
         except ValueError:
           pass
 
-        if idx is None:
-          try:
-            idx = symbols.index(0b1_01010101_1)
-          except ValueError:
-            pass
+      if idx is None:
+        # No lead symbol at all. Discard the data, but only as much as we
+        # have looked at – e.g. the tail of an end symbol might be followed
+        # by the lead of the next burst.
+        logger_dem.debug(f"Mising leads, skipping data")
+        last_i = min(last_i, len(self.unprocessed_audio_data) - 32)
+        self.unprocessed_audio_data = self.unprocessed_audio_data[last_i:]
+        return
+
+      # Check if we can get the size (or the header).
+      while idx < len(symbols):
+        s = symbols[idx]
 
-        if idx is None:
-          # No lead symbol at all. Discard the data.
-          logger_dem.debug(f"Mising leads, skipping data")
-          self.unprocessed_audio_data = self.unprocessed_audio_data[-32:]
+        if s in LEAD_SYMBOLS:
+          idx += 1  # Continue to skip lead.
           continue
 
-        # Check if we can get the size.
-        while idx < len(symbols):
-          s = symbols[idx]
+        if (s & HEADER_MASK) == HEADER:
+          # Found the header, i.e. the rest uses some other profile.
+          break
 
-          if s in { 0b1_10101010_1, 0b1_01010101_1 }:
-            idx += 1  # Continue to skip lead.
-            continue
+        if (s & lead.size_mask) == lead.size_lo:
+          # Found first symbol with size!
+          break
 
-          if (s & 0b1_11000000_1) == 0b0_01000000_0:
-            # Found first symbol with size!
-            break
+        # Unknown symbol, size was expected. Discard the data.
+        idx = -1
+        break
 
-          # Unknown symbol, size was expected. Discard the data.
-          idx = -1
-          break
+      if idx == -1:
+        # Some weird data found, discard it.
+        logger_dem.warning(f"Weird data found after leads")
+        self.unprocessed_audio_data = self.unprocessed_audio_data[-32:]
+        return
 
-        if idx == -1:
-          # Some weird data found, discard it.
-          logger_dem.warning(f"Weird data found after leads")
-          self.unprocessed_audio_data = self.unprocessed_audio_data[-32:]
-          continue
+      if idx == len(symbols):
+        # It's apparently leads all the way, but then we run out of data.
+        # Save the last symbol worth of data, but discard the rest.
+        logger_dem.debug(f"Leads only, wait for more data")
+        self.unprocessed_audio_data = (
+            self.unprocessed_audio_data[-(32 + lead.samples_per_symbol):]
+        )
+        return
 
-        if idx == len(symbols):
-          # It's apparently leads all the way, but then we run out of data.
-          # Save the last symbol worth of data, but discard the rest.
-          logger_dem.debug(f"Leads only, wait for more data")
-          self.unprocessed_audio_data = (
-              self.unprocessed_audio_data[-(32 + SAMPLES_PER_SYMBOL):]
-          )
-          continue
+      if (s & HEADER_MASK) == HEADER:
+        self.receive_header(s, len(symbols) - idx, last_i)
+        return
 
-        # We found the first symbol with size. But is there a next symbol?
-        if idx + 1 >= len(symbols):
-          # Nah, we don't have enough data. Discard everything apart from
-          # last two symbol worth of data and wait for more data.
-          logger_dem.debug(f"Waiting for second size symbol")
-          self.unprocessed_audio_data = (
-              self.unprocessed_audio_data[-(32 + SAMPLES_PER_SYMBOL * 2):]
-          )
-          continue
+      self.receive_burst(symbols, idx, last_i)
+      return
 
-        # Verify that the second symbol of size makes sense.
-        s2 = symbols[idx + 1]
-        if (s2 & 0b1_11000000_1) != 0b0_10000000_0:
-          # Corrupted data, discard.
-          logger_dem.warning(f"Incorrect second size symbol")
-          self.unprocessed_audio_data = self.unprocessed_audio_data[-32:]
-          continue
+    if self.state == "RECV_BURST":
+      # We're in the middle of a burst, i.e. the data starts with either the
+      # size symbols of the next packet, or with the end symbol.
+      profile = self.profile
+      symbols, last_i = self.audio_to_symbols(
+          self.unprocessed_audio_data, profile, aligned=True
+      )
 
-        self.packet_sz = ((s >> 1) & 0x3f) | (((s2 >> 1) & 0x3f) << 6)
+      if not symbols:
+        return  # Not enough data yet.
 
-        # Do we have the full packet?
-        what_we_have = len(symbols) - idx - 2 - 1
-        if what_we_have < self.packet_sz:
-          logger_dem.info(f"Waiting for full packet")
-          # Nope, we need more data.
-          # NOTE: We should discard some data here, but whatever.
-          samples_were_missing = self.packet_sz - what_we_have
-          self.samples_to_fetch = SAMPLES_PER_SYMBOL * samples_were_missing + 32
-          continue
+      s = symbols[0]
+      if s == profile.end:
+        # That's the end of the burst.
+        self.unprocessed_audio_data = self.unprocessed_audio_data[last_i:]
+        self.end_burst()
+        return
 
-        idx += 2
+      if (s & profile.size_mask) != profile.size_lo:
+        # Corrupted data, discard.
+        logger_dem.warning(f"Incorrect first size symbol in a burst")
+        self.unprocessed_audio_data = self.unprocessed_audio_data[-32:]
+        self.end_burst()
+        return
 
-        # We have a full packet! Decode it.
-        all_good = True
-        payload = bytearray(self.packet_sz)
-        for i in range(self.packet_sz):
-          s = symbols[idx + i]
+      self.receive_burst(symbols, 0, last_i)
+      return
 
-          if i & 1:
-            control_bit = 0b0_00000000_1
-          else:
-            control_bit = 0b1_00000000_0
+  def receive_header(self, s, symbols_left, last_i):
+    # The header symbol (symbols_left symbols from the end of what was
+    # decoded) tells us the profile and FEC scheme of the rest of the burst.
+    profile_id = (s >> 1) & 0xf
+    scheme_id = (s >> 5) & 0x3
+    if (profile_id >= len(PROFILES) or
+        PROFILES[profile_id].sample_rate != self.sample_rate):
+      logger_dem.warning(
+          f"Can't receive a burst with profile {profile_id} at "
+          f"{self.sample_rate} Hz"
+      )
+      self.unprocessed_audio_data = self.unprocessed_audio_data[-32:]
+      return
+
+    # Since we sample symbols in their middle, we know where the header symbol
+    # starts, so we know where to sample the first symbol of the profile.
+    lead = self.lead_profile
+    profile = PROFILES[profile_id]
+    header_start = (
+        last_i - symbols_left * lead.samples_per_symbol - lead.window_offset
+    )
+    start = header_start + lead.samples_per_symbol + profile.window_offset
+
+    if start >= len(self.unprocessed_audio_data):
+      logger_dem.debug(f"Waiting for data after the header")
+      return
+
+    logger_dem.debug(
+        f"Receiving a burst with profile {profile.name}, "
+        f"FEC {fec.SCHEMES[scheme_id].name}"
+    )
+    self.unprocessed_audio_data = self.unprocessed_audio_data[start:]
+    self.profile = profile
+    self.fec_scheme = fec.SCHEMES[scheme_id]
+    self.state = "RECV_BURST"
+
+  def receive_burst(self, symbols, idx, last_i):
+    # Decodes packets of a burst starting with the first size symbol at idx and
+    # adds them to the received packets. Once we run out of symbols in the
+    # middle of a burst, the audio data is trimmed to the start of the packet
+    # we're missing and we switch to RECV_BURST to wait for the rest.
+    profile = self.profile
+    fec_scheme = self.fec_scheme
+    samples_per_symbol = profile.samples_per_symbol
+    step = profile.bytes_per_symbol
+
+    while True:
+      # Where (in samples) is the first symbol of the packet sampled?
+      packet_start = last_i - (len(symbols) - idx) * samples_per_symbol
+
+      # We found the first symbol with size. But is there a next symbol?
+      if idx + 1 >= len(symbols):
+        if self.waited_too_long(packet_start, 2):
+          self.drop_burst(packet_start + samples_per_symbol)
+          return
+        # Nah, we don't have enough data. Discard everything before this
+        # packet and wait for more data.
+        logger_dem.debug(f"Waiting for second size symbol")
+        self.unprocessed_audio_data = (
+            self.unprocessed_audio_data[packet_start:]
+        )
+        self.state = "RECV_BURST"
+        return
+
+      # Verify that the second symbol of size makes sense.
+      s = symbols[idx]
+      s2 = symbols[idx + 1]
+      if (s2 & profile.size_mask) != profile.size_hi:
+        # Corrupted data, discard.
+        logger_dem.warning(f"Incorrect second size symbol")
+        self.unprocessed_audio_data = self.unprocessed_audio_data[-32:]
+        self.end_burst()
+        return
+
+      self.packet_sz = ((s >> 1) & 0x3f) | (((s2 >> 1) & 0x3f) << 6)
+      encoded_sz = fec_scheme.encoded_size(self.packet_sz)
+      payload_symbols = (encoded_sz + step - 1) // step
+
+      # Do we have the full packet, including the symbol that follows it?
+      what_we_have = len(symbols) - idx - 2 - 1
+      if what_we_have < payload_symbols:
+        # More data only helps if what we have so far could be the start of
+        # the payload. audio_to_symbols() stops at an end symbol, so with one
+        # in there we'd be waiting forever.
+        broken = self.broken_payload(symbols[idx + 2:], fec_scheme)
+        if broken is not None:
+          logger_dem.warning(f"Packet cut short at payload symbol {broken}")
+          self.drop_burst(packet_start + (2 + broken) * samples_per_symbol)
+          return
+        if self.waited_too_long(packet_start, 2 + payload_symbols + 1):
+          self.drop_burst(packet_start + samples_per_symbol)
+          return
+
+        logger_dem.debug(f"Waiting for full packet")
+        # Nope, we need more data.
+        samples_were_missing = payload_symbols - what_we_have
+        self.samples_to_fetch = samples_per_symbol * samples_were_missing + 32
+        self.unprocessed_audio_data = (
+            self.unprocessed_audio_data[packet_start:]
+        )
+        self.state = "RECV_BURST"
+        return
 
-          if (s & 0b1_00000000_1) != control_bit:
+      idx += 2
+
+      # We have a full packet! Decode it.
+      payload = bytearray(payload_symbols * step)
+      for i in range(payload_symbols):
+        s = symbols[idx + i]
+
+        if i & 1:
+          control_bit = profile.ctrl_lo
+        else:
+          control_bit = profile.ctrl_hi
+
+        if (s & profile.ctrl_mask) != control_bit:
+          if fec_scheme.parity:
+            # The symbol was misread, but the data bits might still be fine
+            # (or fixable by RS).
+            logger_dem.debug(f"Wrong payload control bit {i}, relying on FEC")
+          else:
             # Corrupted data, discard.
             logger_dem.warning(f"Wrong payload control bit {i}")
             self.unprocessed_audio_data = self.unprocessed_audio_data[-32:]
-            all_good = False
-            break
-
-          payload[i] = (s >> 1) & 0xff
-
-        if not all_good:
-          continue
+            self.end_burst()
+            return
+
+        data = (s >> 1) & ((1 << profile.data_bits) - 1)
+        payload[i * step:(i + 1) * step] = data.to_bytes(step, "little")
+
+      del payload[encoded_sz:]  # Remove padding.
+      idx += payload_symbols
+
+      # The packet is followed either by the end symbol, or by the first size
+      # symbol of the next packet in the burst.
+      s = symbols[idx]
+      burst_continues = (s & profile.size_mask) == profile.size_lo
+      if s != profile.end and not burst_continues:
+        # Corrupted data, discard.
+        logger_dem.warning(f"Wrong end symbol")
+        self.unprocessed_audio_data = self.unprocessed_audio_data[-32:]
+        self.end_burst()
+        return
 
-        # Check if the last symbol is the end symbol.
-        s = symbols[idx + self.packet_sz]
-        if s != 0b0_11111111_0:
-          # Corrupted data, discard.
-          logger_dem.warning(f"Wrong end symbol")
-          self.unprocessed_audio_data = self.unprocessed_audio_data[-32:]
-          continue
+      # Check (and fix) the payload.
+      payload, corrected = fec_scheme.decode(bytes(payload), self.packet_sz)
 
+      if payload is None:
+        # Only this packet is lost - the framing is still fine, so the rest of
+        # the burst can still be received.
+        logger_dem.warning(f"FEC/CRC check failed, dropping packet")
+      elif len(payload) > 0:
         # All good, we have the payload.
-        if len(payload) > 0:
-          logger_dem.info(f"Forwarding {self.packet_sz} bytes of data")
-          self.send_packet(s_unix, payload)
-        else:
-          logger_dem.debug(f"Calibration 'ping' received")
+        if corrected:
+          logger_dem.debug("FEC corrected %d bytes", corrected)
+        logger_dem.debug("Forwarding %d bytes of data", self.packet_sz)
+        self.packets.append(bytes(payload))
+      else:
+        logger_dem.debug(f"Calibration 'ping' received")
 
+      if not burst_continues:
         # Remove all received data.
         self.unprocessed_audio_data = self.unprocessed_audio_data[last_i:]
+        self.end_burst()
+        return
+
+  def broken_payload(self, symbols, fec_scheme):
+    # Index of the first of these (payload) symbols which can't be one: an end
+    # symbol, a lead (of the next burst), or, without FEC to fix it, a wrong
+    # control bit. None if they all look fine.
+    profile = self.profile
+    for i, s in enumerate(symbols):
+      if s == profile.end:
+        return i
+      if profile is self.lead_profile and s in LEAD_SYMBOLS:
+        return i
+      control_bit = profile.ctrl_lo if i & 1 else profile.ctrl_hi
+      if (s & profile.ctrl_mask) != control_bit and not fec_scheme.parity:
+        return i
+    return None
+
+  def waited_too_long(self, packet_start, packet_symbols):
+    # Whether there's already more audio (by BURST_WAIT_SLACK symbols) than a
+    # packet of packet_symbols symbols starting at packet_start takes.
+    profile = self.profile
+    enough = (
+        (packet_symbols + BURST_WAIT_SLACK) * profile.samples_per_symbol +
+        profile.fft_sample_count
+    )
+    if len(self.unprocessed_audio_data) - packet_start < enough:
+      return False
+    logger_dem.warning(f"Packet still incomplete, giving up on the burst")
+    return True
+
+  def drop_burst(self, keep_from):
+    # Drops the rest of the burst, keeping the audio from keep_from on (which
+    # might be the start of the next one).
+    keep_from = max(0, keep_from - self.profile.samples_per_symbol)
+    self.unprocessed_audio_data = self.unprocessed_audio_data[keep_from:]
+    self.end_burst()
+
+
+class SharedAudioRing:
+  # A single-producer, single-consumer ring buffer of int16 samples living in
+  # shared memory. The first 8 bytes are the number of samples written so far
+  # (i.e. the write position), the samples follow.
+  def __init__(self, capacity, name=None):
+    self.owner = name is None
+    if self.owner:
+      self.shm = shared_memory.SharedMemory(create=True, size=8 + capacity * 2)
+    else:
+      self.shm = shared_memory.SharedMemory(name=name)
+
+    self.name = self.shm.name
+    self.capacity = capacity
+    self.write_pos = np.ndarray((1,), dtype=np.uint64, buffer=self.shm.buf)
+    self.samples = np.ndarray(
+        (capacity,), dtype=np.int16, buffer=self.shm.buf, offset=8
+    )
+
+    if self.owner:
+      self.write_pos[0] = 0
+
+  def written(self):
+    return int(self.write_pos[0])
+
+  def write(self, samples):
+    pos = self.written()
+    start = pos % self.capacity
+    n = min(len(samples), self.capacity - start)
+    self.samples[start:start + n] = samples[:n]
+    self.samples[:len(samples) - n] = samples[n:]
+
+    # Only now let the reader know about the new samples.
+    self.write_pos[0] = pos + len(samples)
+
+  def read(self, pos, count):
+    # Returns views (not copies!) of count samples starting at pos. That's two
+    # views if the samples wrap around the end of the ring.
+    start = pos % self.capacity
+    end = start + count
+    if end <= self.capacity:
+      return [self.samples[start:end]]
+
+    return [self.samples[start:], self.samples[:end - self.capacity]]
+
+  def close(self):
+    # The views have to be gone before the shared memory can be closed.
+    del self.write_pos
+    del self.samples
+    self.shm.close()
+    if self.owner:
+      self.shm.unlink()
+
+
+def demodulator_process(ring_name, ring_capacity, sample_rate, results,
+                        the_end):
+  # Runs in a separate process. Demodulates whatever the capture thread puts
+  # into the ring and sends the received payloads back over the results pipe.
+  ring = SharedAudioRing(ring_capacity, name=ring_name)
+  demodulator = Demodulator(sample_rate)
+  pos = 0
+
+  logger_dem.info(f"Audio demodulator process online")
+
+  try:
+    while not the_end.is_set():
+      available = ring.written() - pos
+
+      if available > ring_capacity // 2:
+        # We're way behind and the capture thread will soon overwrite what we
+        # haven't read yet. Skip to the most recent data.
+        logger_dem.warning(
+            f"Demodulator is behind, skipping {available} samples"
+        )
+        pos += available
+        demodulator.discard()
+        continue
+
+      count = min(demodulator.samples_to_fetch, available)
+      if count < min(demodulator.samples_to_fetch, ring_capacity // 4):
+        # Wait for the capture thread to catch up.
+        time.sleep(CAPTURE_CHUNK / sample_rate / 2)
         continue
 
+      for payload in demodulator.process(*ring.read(pos, count)):
+        results.send_bytes(payload)
+
+      pos += count
+  finally:
+    ring.close()
+
+  logger_dem.info(f"Audio demodulator process offline")
+
+
+class AudioDemodulator(threading.Thread):
+  def __init__(self, tun_inbound_path, audio_source, the_end, sample_rate,
+               use_process=False, channels=AUDIO_CHANNELS, arq_link=None):
+    super().__init__()
+    self.audio_source = audio_source
+    self.sample_rate = sample_rate
+    self.tun_inbound_path = tun_inbound_path
+    self.the_end = the_end
+    self.use_process = use_process
+    self.channels = channels
+    # Packets which weren't compressed pass through as they are, so this is
+    # always on.
+    self.decompressor = hdrcomp.HeaderDecompressor()
+    self.arq = arq_link
+
+    # The demodulator might be in another process, so this counts what comes
+    # out of it.
+    self.stats = metrics.LinkMetrics()
+    self.dropped = metrics.counter(
+        "ipow_dropped_total", "Received packets which were dropped",
+        reason="header_compression"
+    )
+
+  def send_packet(self, ipow, payload):
+    if payload:
+      self.stats.received(payload)
+    if self.arq:
+      payload = self.arq.unwrap(payload)
+      if payload is None:
+        return  # A duplicate, or just an ACK.
+    payload = self.decompressor.decompress(payload)
+    if payload is None:
+      logger_dem.debug("Dropping a packet (header compression context lost)")
+      self.dropped.inc()
+      return
+    tracing.mark("received", payload)
+    # Never blocks: the audio keeps coming whether IPOW keeps up or not, so
+    # what doesn't fit the writer's queue is dropped (and counted) there.
+    if ipow.write(payload):
+      tracing.mark("ipow_out", payload)
+
+  def read_samples(self, count):
+    # Returns count frames as a (frames, channels) array.
+    audio_data = self.audio_source.read(2 * count * self.channels)
+    return np.frombuffer(audio_data, dtype="<i2").reshape(-1, self.channels)
+
+  def worker(self, ipow):
+    # Each channel carries an independent symbol stream, so each one gets its
+    # own demodulator.
+    demodulators = [
+        Demodulator(self.sample_rate) for _ in range(self.channels)
+    ]
+
+    while not self.the_end.is_set():
+      count = max(
+          demodulator.samples_to_fetch for demodulator in demodulators
+      )
+      frames = self.read_samples(count)
+
+      for channel, demodulator in enumerate(demodulators):
+        for payload in demodulator.process(frames[:, channel]):
+          self.send_packet(ipow, payload)
+
+  def worker_with_process(self, ipow):
+    # This thread only captures audio into the rings (and forwards whatever
+    # comes back), while the actual demodulation happens in other processes
+    # (one per channel), i.e. it doesn't compete with the modulator for the
+    # GIL.
+    ctx = multiprocessing.get_context("spawn")
+    process_end = ctx.Event()
+    rings = []
+    results = []
+    processes = []
+
+    try:
+      for _ in range(self.channels):
+        ring = SharedAudioRing(CAPTURE_RING_SECONDS * self.sample_rate)
+        rings.append(ring)
+        channel_results, results_send = ctx.Pipe(duplex=False)
+        results.append(channel_results)
+
+        process = ctx.Process(
+            target=demodulator_process,
+            args=(ring.name, ring.capacity, self.sample_rate, results_send,
+                  process_end),
+            daemon=True
+        )
+        process.start()
+        processes.append(process)
+
+      while not self.the_end.is_set():
+        frames = self.read_samples(CAPTURE_CHUNK)
+        for channel, ring in enumerate(rings):
+          ring.write(frames[:, channel])
+
+        for channel_results in results:
+          while channel_results.poll():
+            self.send_packet(ipow, channel_results.recv_bytes())
+
+        if not all(process.is_alive() for process in processes):
+          logger_dem.error(f"Audio demodulator process died")
+          self.the_end.set()
+    finally:
+      process_end.set()
+      for process in processes:
+        process.join()
+      for ring in rings:
+        ring.close()
 
   def run(self):
     logger_dem.info(f"Audio demodulator (sender) thread online")
 
+    ipow = ipowwriter.IPOWWriter(
+        self.tun_inbound_path, logger=logger_dem, background=True
+    )
     while not self.the_end.is_set():
-      s = socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM)
-      self.worker(s)
-      s.close()
+      if self.use_process:
+        self.worker_with_process(ipow)
+      else:
+        self.worker(ipow)
 
     logger_dem.info(f"Audio demodulator (sender) thread offline")
     self.the_end.set()  # If I exit, everyone exits.
 
 
-
 def main():
   parser = argparse.ArgumentParser(description="IPOW-compatible audio 'modem'")
   parser.add_argument(
@@ -512,19 +1358,91 @@ def main():
   )
   parser.add_argument(
       "-O", "--line-out", type=str,
-      help='Pulse Audio sink (line out/speaker); use "pactl list short sinks"',
+      help='Pulse Audio sink (line out/speaker); use "pactl list short sinks"; '
+           'or a WAV file / loopback name with -b',
       default='use--line-out-to-provide-a-sink'
   )
   parser.add_argument("-I", "--line-in", type=str,
-      help='Pulse Audio source (line in/mic); use "pactl list short sources"',
+      help='Pulse Audio source (line in/mic); use "pactl list short sources"; '
+           'or a WAV file / loopback name with -b',
       default='use--line-in-to-provide-a-source'
   )
+  parser.add_argument(
+      "-b", "--backend", type=str, choices=backends.BACKENDS,
+      help='Audio backend: pulse (Pulse Audio), wav (WAV files) or loopback '
+           '(in-memory, the same -O and -I names are connected)',
+      default='pulse'
+  )
+  parser.add_argument(
+      "-P", "--demod-process", action="store_true",
+      help='Demodulate in a separate process (audio capture stays in a thread)'
+  )
+  parser.add_argument(
+      "-p", "--profile", type=str, choices=PROFILES_BY_NAME.keys(),
+      help='Modulation profile to send with (the receiving side accepts any '
+           'profile with the same sample rate)',
+      default='classic'
+  )
+  parser.add_argument(
+      "-c", "--channels", type=int, choices=[1, 2],
+      help='Number of audio channels; 2 (stereo) sends independent data on '
+           'left and right',
+      default=AUDIO_CHANNELS
+  )
+  parser.add_argument(
+      "-f", "--fec", type=str, choices=fec.SCHEMES_BY_NAME.keys(),
+      help='Error detection/correction to send with: CRC32 only, or CRC32 and '
+           'Reed-Solomon with 8/16 parity bytes per block (the receiving side '
+           'accepts any)',
+      default='none'
+  )
+  parser.add_argument(
+      "-z", "--compress-headers", action="store_true",
+      help='Compress IPv4/TCP/UDP/ICMP headers before sending (the receiving '
+           'side always decompresses)'
+  )
+  parser.add_argument(
+      "-r", "--arq", action="store_true",
+      help='Retransmit lost packets (selective repeat ARQ; needs -m both on '
+           'both sides)'
+  )
+  parser.add_argument(
+      "-v", "--verbose", action="store_true",
+      help='Log every packet'
+  )
+  parser.add_argument(
+      "--metrics", type=str,
+      help='Serve metrics on this UNIX socket path or [host:]port (HTTP)'
+  )
+  parser.add_argument(
+      "--trace", type=str,
+      help='Trace packets through the stages into this file (.json: Chrome '
+           'trace format; written on exit and SIGUSR1)'
+  )
   args = parser.parse_args()
 
+  # force, as importing this already set up logging (at INFO).
   logging.basicConfig(
-      level=logging.DEBUG,
+      level=logging.DEBUG if args.verbose else logging.INFO,
       format='[%(asctime)s] [%(levelname)s] %(funcName)s: %(message)s',
       datefmt='%Y-%m-%d %H:%M:%S',
+      force=True,
+  )
+
+  if args.metrics:
+    metrics.serve(args.metrics, "audio")
+
+  if args.trace:
+    tracing.start(args.trace, "audio")
+
+  profile = PROFILES_BY_NAME[args.profile]
+  logger.info(
+      f"Using profile {profile.name}: {profile.sample_rate} Hz, "
+      f"{args.channels} channel(s), "
+      f"~{profile.bytes_per_second() * args.channels:.0f} bytes/s, "
+      f"FEC {args.fec}"
+      f"{', header compression' if args.compress_headers else ''}"
+      f"{', ARQ' if args.arq else ''}"
   )
 
   mode = args.mode.lower()
@@ -542,14 +1460,10 @@ def main():
       sys.exit()
 
     try:
-      audio_sink = pasimple.PaSimple(
-          pasimple.PA_STREAM_PLAYBACK,
-          AUDIO_SAMPLE_FORMAT,
-          AUDIO_CHANNELS,
-          AUDIO_SAMPLES_PER_SECOND,
-          device_name=args.line_out
+      audio_sink = backends.open_sink(
+          args.backend, args.line_out, profile.sample_rate, args.channels
       )
-    except pasimple.exceptions.PaSimpleError as e:
+    except backends.AudioBackendError as e:
       logger.info(f"Couldn't open audio sink '{args.line_out}': {e}")
       sys.exit()
 
@@ -561,31 +1475,44 @@ def main():
       sys.exit()
 
     try:
-      audio_source = pasimple.PaSimple(
-          pasimple.PA_STREAM_RECORD,
-          AUDIO_SAMPLE_FORMAT,
-          AUDIO_CHANNELS,
-          AUDIO_SAMPLES_PER_SECOND,
-          device_name=args.line_in
+      audio_source = backends.open_source(
+          args.backend, args.line_in, profile.sample_rate, args.channels
       )
-    except pasimple.exceptions.PaSimpleError as e:
+    except backends.AudioBackendError as e:
       logger.info(f"Couldn't open audio source '{args.line_in}': {e}")
       sys.exit()
 
 
+  # The ACKs come back over the other direction, so ARQ needs both.
+  arq_link = None
+  if args.arq:
+    if not (mode_send_audio and mode_recv_audio):
+      logger.info(f"ARQ needs both directions (-m both)")
+      sys.exit()
+
+    # Even a single full-sized packet takes a while to get through, so give
+    # the packets at least a few of those.
+    packet_time = codel.MTU / (profile.bytes_per_second() * args.channels)
+    arq_link = arq.ARQ(
+        deadline=max(arq.DEADLINE, 2 * packet_time),
+        initial_rto=max(arq.INITIAL_RTO, packet_time), logger=logger
+    )
+
   audio_modulator_th = None
   audio_demodulator_th = None
   the_end = threading.Event()
 
   if mode_send_audio:
     audio_modulator_th = AudioModulator(
-        audio_sink, args.tun_outbound, the_end
+        audio_sink, args.tun_outbound, the_end, profile, args.channels,
+        fec.SCHEMES_BY_NAME[args.fec], args.compress_headers, arq_link
     )
     audio_modulator_th.start()
 
   if mode_recv_audio:
     audio_demodulator_th = AudioDemodulator(
-        args.tun_inbound, audio_source, the_end
+        args.tun_inbound, audio_source, the_end, profile.sample_rate,
+        args.demod_process, args.channels, arq_link
     )
     audio_demodulator_th.start()
 
@@ -608,6 +1535,12 @@ def main():
   if audio_demodulator_th:
     audio_demodulator_th.join()
 
+  if audio_sink:
+    audio_sink.close()
+
+  if audio_source and audio_source is not audio_sink:
+    audio_source.close()
+
 
 if __name__ == "__main__":
   main()
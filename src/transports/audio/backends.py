@@ -0,0 +1,220 @@
+# Audio backends for the audio modem. Everything here looks like
+# pasimple.PaSimple as far as the modem is concerned, i.e. has write(data),
+# read(size), drain() and close(), and deals in interleaved int16 (little
+# endian) frames.
+#
+#   pulse     - Pulse Audio via pasimple (imported only when used)
+#   wav       - WAV files (sink writes one, source reads one)
+#   loopback  - in-memory virtual cable, sinks and sources with the same device
+#               name are connected
+import threading
+import time
+import wave
+
+AUDIO_SAMPLE_WIDTH = 2  # int16
+
+BACKENDS = ("pulse", "wav", "loopback")
+
+# Seconds without a read (in progress or done) after which a loopback
+# cable's reader is gone.
+LOOPBACK_READER_GONE = 1.0
+
+
+class AudioBackendError(Exception):
+  pass
+
+
+class LoopbackAudio:
+  # A virtual cable. Reading is paced to the sample rate (times speed), and if
+  # nothing was written in the meantime, silence is read - just like a line in
+  # with nothing playing. Writing blocks if too much is waiting to be read,
+  # just like a sound card's buffer. But if nobody reads at all (e.g. the
+  # receiving side already quit), what's waiting is dropped instead - a sound
+  # card plays on, whether anyone's listening or not.
+  def __init__(self, sample_rate, channels, speed=1.0, buffer_seconds=0.2):
+    self.frame_size = AUDIO_SAMPLE_WIDTH * channels
+    self.rate = sample_rate * speed
+    self.buffer_sz = int(sample_rate * buffer_seconds) * self.frame_size
+    self.pending = bytearray()
+    self.lock = threading.Condition()
+    self.t0 = None
+    self.frames_read = 0
+    self.last_read = time.monotonic()
+    self.reading = 0  # Reads in progress; a long one is paced for a while.
+
+  def write(self, data):
+    with self.lock:
+      while len(self.pending) > self.buffer_sz:
+        if (not self.reading and
+            time.monotonic() - self.last_read > LOOPBACK_READER_GONE):
+          self.pending.clear()
+          break
+        self.lock.wait(0.05)
+      self.pending += data
+
+  def read(self, size):
+    if self.t0 is None:
+      self.t0 = time.monotonic()
+
+    with self.lock:
+      self.reading += 1
+    try:
+      self.frames_read += size // self.frame_size
+      delay = self.t0 + self.frames_read / self.rate - time.monotonic()
+      if delay > 0:
+        time.sleep(delay)
+    finally:
+      with self.lock:
+        self.reading -= 1
+        data = bytes(self.pending[:size])
+        del self.pending[:size]
+        self.last_read = time.monotonic()
+        self.lock.notify_all()
+
+    return data + b"\0" * (size - len(data))
+
+  def drain(self):
+    while True:
+      with self.lock:
+        if not self.pending:
+          return
+      time.sleep(0.01)
+
+  def close(self):
+    pass
+
+
+class WavSink:
+  # Writes everything played into a WAV file. If realtime is set, the time
+  # between writes is filled with silence, so that the file sounds like what
+  # a line in on the other side would hear.
+  def __init__(self, path, sample_rate, channels, realtime=True):
+    self.sample_rate = sample_rate
+    self.frame_size = AUDIO_SAMPLE_WIDTH * channels
+    self.realtime = realtime
+    self.t0 = time.monotonic()
+    self.frames = 0
+
+    self.wav = wave.open(path, "wb")
+    self.wav.setnchannels(channels)
+    self.wav.setsampwidth(AUDIO_SAMPLE_WIDTH)
+    self.wav.setframerate(sample_rate)
+
+  def write(self, data):
+    if self.realtime:
+      now = int((time.monotonic() - self.t0) * self.sample_rate)
+      if now > self.frames:
+        self.wav.writeframes(b"\0" * (now - self.frames) * self.frame_size)
+        self.frames = now
+
+    self.wav.writeframes(data)
+    self.frames += len(data) // self.frame_size
+
+  def drain(self):
+    pass
+
+  def close(self):
+    self.wav.close()
+
+
+class WavSource:
+  # Reads a WAV file (which has to match the sample rate and channel count).
+  # If realtime is set, reading is paced to the sample rate. Past the end of
+  # the file, there's only silence.
+  def __init__(self, path, sample_rate, channels, realtime=True):
+    try:
+      self.wav = wave.open(path, "rb")
+    except (OSError, wave.Error) as e:
+      raise AudioBackendError(str(e))
+
+    if (self.wav.getframerate() != sample_rate or
+        self.wav.getnchannels() != channels or
+        self.wav.getsampwidth() != AUDIO_SAMPLE_WIDTH):
+      self.wav.close()
+      raise AudioBackendError(
+          f"expected {sample_rate} Hz, {channels} channel(s), 16-bit audio"
+      )
+
+    self.sample_rate = sample_rate
+    self.frame_size = AUDIO_SAMPLE_WIDTH * channels
+    self.frame_count = self.wav.getnframes()
+    self.realtime = realtime
+    self.t0 = None
+    self.frames = 0
+
+  def read(self, size):
+    if self.realtime:
+      if self.t0 is None:
+        self.t0 = time.monotonic()
+      delay = self.t0 + self.frames / self.sample_rate - time.monotonic()
+      if delay > 0:
+        time.sleep(delay)
+
+    data = self.wav.readframes(size // self.frame_size)
+    self.frames += size // self.frame_size
+    return data + b"\0" * (size - len(data))
+
+  def drain(self):
+    pass
+
+  def close(self):
+    self.wav.close()
+
+
+# Loopback cables by device name.
+loopback_devices = {}
+loopback_lock = threading.Lock()
+
+
+def open_loopback(device, sample_rate, channels):
+  with loopback_lock:
+    if device not in loopback_devices:
+      loopback_devices[device] = LoopbackAudio(sample_rate, channels)
+    return loopback_devices[device]
+
+
+def open_pulse(playback, device, sample_rate, channels):
+  try:
+    import pasimple
+  except ImportError:
+    raise AudioBackendError("pasimple is not installed")
+
+  try:
+    return pasimple.PaSimple(
+        pasimple.PA_STREAM_PLAYBACK if playback else pasimple.PA_STREAM_RECORD,
+        pasimple.PA_SAMPLE_S16LE,
+        channels,
+        sample_rate,
+        device_name=device
+    )
+  except pasimple.exceptions.PaSimpleError as e:
+    raise AudioBackendError(str(e))
+
+
+def open_sink(backend, device, sample_rate, channels):
+  if backend == "pulse":
+    return open_pulse(True, device, sample_rate, channels)
+
+  if backend == "wav":
+    try:
+      return WavSink(device, sample_rate, channels)
+    except OSError as e:
+      raise AudioBackendError(str(e))
+
+  if backend == "loopback":
+    return open_loopback(device, sample_rate, channels)
+
+  raise AudioBackendError(f"unknown audio backend '{backend}'")
+
+
+def open_source(backend, device, sample_rate, channels):
+  if backend == "pulse":
+    return open_pulse(False, device, sample_rate, channels)
+
+  if backend == "wav":
+    return WavSource(device, sample_rate, channels)
+
+  if backend == "loopback":
+    return open_loopback(device, sample_rate, channels)
+
+  raise AudioBackendError(f"unknown audio backend '{backend}'")
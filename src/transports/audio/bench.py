@@ -0,0 +1,323 @@
+#!/usr/bin/env python3
+# Offline benchmark for the audio modem. Synthetic packets are modulated,
+# sent through a simulated cable (attenuation, noise, clock drift) and
+# demodulated, all in "audio time", i.e. no sound card, no IPOW, no waiting.
+#
+# Reports goodput, bit error rate, decoding CPU time per second of audio and
+# end-to-end latency (from the packet showing up to it being demodulated).
+#
+# It can also just demodulate a WAV file, e.g. the recording in this directory:
+#   python bench.py --wav ping_modulated_audio.wav --expect 5
+import argparse
+import collections
+import logging
+import random
+import sys
+import threading
+import time
+
+import numpy as np
+
+import audio
+import backends
+import fec
+
+
+def make_packets(count, min_sz, max_sz, rng):
+  # Each packet starts with its sequence number, the rest is random.
+  packets = []
+  for seq in range(count):
+    size = rng.randint(max(min_sz, 4), max(max_sz, 4))
+    packets.append(seq.to_bytes(4, "big") + rng.randbytes(size - 4))
+  return packets
+
+
+def modulate(modulator, packets, arrivals, sample_rate):
+  # Does what AudioModulator's worker does, but in audio time: whatever has
+  # arrived by the time the line is free goes out as a burst, and an empty
+  # packet goes out if the line was idle for CALIBRATION_INTERVAL.
+  # Returns the audio and the sample at which each packet arrived.
+  calibration_interval = int(audio.CALIBRATION_INTERVAL * sample_rate)
+  max_packets = audio.BURST_MAX_PACKETS * modulator.channels
+  max_bytes = audio.BURST_MAX_BYTES * modulator.channels
+
+  chunks = []
+  pos = 0
+  waiting = collections.deque()
+  i = 0
+
+  def append(waveform):
+    nonlocal pos
+    chunks.append(waveform)
+    pos += len(waveform)
+
+  def silence(frames):
+    append(np.zeros((frames, modulator.channels), dtype=np.int16))
+
+  # Let the other side lock on first (like the worker would after being idle).
+  append(modulator.modulate([b""]))
+
+  while i < len(packets) or waiting:
+    while i < len(packets) and arrivals[i] <= pos:
+      waiting.append(packets[i])
+      i += 1
+
+    if not waiting:
+      wait = arrivals[i] - pos
+      if wait > calibration_interval:
+        silence(calibration_interval)
+        append(modulator.modulate([b""]))
+      else:
+        silence(wait)
+      continue
+
+    burst = [waiting.popleft()]
+    burst_sz = len(burst[0])
+    while waiting and len(burst) < max_packets and burst_sz < max_bytes:
+      burst.append(waiting.popleft())
+      burst_sz += len(burst[-1])
+
+    append(modulator.modulate(burst))
+
+  silence(sample_rate)  # Let the demodulator finish.
+  return np.concatenate(chunks)
+
+
+def impair(samples, attenuation_db, noise_db, drift_ppm, rng):
+  # The simulated cable. Noise is relative to the full scale of what the
+  # modulator sends. Clock drift means the receiving side's sample clock is
+  # off by drift_ppm.
+  samples = samples.astype(np.float64) * 10 ** (-attenuation_db / 20)
+
+  if drift_ppm:
+    # Resample in the frequency domain - plain interpolation would smear the
+    # tones close to the Nyquist frequency.
+    frames = int(len(samples) * (1 + drift_ppm / 1e6))
+    spectrum = np.fft.rfft(samples, axis=0)
+    samples = np.fft.irfft(spectrum, n=frames, axis=0) * (frames / len(samples))
+
+  if noise_db is not None:
+    noise = audio.AUDIO_FULL_SCALE * 10 ** (noise_db / 20)
+    samples += rng.normal(0, noise, samples.shape)
+
+  return np.clip(np.round(samples), -0x8000, 0x7fff).astype(np.int16)
+
+
+def demodulate(samples, sample_rate):
+  # Returns the received payloads along with the sample at which each one
+  # was ready, and the CPU time it took.
+  demodulators = [
+      audio.Demodulator(sample_rate) for _ in range(samples.shape[1])
+  ]
+  received = []
+  cpu = 0
+
+  for pos in range(0, len(samples), audio.CAPTURE_CHUNK):
+    chunk = samples[pos:pos + audio.CAPTURE_CHUNK]
+    t = time.process_time()
+    for channel, demodulator in enumerate(demodulators):
+      for payload in demodulator.process(chunk[:, channel]):
+        received.append((payload, pos + len(chunk)))
+    cpu += time.process_time() - t
+
+  return received, cpu
+
+
+def bit_errors(a, b):
+  return int(np.unpackbits(
+      np.frombuffer(a, dtype=np.uint8) ^ np.frombuffer(b, dtype=np.uint8)
+  ).sum())
+
+
+def match(packets, received):
+  # Pairs up received payloads with the sent packets (by the sequence number,
+  # or by the least bit errors if that got corrupted).
+  # Returns a list of (sent index, received payload, ready at) tuples.
+  unmatched = set(range(len(packets)))
+  matched = []
+
+  for payload, ready in received:
+    seq = int.from_bytes(payload[:4], "big")
+    if (seq not in unmatched or len(packets[seq]) != len(payload)):
+      candidates = [i for i in unmatched if len(packets[i]) == len(payload)]
+      if not candidates:
+        continue
+      seq = min(candidates, key=lambda i: bit_errors(packets[i], payload))
+
+    unmatched.discard(seq)
+    matched.append((seq, payload, ready))
+
+  return matched
+
+
+def bench(args):
+  profile = audio.PROFILES_BY_NAME[args.profile]
+  fec_scheme = fec.SCHEMES_BY_NAME[args.fec]
+  sample_rate = profile.sample_rate
+  rng = random.Random(args.seed)
+  np_rng = np.random.default_rng(args.seed)
+
+  packets = make_packets(args.packets, args.min_size, args.max_size, rng)
+  if args.rate:
+    t = 0
+    arrivals = []
+    for _ in packets:
+      t += rng.expovariate(args.rate)
+      arrivals.append(int(t * sample_rate))
+  else:
+    arrivals = [0] * len(packets)  # Everything is there from the start.
+
+  modulator = audio.AudioModulator(
+      None, None, threading.Event(), profile, args.channels, fec_scheme
+  )
+  sent = modulate(modulator, packets, arrivals, sample_rate)
+
+  if args.save_wav:
+    sink = backends.WavSink(
+        args.save_wav, sample_rate, args.channels, realtime=False
+    )
+    sink.write(sent.tobytes())
+    sink.close()
+
+  received_audio = impair(
+      sent, args.attenuation, args.noise, args.drift, np_rng
+  )
+  received, cpu = demodulate(received_audio, sample_rate)
+  matched = match(packets, received)
+
+  duration = len(received_audio) / sample_rate
+  delivered_bytes = sum(len(payload) for _, payload, _ in matched)
+  errors = sum(
+      bit_errors(packets[seq], payload) for seq, payload, _ in matched
+  )
+  intact = sum(1 for seq, payload, _ in matched if packets[seq] == payload)
+  latencies = np.array(
+      [(ready - arrivals[seq]) / sample_rate for seq, _, ready in matched]
+  )
+
+  print(
+      f"profile {profile.name}, {args.channels} channel(s), "
+      f"FEC {fec_scheme.name}, {sample_rate} Hz"
+  )
+  print(
+      f"cable:       attenuation {args.attenuation} dB, "
+      f"noise {'none' if args.noise is None else f'{args.noise} dB'}, "
+      f"drift {args.drift} ppm"
+  )
+  print(f"audio:       {duration:.2f} s")
+  print(
+      f"packets:     {len(packets)} sent, {len(matched)} delivered, "
+      f"{intact} intact"
+  )
+  print(f"goodput:     {delivered_bytes / duration:.1f} bytes/s")
+  if delivered_bytes:
+    print(
+        f"BER:         {errors / (delivered_bytes * 8):.2e} "
+        f"({errors} bit errors)"
+    )
+  print(f"decode CPU:  {cpu / duration:.3f} s per second of audio")
+  if len(latencies):
+    print(
+        f"latency:     p50 {np.percentile(latencies, 50):.3f} s, "
+        f"p99 {np.percentile(latencies, 99):.3f} s, "
+        f"max {latencies.max():.3f} s"
+    )
+
+  return intact
+
+
+def decode_wav(args):
+  try:
+    source = backends.WavSource(
+        args.wav, audio.PROFILES_BY_NAME[args.profile].sample_rate,
+        args.channels, realtime=False
+    )
+  except backends.AudioBackendError as e:
+    print(f"Can't read '{args.wav}': {e}")
+    sys.exit(2)
+
+  data = source.read(source.frame_count * source.frame_size)
+  source.close()
+
+  samples = np.frombuffer(data, dtype="<i2").reshape(-1, args.channels)
+  received, cpu = demodulate(samples, source.sample_rate)
+
+  duration = len(samples) / source.sample_rate
+  for payload, ready in received:
+    print(f"{ready / source.sample_rate:8.3f} s: {len(payload)} bytes")
+  print(
+      f"{len(received)} packets in {duration:.2f} s of audio, "
+      f"decode CPU {cpu / duration:.3f} s per second of audio"
+  )
+
+  return len(received)
+
+
+def main():
+  parser = argparse.ArgumentParser(description="Audio modem benchmark")
+  parser.add_argument(
+      "-p", "--profile", type=str, choices=audio.PROFILES_BY_NAME.keys(),
+      default='classic'
+  )
+  parser.add_argument("-c", "--channels", type=int, choices=[1, 2], default=1)
+  parser.add_argument(
+      "-f", "--fec", type=str, choices=fec.SCHEMES_BY_NAME.keys(),
+      default='none'
+  )
+  parser.add_argument(
+      "-n", "--packets", type=int, default=50,
+      help='Number of packets to send'
+  )
+  parser.add_argument("--min-size", type=int, default=40)
+  parser.add_argument("--max-size", type=int, default=200)
+  parser.add_argument(
+      "--rate", type=float, default=0,
+      help='Average packets per second (Poisson arrivals); 0 - all packets '
+           'are waiting from the start'
+  )
+  parser.add_argument(
+      "--attenuation", type=float, default=0,
+      help='Attenuation in dB'
+  )
+  parser.add_argument(
+      "--noise", type=float, default=None,
+      help='White noise level in dB relative to the full signal, e.g. -30'
+  )
+  parser.add_argument(
+      "--drift", type=float, default=0,
+      help='Receiving side sample clock drift in ppm'
+  )
+  parser.add_argument("--seed", type=int, default=1)
+  parser.add_argument(
+      "--save-wav", type=str,
+      help='Also save the sent audio (before the cable) as a WAV file'
+  )
+  parser.add_argument(
+      "--wav", type=str,
+      help='Just demodulate this WAV file instead'
+  )
+  parser.add_argument(
+      "--expect", type=int,
+      help='Exit with 1 unless at least this many packets were received '
+           'intact'
+  )
+  parser.add_argument(
+      "-v", "--verbose", action="store_true",
+      help='Show the modem logs'
+  )
+  args = parser.parse_args()
+
+  logging.getLogger().setLevel(logging.INFO if args.verbose else logging.ERROR)
+
+  if args.wav:
+    received = decode_wav(args)
+  else:
+    received = bench(args)
+
+  if args.expect is not None and received < args.expect:
+    print(f"FAILED: expected at least {args.expect} packets")
+    sys.exit(1)
+
+
+if __name__ == "__main__":
+  main()
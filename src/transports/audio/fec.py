@@ -0,0 +1,274 @@
+# Forward error correction for the audio modem: a CRC32 trailer and
+# (optionally) Reed-Solomon over GF(256) on top of it.
+#
+# A packet's payload gets its CRC32 (little endian) appended, and is then split
+# into blocks of up to RS_BLOCK_SIZE bytes. Each block is followed by its RS
+# parity bytes (the code is shortened, i.e. a shorter last block is treated as
+# if it had leading zeros). An RS block with N parity bytes can correct up to
+# N/2 wrong bytes; the CRC catches whatever RS got wrong.
+import numpy as np
+import zlib
+
+# How many data bytes go into one RS block. Note that this + parity has to be
+# at most 255.
+RS_BLOCK_SIZE = 96
+
+CRC_SIZE = 4
+
+# GF(256) with the 0x11d polynomial (x^8+x^4+x^3+x^2+1) and 2 as the
+# generator.
+GF_EXP = np.zeros(512, dtype=np.int32)
+GF_LOG = np.zeros(256, dtype=np.int32)
+_x = 1
+for _i in range(255):
+  GF_EXP[_i] = _x
+  GF_LOG[_x] = _i
+  _x <<= 1
+  if _x & 0x100:
+    _x ^= 0x11d
+GF_EXP[255:510] = GF_EXP[:255]
+del _x, _i
+
+# Full multiplication table, i.e. GF_MUL[a, b] == a * b. It's only 64KB and
+# it makes everything below vectorizable with plain numpy indexing.
+GF_MUL = GF_EXP[GF_LOG[:, None] + GF_LOG[None, :]].astype(np.uint8)
+GF_MUL[0, :] = 0
+GF_MUL[:, 0] = 0
+
+
+def gf_inverse(a):
+  return int(GF_EXP[255 - GF_LOG[a]])
+
+
+def gf_poly_eval(poly, x):
+  # poly is lowest degree first.
+  result = 0
+  for coefficient in reversed(poly):
+    result = int(GF_MUL[result, x]) ^ coefficient
+  return result
+
+
+def rs_generator(parity):
+  # g(x) = (x - 1)(x - 2)(x - 2^2)...(x - 2^(parity-1)), highest degree first.
+  g = np.array([1], dtype=np.uint8)
+  for i in range(parity):
+    shifted = np.append(g, 0)
+    scaled = np.insert(GF_MUL[g, GF_EXP[i]], 0, 0)
+    g = shifted ^ scaled
+  return g
+
+
+def rs_encode_blocks(blocks, generator):
+  # blocks is a (count, block_size) uint8 array; returns (count, parity) uint8
+  # array of parity bytes. This is the usual LFSR division, just done for all
+  # the blocks at once.
+  parity = len(generator) - 1
+  remainder = np.zeros((len(blocks), parity), dtype=np.uint8)
+  for column in blocks.T:
+    feedback = column ^ remainder[:, 0]
+    remainder[:, :-1] = remainder[:, 1:]
+    remainder[:, -1] = 0
+    remainder ^= GF_MUL[feedback[:, None], generator[None, 1:]]
+  return remainder
+
+
+def rs_syndromes(codewords, parity):
+  # S_i = r(2^i), for all the codewords at once. Returns (count, parity).
+  n = codewords.shape[1]
+  powers = np.arange(parity)[:, None] * np.arange(n - 1, -1, -1)[None, :]
+  terms = GF_MUL[codewords[:, None, :], GF_EXP[powers % 255][None, :, :]]
+  return np.bitwise_xor.reduce(terms, axis=2)
+
+
+def rs_correct(codeword, syndromes, first_valid):
+  # Corrects a single codeword (in place) with the given (non-zero)
+  # syndromes. Returns the number of corrected bytes, or None if there are
+  # too many errors. Bytes before first_valid are known to be zero (padding
+  # of a shortened block), so errors can't be there.
+  parity = len(syndromes)
+  syndromes = [int(s) for s in syndromes]
+
+  # Berlekamp-Massey: find the error locator polynomial (lowest degree first).
+  locator = [1]
+  previous = [1]
+  errors = 0
+  shift = 1
+  previous_discrepancy = 1
+  for k in range(parity):
+    discrepancy = syndromes[k]
+    for i in range(1, errors + 1):
+      discrepancy ^= int(GF_MUL[locator[i], syndromes[k - i]])
+
+    if discrepancy == 0:
+      shift += 1
+      continue
+
+    scale = int(GF_MUL[discrepancy, gf_inverse(previous_discrepancy)])
+    updated = locator + [0] * max(0, len(previous) + shift - len(locator))
+    for i, coefficient in enumerate(previous):
+      updated[i + shift] ^= int(GF_MUL[scale, coefficient])
+
+    if 2 * errors <= k:
+      previous = locator
+      errors = k + 1 - errors
+      previous_discrepancy = discrepancy
+      shift = 1
+    else:
+      shift += 1
+    locator = updated
+
+  del locator[errors + 1:]
+  if errors * 2 > parity:
+    return None
+
+  # Chien search: an error at position j (counted from the end) means that
+  # the locator has a root at 2^-j. Check all the positions at once.
+  n = len(codeword)
+  positions = np.arange(n)
+  powers = (np.arange(errors + 1)[:, None] * (255 - positions)[None, :]) % 255
+  values = np.bitwise_xor.reduce(
+      GF_MUL[np.array(locator)[:, None], GF_EXP[powers]], axis=0
+  )
+  error_positions = positions[values == 0]
+  if len(error_positions) != errors:
+    return None
+
+  # Forney: the error evaluator is S(x) * locator(x) mod x^parity.
+  evaluator = [0] * parity
+  for i, s in enumerate(syndromes):
+    for j, coefficient in enumerate(locator):
+      if i + j < parity:
+        evaluator[i + j] ^= int(GF_MUL[s, coefficient])
+
+  # The formal derivative only keeps odd powers in GF(2^m).
+  derivative = [
+      locator[i] if i & 1 else 0 for i in range(1, len(locator))
+  ]
+
+  for position in error_positions:
+    index = n - 1 - int(position)
+    if index < first_valid:
+      return None
+
+    x = int(GF_EXP[position])
+    x_inverse = gf_inverse(x)
+    denominator = gf_poly_eval(derivative, x_inverse)
+    if denominator == 0:
+      return None
+
+    magnitude = GF_MUL[
+        GF_MUL[x, gf_poly_eval(evaluator, x_inverse)],
+        gf_inverse(denominator)
+    ]
+    codeword[index] ^= magnitude
+
+  return errors
+
+
+class FecScheme:
+  # How (and if) packet payloads are protected. The scheme ID is sent in the
+  # audio header symbol (2 bits), so there can be at most 4 of these.
+  def __init__(self, scheme_id, name, crc, parity):
+    self.scheme_id = scheme_id
+    self.name = name
+    self.crc = crc
+    self.parity = parity  # RS parity bytes per block (0 - no RS).
+
+    if parity:
+      self.generator = rs_generator(parity)
+
+  def encoded_size(self, size):
+    # How many bytes go over the air for a payload of this size. Note that
+    # empty (calibration) packets stay empty.
+    if size == 0 or not self.crc:
+      return size
+
+    size += CRC_SIZE
+    if self.parity:
+      size += -(-size // RS_BLOCK_SIZE) * self.parity
+    return size
+
+  def encode(self, payload):
+    if not payload or not self.crc:
+      return payload
+
+    message = payload + zlib.crc32(payload).to_bytes(CRC_SIZE, "little")
+    if not self.parity:
+      return message
+
+    blocks, lengths = self.split(np.frombuffer(message, dtype=np.uint8))
+    parity = rs_encode_blocks(blocks, self.generator)
+
+    encoded = []
+    for block, length, block_parity in zip(blocks, lengths, parity):
+      encoded.append(block[RS_BLOCK_SIZE - length:].tobytes())
+      encoded.append(block_parity.tobytes())
+    return b"".join(encoded)
+
+  def decode(self, data, size):
+    # Returns (payload, number of corrected bytes), or (None, None) if the
+    # payload couldn't be recovered.
+    if size == 0 or not self.crc:
+      return data[:size], 0
+
+    message_size = size + CRC_SIZE
+    corrected = 0
+
+    if self.parity:
+      data = np.frombuffer(data, dtype=np.uint8)
+      codeword_size = RS_BLOCK_SIZE + self.parity
+      block_count = -(-message_size // RS_BLOCK_SIZE)
+
+      # Put the blocks back into a (count, codeword_size) array, left-padded
+      # with zeros (i.e. the way they were encoded).
+      codewords = np.zeros((block_count, codeword_size), dtype=np.uint8)
+      pads = []
+      pos = 0
+      for i in range(block_count):
+        length = min(RS_BLOCK_SIZE, message_size - i * RS_BLOCK_SIZE)
+        pad = RS_BLOCK_SIZE - length
+        codewords[i, pad:] = data[pos:pos + length + self.parity]
+        pads.append(pad)
+        pos += length + self.parity
+
+      syndromes = rs_syndromes(codewords, self.parity)
+      for i in np.flatnonzero(syndromes.any(axis=1)):
+        fixed = rs_correct(codewords[i], syndromes[i], pads[i])
+        if fixed is None:
+          return None, None
+        corrected += fixed
+
+      data = b"".join(
+          codewords[i, pad:RS_BLOCK_SIZE].tobytes()
+          for i, pad in enumerate(pads)
+      )
+
+    payload = data[:size]
+    crc = int.from_bytes(data[size:message_size], "little")
+    if zlib.crc32(payload) != crc:
+      return None, None
+
+    return bytes(payload), corrected
+
+  def split(self, message):
+    # Splits the message into RS_BLOCK_SIZE blocks, left-padding the last one
+    # with zeros. Returns the (count, RS_BLOCK_SIZE) array and the actual
+    # lengths of the blocks.
+    block_count = -(-len(message) // RS_BLOCK_SIZE)
+    blocks = np.zeros((block_count, RS_BLOCK_SIZE), dtype=np.uint8)
+    lengths = []
+    for i in range(block_count):
+      block = message[i * RS_BLOCK_SIZE:(i + 1) * RS_BLOCK_SIZE]
+      blocks[i, RS_BLOCK_SIZE - len(block):] = block
+      lengths.append(len(block))
+    return blocks, lengths
+
+
+SCHEMES = [
+    FecScheme(0, "none", crc=False, parity=0),
+    FecScheme(1, "crc", crc=True, parity=0),
+    FecScheme(2, "rs8", crc=True, parity=8),
+    FecScheme(3, "rs16", crc=True, parity=16),
+]
+
+SCHEMES_BY_NAME = {scheme.name: scheme for scheme in SCHEMES}
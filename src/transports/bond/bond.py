@@ -0,0 +1,525 @@
+#!/usr/bin/env python3
+# Bonding of several transports into one link. This registers as the (only)
+# client of IPOW (ipowd2, i.e. the datagram UNIX socket version) and pretends
+# to be IPOW for each of the transports (the "paths"):
+#
+#   IPOW <-> bond.py <-> <dir>/tcp_out, <dir>/tcp_in   <-> tcp-client.py   <->
+#                    <-> <dir>/icmp_out, <dir>/icmp_in <-> icmp-client.py  <->
+#                    <-> <dir>/dns_out, <dir>/dns_in   <-> dns-client.py   <->
+#
+# ...with another bond.py on the other end. Paths are either "socket" ones
+# (datagram UNIX sockets, just like ipowd2) or "fifo" ones (named pipes, just
+# like ipowd), e.g.:
+#
+#   bond.py -d /var/run/bond -P tcp:fifo:1000000 -P icmp:fifo:5000 \
+#           -P dns:fifo:500
+#   tcp-client.py -c ... -i /var/run/bond/tcp_out.fifo \
+#                 -o /var/run/bond/tcp_in.fifo
+#
+# Packets go over the paths as they are. The bonds additionally send small
+# probes over each path (and reply to them over the same path), which tells
+# them the path's RTT, whether it's up at all, and - as the reply carries the
+# number of bytes received on that path so far - how much actually gets
+# through. FIFOs don't keep packet boundaries, so on fifo paths the probes go
+# in an IPv4 header of their own (protocol 253, the one for experiments):
+# what goes through the FIFO is then nothing but IP packets, which is how the
+# transports (and the bond at the other end) cut the stream up again - see
+# framing.Splitter. A path's capacity is the most that got through recently,
+# or the rate given on the command line if that's more.
+#
+# Each flow (protocol, addresses, ports) sticks to one path. New flows pick a
+# path with weighted rendezvous hashing, i.e. in proportion to the paths'
+# capacities. So a fast path (like TCP) gets pretty much everything while
+# it's up. When a probe isn't answered within the path's RTO (about an RTT),
+# the path is down and its flows move to the other paths.
+#
+# With -r the bond talks to IPOW through shared memory rings (see
+# ../shmring.py) instead of its sockets, which saves a couple of syscalls and
+# copies per packet - worth it with fast paths.
+import argparse
+import collections
+import logging
+import math
+import os
+import select
+import socket
+import stat
+import struct
+import sys
+import tempfile
+import time
+import zlib
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+import framing
+import hdrcomp
+import ipowwriter
+import shmring
+
+MAX_PACKET_SIZE = 20480
+
+# Control frames. Their first byte can't be the start of an IPv4/IPv6 packet
+# (or a compressed one, see hdrcomp.py).
+FRAME_PROBE = 0x10
+FRAME_PROBE_REPLY = 0x11
+PROBE_FORMAT = "!BId"  # Type, sequence number, send time.
+PROBE_REPLY_FORMAT = "!BIdQ"  # ..., bytes received on this path so far.
+
+# The IPv4 header around control frames on fifo paths (no addresses).
+FRAME_HEADER_FORMAT = "!BBHHHBBH8x"
+FRAME_PROTO = 253
+
+PROBE_MIN_INTERVAL = 0.25  # Seconds.
+PROBE_MAX_SHARE = 0.05  # Probes can take up to 5% of a path's capacity.
+INITIAL_RTO = 3.0
+MIN_RTO = 0.5
+RATE_WINDOW = 30.0  # Seconds for which a capacity measurement counts.
+FLOW_TIMEOUT = 60.0
+REGISTER_INTERVAL = 10.0  # Re-register with IPOW every now and then.
+STATS_INTERVAL = 10.0
+
+PROTO_TCP = 6
+PROTO_UDP = 17
+
+logger = logging.getLogger("bond")
+
+
+def flow_key(packet):
+    packet = bytes(packet[:64])  # The headers are enough (also: memoryviews).
+    version = packet[0] >> 4 if packet else 0
+
+    if version == 4 and len(packet) >= 20:
+        header_size = (packet[0] & 0x0f) * 4
+        proto = packet[9]
+        key = packet[9:10] + packet[12:20]
+        fragment = int.from_bytes(packet[6:8], "big") & 0x3fff
+    elif version == 6 and len(packet) >= 40:
+        header_size = 40
+        proto = packet[6]
+        key = packet[6:7] + packet[8:40]
+        fragment = 0
+    else:
+        return b""
+
+    if proto in (PROTO_TCP, PROTO_UDP) and not fragment:
+        key += packet[header_size:header_size + 4]
+    return bytes(key)
+
+
+def wrap(frame):
+    # A control frame as an IPv4 packet, for fifo paths.
+    header = bytearray(struct.pack(
+        FRAME_HEADER_FORMAT, 0x45, 0, 20 + len(frame), 0, 0, 0, FRAME_PROTO, 0
+    ))
+    header[10:12] = hdrcomp.checksum(header).to_bytes(2, "big")
+    return bytes(header) + frame
+
+
+def unwrap(packet):
+    # The control frame in a packet from a fifo path, None if it's data.
+    if (len(packet) > 20 and packet[0] == 0x45 and packet[9] == FRAME_PROTO
+            and not any(packet[12:20])):
+        return packet[20:]
+    return None
+
+
+def flow_hash(key, name):
+    # A number in (0, 1) for the rendezvous hashing.
+    return (zlib.crc32(key + name.encode()) + 0.5) / (1 << 32)
+
+
+class Path:
+    def __init__(self, name, kind, rate, directory):
+        self.name = name
+        self.kind = kind
+        self.hint = rate
+
+        self.up = False
+        self.srtt = None
+        self.rttvar = None
+        self.rates = collections.deque()  # (time, bytes/s)
+        self.probe_seq = 0
+        self.outstanding = collections.OrderedDict()  # Sequence -> send time.
+        self.next_probe = 0
+        self.last_reply = None  # (time, peer's received bytes)
+
+        self.tx_bytes = 0
+        self.rx_bytes = 0
+        self.dropped = 0
+
+        self.client = None
+        self.out_sock = None
+        self.out_fd = None
+        self.in_fd = None
+        self.splitter = framing.Splitter()
+        self.unwritten = b""  # What's left of a frame os.write() cut short.
+        if kind == "socket":
+            self.out_sock = self.bind(os.path.join(directory, f"{name}_out"))
+            self.in_sock = self.bind(os.path.join(directory, f"{name}_in"))
+            self.fds = [self.out_sock, self.in_sock]
+        else:
+            # O_RDWR, so that opening doesn't wait for the other end, and
+            # there's no EOF when the transport restarts.
+            self.out_fd = self.fifo(os.path.join(directory, f"{name}_out.fifo"))
+            self.in_fd = self.fifo(os.path.join(directory, f"{name}_in.fifo"))
+            self.fds = [self.in_fd]
+
+    @staticmethod
+    def bind(path):
+        if os.path.exists(path):
+            os.unlink(path)
+        s = socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM)
+        s.bind(path)
+        s.setblocking(False)
+        os.chmod(path, 0o666)
+        return s
+
+    @staticmethod
+    def fifo(path):
+        if not os.path.exists(path) or not stat.S_ISFIFO(os.stat(path).st_mode):
+            if os.path.exists(path):
+                os.unlink(path)
+            os.mkfifo(path, 0o666)
+        return os.open(path, os.O_RDWR | os.O_NONBLOCK)
+
+    def connected(self):
+        return self.kind == "fifo" or self.client is not None
+
+    def send(self, data):
+        try:
+            if self.kind == "socket":
+                if self.client is None:
+                    self.dropped += 1
+                    return False
+                self.out_sock.sendto(data, self.client)
+            else:
+                # The rest of a frame has to go before anything else, or the
+                # stream is garbled.
+                if self.unwritten and not self.flush():
+                    raise BlockingIOError
+                written = os.write(self.out_fd, data)
+                self.unwritten = bytes(data[written:])  # Could be a ring slot.
+        except BlockingIOError:
+            self.dropped += 1
+            return False
+        except (FileNotFoundError, ConnectionRefusedError):
+            logger.info(f"Path {self.name}: transport went away")
+            self.client = None
+            self.dropped += 1
+            return False
+
+        self.tx_bytes += len(data)
+        return True
+
+    def send_frame(self, frame):
+        return self.send(wrap(frame) if self.kind == "fifo" else frame)
+
+    def flush(self):
+        # Writes more of a cut short frame (fifo paths, once writable).
+        # Returns True if it's all out.
+        try:
+            written = os.write(self.out_fd, self.unwritten)
+        except BlockingIOError:
+            return False
+        self.unwritten = self.unwritten[written:]
+        return not self.unwritten
+
+    def read(self, fd):
+        # Returns the received frames.
+        try:
+            if fd is self.out_sock:
+                # A transport telling us where to send the data to.
+                _, self.client = self.out_sock.recvfrom(MAX_PACKET_SIZE)
+                logger.info(f"Path {self.name}: transport registered")
+                return []
+            if fd == self.in_fd:
+                data = os.read(self.in_fd, MAX_PACKET_SIZE)
+            else:
+                data = self.in_sock.recv(MAX_PACKET_SIZE)
+        except BlockingIOError:
+            return []
+
+        self.rx_bytes += len(data)
+        if fd == self.in_fd:
+            return self.splitter.feed(data)
+        return [data] if data else []
+
+    def capacity(self, now):
+        while self.rates and self.rates[0][0] < now - RATE_WINDOW:
+            self.rates.popleft()
+        return max([self.hint] + [rate for _, rate in self.rates])
+
+    def rto(self):
+        if self.srtt is None:
+            return INITIAL_RTO
+        return max(MIN_RTO, self.srtt + 4 * self.rttvar)
+
+    def probe(self, now):
+        # Sends a probe if it's time for one, and notices if the path died.
+        if self.outstanding:
+            oldest = next(iter(self.outstanding.values()))
+            if self.up and now - oldest > self.rto():
+                self.up = False
+                logger.info(
+                    f"Path {self.name}: down (no reply for {now - oldest:.2f} s)"
+                )
+
+        if now < self.next_probe or not self.connected():
+            return
+
+        self.probe_seq = (self.probe_seq + 1) & 0xffffffff
+        if self.send_frame(struct.pack(PROBE_FORMAT, FRAME_PROBE, self.probe_seq, now)):
+            self.outstanding[self.probe_seq] = now
+            while len(self.outstanding) > 64:
+                self.outstanding.popitem(last=False)
+
+        interval = max(
+            PROBE_MIN_INTERVAL,
+            self.srtt or 0,
+            struct.calcsize(PROBE_FORMAT) /
+            (PROBE_MAX_SHARE * self.capacity(now))
+        )
+        self.next_probe = now + interval
+
+    def probe_replied(self, now, seq, sent, peer_rx_bytes):
+        # Returns True if the path just came up.
+        if seq not in self.outstanding:
+            return False  # Too late, or not ours.
+
+        # Everything sent before this one isn't coming back anymore.
+        while self.outstanding:
+            probe_seq, _ = self.outstanding.popitem(last=False)
+            if probe_seq == seq:
+                break
+
+        # RFC 6298.
+        rtt = now - sent
+        if self.srtt is None:
+            self.srtt = rtt
+            self.rttvar = rtt / 2
+        else:
+            self.rttvar = 0.75 * self.rttvar + 0.25 * abs(self.srtt - rtt)
+            self.srtt = 0.875 * self.srtt + 0.125 * rtt
+
+        if self.last_reply:
+            last_time, last_rx_bytes = self.last_reply
+            if now > last_time and peer_rx_bytes > last_rx_bytes:
+                self.rates.append(
+                    (now, (peer_rx_bytes - last_rx_bytes) / (now - last_time))
+                )
+        self.last_reply = (now, peer_rx_bytes)
+
+        if self.up:
+            return False
+        self.up = True
+        logger.info(f"Path {self.name}: up (RTT {rtt * 1000:.0f} ms)")
+        return True
+
+
+class Bond:
+    def __init__(self, tun_outbound_path, tun_inbound_path, paths, ring=False):
+        self.tun_outbound_path = tun_outbound_path
+        self.tun_inbound_path = tun_inbound_path
+        self.paths = paths
+        self.flows = {}  # Flow key -> [path, last used, generation]
+        self.generation = 0  # Changes whenever a path comes up.
+
+        self.tmp_dir = tempfile.TemporaryDirectory()
+        self.tun_outbound = socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM)
+        self.tun_outbound.bind(f"{self.tmp_dir.name}/tun_outbound_receiver")
+        self.to_ipow = ipowwriter.IPOWWriter(tun_inbound_path, logger=logger)
+
+        # Registers (once, for good) by itself.
+        self.ring = shmring.RingClient(tun_outbound_path) if ring else None
+
+        self.next_register = 0 if not ring else math.inf
+        self.next_stats = time.monotonic() + STATS_INTERVAL
+
+        self.fd_paths = {}
+        self.out_fd_paths = {}  # fifo paths, for finishing cut short frames.
+        for path in paths:
+            for fd in path.fds:
+                self.fd_paths[fd] = path
+            if path.out_fd is not None:
+                self.out_fd_paths[path.out_fd] = path
+
+    def register(self, now):
+        # Send anything to the IPOW server so it knows where to send data to.
+        if now < self.next_register:
+            return
+        try:
+            self.tun_outbound.sendto(b"hi", self.tun_outbound_path)
+        except OSError as e:
+            logger.info(f"Can't register with IPOW: {e}")
+        self.next_register = now + REGISTER_INTERVAL
+
+    def pick_path(self, key, now):
+        # A flow moves only when its path goes down, or when a path comes up
+        # (and with rendezvous hashing only the flows which belong on that
+        # path move, e.g. back to where they were before a failover).
+        flow = self.flows.get(key)
+        if (flow and flow[0].up and flow[2] == self.generation and
+                now - flow[1] < FLOW_TIMEOUT):
+            flow[1] = now
+            return flow[0]
+
+        paths = [path for path in self.paths if path.up]
+        if not paths:
+            # Nothing confirmed to work (yet), try whatever is there.
+            paths = [path for path in self.paths if path.connected()]
+        if not paths:
+            return None
+
+        # Weighted rendezvous hashing.
+        path = max(
+            paths,
+            key=lambda path: path.capacity(now) / -math.log(flow_hash(key, path.name))
+        )
+        self.flows[key] = [path, now, self.generation]
+        return path
+
+    def from_ipow(self, now):
+        if self.ring:
+            for packet in self.ring.receive():
+                self.to_path(packet, now)
+            self.ring.release()
+            return
+        self.to_path(self.tun_outbound.recv(MAX_PACKET_SIZE), now)
+
+    def to_path(self, packet, now):
+        path = self.pick_path(flow_key(packet), now)
+        if path is None:
+            logger.debug(f"Dropping {len(packet)} bytes, no path")
+            return
+        logger.debug(f"Sending {len(packet)} bytes over {path.name}")
+        path.send(packet)
+
+    def from_path(self, path, data, now):
+        frame = data if path.kind == "socket" else unwrap(data)
+
+        if frame and frame[0] == FRAME_PROBE:
+            if len(frame) == struct.calcsize(PROBE_FORMAT):
+                _, seq, sent = struct.unpack(PROBE_FORMAT, frame)
+                path.send_frame(struct.pack(
+                    PROBE_REPLY_FORMAT, FRAME_PROBE_REPLY, seq, sent,
+                    path.rx_bytes
+                ))
+            return
+
+        if frame and frame[0] == FRAME_PROBE_REPLY:
+            if len(frame) == struct.calcsize(PROBE_REPLY_FORMAT):
+                reply = struct.unpack(PROBE_REPLY_FORMAT, frame)
+                if path.probe_replied(now, *reply[1:]):
+                    self.generation += 1
+            return
+
+        logger.debug(f"Received {len(data)} bytes over {path.name}")
+        if self.ring:
+            if not self.ring.send(data):
+                logger.debug(f"Can't pass {len(data)} bytes to IPOW: ring full")
+            return
+        if not self.to_ipow.write(data):
+            logger.debug(f"Can't pass {len(data)} bytes to IPOW")
+
+    def report(self, now):
+        if now < self.next_stats:
+            return
+        self.next_stats = now + STATS_INTERVAL
+
+        for key in [key for key, (_, last, _) in self.flows.items()
+                    if now - last > FLOW_TIMEOUT]:
+            del self.flows[key]
+
+        for path in self.paths:
+            flows = sum(1 for p, _, _ in self.flows.values() if p is path)
+            rtt = f"{path.srtt * 1000:.0f} ms" if path.srtt is not None else "?"
+            logger.info(
+                f"Path {path.name}: {'up' if path.up else 'down'}, RTT {rtt}, "
+                f"capacity {path.capacity(now):.0f} bytes/s, {flows} flows, "
+                f"sent {path.tx_bytes}, received {path.rx_bytes}, "
+                f"dropped {path.dropped}"
+            )
+
+    def run(self):
+        while True:
+            now = time.monotonic()
+            self.register(now)
+            for path in self.paths:
+                path.probe(now)
+            self.report(now)
+
+            timeout = min(
+                [path.next_probe for path in self.paths] +
+                [self.next_register, self.next_stats]
+            ) - now
+            if self.ring:
+                timeout = min(timeout, shmring.POLL_INTERVAL)
+            ipow = self.ring or self.tun_outbound
+            # While IPOW is behind, the paths' data waits where it is.
+            reading = [ipow]
+            if not self.to_ipow.backlogged():
+                reading += list(self.fd_paths)
+            writing = [self.to_ipow] if self.to_ipow.pending() else []
+            writing += [fd for fd, path in self.out_fd_paths.items() if path.unwritten]
+            readable, writable, _ = select.select(
+                reading, writing, [], max(0, min(timeout, PROBE_MIN_INTERVAL))
+            )
+
+            now = time.monotonic()
+            for fd in writable:
+                if fd is self.to_ipow:
+                    self.to_ipow.flush()
+                else:
+                    self.out_fd_paths[fd].flush()
+            if self.ring and ipow not in readable:
+                readable.append(ipow)  # In case a wakeup got lost.
+            for fd in readable:
+                if fd is ipow:
+                    self.from_ipow(now)
+                    continue
+
+                path = self.fd_paths[fd]
+                for data in path.read(fd):
+                    self.from_path(path, data, now)
+
+
+def parse_path(spec):
+    # NAME[:KIND[:RATE]]
+    parts = spec.split(":")
+    name = parts[0]
+    kind = parts[1] if len(parts) > 1 and parts[1] else "socket"
+    rate = float(parts[2]) if len(parts) > 2 else 1000.0
+    if not name or kind not in ("socket", "fifo") or len(parts) > 3:
+        raise argparse.ArgumentTypeError(f"bad path '{spec}'")
+    return name, kind, rate
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="IPOW transport bonding")
+    parser.add_argument("-i", "--tun-outbound", type=str, help="IPOW's outbound socket path", default='/var/run/tun_out.fifo')
+    parser.add_argument("-o", "--tun-inbound", type=str, help="IPOW's inbound socket path", default='/var/run/tun_in.fifo')
+    parser.add_argument("-d", "--directory", type=str, help='Where to create the paths\' sockets/FIFOs', default='/var/run/bond')
+    parser.add_argument("-P", "--path", type=parse_path, action='append', required=True,
+                        help='Path as NAME[:KIND[:RATE]], KIND is socket (ipowd2-like, default) or fifo (ipowd-like), RATE is the expected capacity in bytes/s (default 1000)')
+    parser.add_argument("-r", "--ring", action='store_true', help='Exchange packets with IPOW (ipowd2) through shared memory rings instead of its sockets')
+    args = parser.parse_args()
+
+    logging.basicConfig(
+        level=logging.DEBUG,
+        format='[%(asctime)s] [%(levelname)s] %(funcName)s: %(message)s',
+        datefmt='%Y-%m-%d %H:%M:%S',
+    )
+
+    if not os.path.exists(args.tun_outbound):
+        logger.info(f"IPOW's outbound socket '{args.tun_outbound}' doesn't exist")
+        sys.exit()
+
+    os.makedirs(args.directory, exist_ok=True)
+    paths = [Path(name, kind, rate, args.directory) for name, kind, rate in args.path]
+    for path in paths:
+        logger.info(f"Path {path.name} ({path.kind}, {path.hint:.0f} bytes/s) ready")
+
+    try:
+        Bond(args.tun_outbound, args.tun_inbound, paths, args.ring).run()
+    except KeyboardInterrupt:
+        pass
@@ -0,0 +1,227 @@
+#!/usr/bin/env python3
+# Records everything going between IPOW (ipowd2) and a transport. This
+# registers as IPOW's client, pretends to be IPOW for the transport (like
+# bond.py does for its paths), passes everything through as it is, and writes
+# each packet - with a nanosecond timestamp and its direction - to a pcapng
+# file (see ../pcap.py):
+#
+#   IPOW <-> capture.py <-> <dir>/capture_out, <dir>/capture_in <-> transport
+#
+# e.g.:
+#
+#   capture.py -w audio.pcapng -d /var/run/capture
+#   audio.py -i /var/run/capture/capture_out -o /var/run/capture/capture_in ...
+#
+# With -k fifo the transport gets named pipes instead (capture_out.fifo,
+# capture_in.fifo), for the transports which still use ipowd's FIFOs. What
+# comes from those is cut into packets by the IP headers' length fields.
+#
+# The capture can be looked at with Wireshark/tcpdump, or replayed through a
+# transport with ../loopbench/replay.py.
+import argparse
+import logging
+import os
+import select
+import signal
+import socket
+import stat
+import sys
+import tempfile
+import time
+
+# Shared by all the transports.
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+import framing
+import pcap
+
+MAX_PACKET_SIZE = 20480
+REGISTER_INTERVAL = 10.0  # Re-register with IPOW every now and then.
+FLUSH_INTERVAL = 1.0
+STATS_INTERVAL = 10.0
+
+logger = logging.getLogger("capture")
+
+
+class Capture:
+    def __init__(self, tun_outbound_path, tun_inbound_path, directory, kind,
+                 writer):
+        self.tun_outbound_path = tun_outbound_path
+        self.tun_inbound_path = tun_inbound_path
+        self.kind = kind
+        self.writer = writer
+
+        self.tmp_dir = tempfile.TemporaryDirectory()
+        self.tun_outbound = socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM)
+        self.tun_outbound.bind(f"{self.tmp_dir.name}/tun_outbound_receiver")
+        self.tun_inbound = socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM)
+        self.tun_inbound.setblocking(False)
+
+        # The transport's side.
+        self.client = None
+        self.buffer = b""  # From the FIFO, not a whole packet yet.
+        if kind == "socket":
+            self.out_sock = self.bind(os.path.join(directory, "capture_out"))
+            self.in_sock = self.bind(os.path.join(directory, "capture_in"))
+            self.fds = [self.tun_outbound, self.out_sock, self.in_sock]
+        else:
+            # O_RDWR, so that opening doesn't wait for the other end, and
+            # there's no EOF when the transport restarts.
+            self.out_fd = self.fifo(os.path.join(directory, "capture_out.fifo"))
+            self.in_fd = self.fifo(os.path.join(directory, "capture_in.fifo"))
+            self.fds = [self.tun_outbound, self.in_fd]
+
+        self.next_register = 0
+        self.next_flush = time.monotonic() + FLUSH_INTERVAL
+        self.next_stats = time.monotonic() + STATS_INTERVAL
+        self.counts = {pcap.OUTBOUND: 0, pcap.INBOUND: 0}
+        self.dropped = 0
+
+    @staticmethod
+    def bind(path):
+        if os.path.exists(path):
+            os.unlink(path)
+        s = socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM)
+        s.bind(path)
+        s.setblocking(False)
+        os.chmod(path, 0o666)
+        return s
+
+    @staticmethod
+    def fifo(path):
+        if not os.path.exists(path) or not stat.S_ISFIFO(os.stat(path).st_mode):
+            if os.path.exists(path):
+                os.unlink(path)
+            os.mkfifo(path, 0o666)
+        return os.open(path, os.O_RDWR | os.O_NONBLOCK)
+
+    def register(self, now):
+        # Send anything to the IPOW server so it knows where to send data to.
+        if now < self.next_register:
+            return
+        try:
+            self.tun_outbound.sendto(b"hi", self.tun_outbound_path)
+        except OSError as e:
+            logger.info(f"Can't register with IPOW: {e}")
+        self.next_register = now + REGISTER_INTERVAL
+
+    def record(self, packet, direction):
+        self.writer.write(packet, direction)
+        self.counts[direction] += 1
+        logger.debug("%s: %d bytes", direction, len(packet))
+
+    def from_ipow(self):
+        packet = self.tun_outbound.recv(MAX_PACKET_SIZE)
+        self.record(packet, pcap.OUTBOUND)
+        try:
+            if self.kind == "socket":
+                if self.client is None:
+                    self.dropped += 1
+                    return
+                self.out_sock.sendto(packet, self.client)
+            else:
+                os.write(self.out_fd, packet)
+        except BlockingIOError:
+            self.dropped += 1
+        except (FileNotFoundError, ConnectionRefusedError):
+            logger.info("Transport went away")
+            self.client = None
+            self.dropped += 1
+
+    def to_ipow(self, packet):
+        self.record(packet, pcap.INBOUND)
+        try:
+            self.tun_inbound.sendto(packet, self.tun_inbound_path)
+        except OSError as e:
+            logger.info(f"Can't send to IPOW: {e}")
+            self.dropped += 1
+
+    def from_fifo(self):
+        try:
+            self.buffer += os.read(self.in_fd, MAX_PACKET_SIZE)
+        except BlockingIOError:
+            return
+        while True:
+            length = framing.packet_length(self.buffer)
+            if length is None or len(self.buffer) < length:
+                return
+            if length == 0:
+                # Not a packet; pass it on as it is (IPOW will make of it
+                # what it will), just don't record it.
+                self.tun_inbound.sendto(self.buffer, self.tun_inbound_path)
+                self.buffer = b""
+                return
+            self.to_ipow(self.buffer[:length])
+            self.buffer = self.buffer[length:]
+
+    def report(self, now):
+        if now < self.next_stats:
+            return
+        self.next_stats = now + STATS_INTERVAL
+        logger.info(
+            f"Recorded {self.counts[pcap.OUTBOUND]} packets out, "
+            f"{self.counts[pcap.INBOUND]} in, dropped {self.dropped}"
+        )
+
+    def run(self):
+        while True:
+            now = time.monotonic()
+            self.register(now)
+            if now >= self.next_flush:
+                self.writer.flush()
+                self.next_flush = now + FLUSH_INTERVAL
+            self.report(now)
+
+            timeout = min(self.next_register, self.next_flush, self.next_stats) - now
+            readable, _, _ = select.select(self.fds, [], [], max(0, timeout))
+
+            for fd in readable:
+                try:
+                    if fd is self.tun_outbound:
+                        self.from_ipow()
+                    elif self.kind == "fifo":
+                        self.from_fifo()
+                    elif fd is self.out_sock:
+                        # The transport telling us where to send the data to.
+                        _, self.client = self.out_sock.recvfrom(MAX_PACKET_SIZE)
+                        logger.info("Transport registered")
+                    else:
+                        self.to_ipow(self.in_sock.recv(MAX_PACKET_SIZE))
+                except BlockingIOError:
+                    pass
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="IPOW traffic capture")
+    parser.add_argument("-w", "--write", type=str, help="pcapng file to write", required=True)
+    parser.add_argument("-i", "--tun-outbound", type=str, help="IPOW's outbound socket path", default='/var/run/tun_out.fifo')
+    parser.add_argument("-o", "--tun-inbound", type=str, help="IPOW's inbound socket path", default='/var/run/tun_in.fifo')
+    parser.add_argument("-d", "--directory", type=str, help="Where to create the transport's sockets/FIFOs", default='/var/run/capture')
+    parser.add_argument("-k", "--kind", type=str, choices=["socket", "fifo"], help="What the transport uses: socket (ipowd2-like, default) or fifo (ipowd-like)", default="socket")
+    parser.add_argument('-v', '--verbose', action='store_true', help='Log every packet')
+    args = parser.parse_args()
+
+    logging.basicConfig(
+        level=logging.DEBUG if args.verbose else logging.INFO,
+        format='[%(asctime)s] [%(levelname)s] %(funcName)s: %(message)s',
+        datefmt='%Y-%m-%d %H:%M:%S',
+    )
+
+    if not os.path.exists(args.tun_outbound):
+        logger.info(f"IPOW's outbound socket '{args.tun_outbound}' doesn't exist")
+        sys.exit()
+
+    os.makedirs(args.directory, exist_ok=True)
+    writer = pcap.Writer(args.write)
+    capture = Capture(args.tun_outbound, args.tun_inbound, args.directory,
+                      args.kind, writer)
+    logger.info(f"Capturing to {args.write}, transport's side in {args.directory} ({args.kind})")
+
+    # SIGTERM too, so that whatever's buffered makes it to the file.
+    signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit())
+    try:
+        capture.run()
+    except (KeyboardInterrupt, SystemExit):
+        pass
+    finally:
+        writer.close()
+        logger.info(f"{writer.packets} packets written to {args.write}")
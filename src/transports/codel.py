@@ -0,0 +1,237 @@
+# Outbound packet queue for the transports: a byte budget instead of an item
+# count, and CoDel (RFC 8289) to keep the queueing delay bounded.
+#
+# put() never blocks - if the packet doesn't fit into the byte budget, the
+# oldest packets are dropped to make room (they're the most stale anyway).
+# get() drops packets which spent too long in the queue: once the sojourn time
+# stays above TARGET for a whole INTERVAL, packets are dropped at an
+# increasing rate (INTERVAL / sqrt(drops)) until it goes back below TARGET.
+# TCP sees the drops and slows down, so interactive traffic doesn't end up
+# waiting behind seconds of bulk data.
+#
+# The default timings are a lot longer than the RFC's 5 ms / 100 ms, as the
+# links we're dealing with do a few packets per second at best.
+import collections
+import math
+import queue
+import threading
+import time
+
+import metrics
+
+MAX_BYTES = 16384
+TARGET = 0.2  # Seconds.
+INTERVAL = 2.0  # Seconds.
+MTU = 1500
+STATS_INTERVAL = 10.0  # Seconds.
+
+
+class CoDelQueue:
+    def __init__(self, max_bytes=MAX_BYTES, target=TARGET, interval=INTERVAL,
+                 logger=None, name=None):
+        self.max_bytes = max_bytes
+        self.target = target
+        self.interval = interval
+        self.logger = logger
+        self.name = f"Queue ({name})" if name else "Queue"
+
+        self.packets = collections.deque()  # (enqueue time, data)
+        self.bytes = 0
+        self.lock = threading.Condition()
+
+        # CoDel state.
+        self.first_above_time = 0
+        self.drop_next = 0
+        self.count = 0
+        self.last_count = 0
+        self.dropping = False
+
+        # Statistics (since the last report).
+        self.stats_time = time.monotonic()
+        self.delivered = 0
+        self.dropped = 0
+        self.overflows = 0
+        self.delay_total = 0
+        self.delay_max = 0
+
+        # The same, for metrics.py (never reset).
+        queue_name = name or "default"
+        self.dropped_counter = metrics.counter(
+            "ipow_queue_dropped_total", "Packets dropped by the outbound queue",
+            queue=queue_name, reason="delay"
+        )
+        self.overflows_counter = metrics.counter(
+            "ipow_queue_dropped_total", "Packets dropped by the outbound queue",
+            queue=queue_name, reason="full"
+        )
+        self.delay_histogram = metrics.histogram(
+            "ipow_queue_delay_seconds", "Time spent in the outbound queue",
+            queue=queue_name
+        )
+        metrics.gauge(
+            "ipow_queue_packets", "Packets waiting in the outbound queue",
+            self.qsize, queue=queue_name
+        )
+        metrics.gauge(
+            "ipow_queue_bytes", "Bytes waiting in the outbound queue",
+            lambda: self.bytes, queue=queue_name
+        )
+
+    def __len__(self):
+        return len(self.packets)
+
+    def qsize(self):
+        return len(self.packets)
+
+    def empty(self):
+        return not self.packets
+
+    def put(self, data):
+        # Returns False if the packet didn't fit even in an empty queue.
+        with self.lock:
+            if len(data) > self.max_bytes:
+                self.overflows += 1
+                self.overflows_counter.inc()
+                return False
+
+            while self.bytes + len(data) > self.max_bytes:
+                _, dropped = self.packets.popleft()
+                self.bytes -= len(dropped)
+                self.overflows += 1
+                self.overflows_counter.inc()
+
+            self.packets.append((time.monotonic(), data))
+            self.bytes += len(data)
+            self.lock.notify()
+            return True
+
+    def put_nowait(self, data):
+        return self.put(data)
+
+    def get(self, block=True, timeout=None):
+        # Same as queue.Queue's get(), i.e. raises queue.Empty.
+        deadline = None if timeout is None else time.monotonic() + timeout
+
+        with self.lock:
+            while True:
+                if self.packets:
+                    data = self.dequeue()
+                    if data is not None:
+                        return data
+                    continue  # Everything got dropped.
+
+                if not block:
+                    raise queue.Empty
+
+                if deadline is None:
+                    self.lock.wait()
+                else:
+                    remaining = deadline - time.monotonic()
+                    if remaining <= 0:
+                        raise queue.Empty
+                    self.lock.wait(remaining)
+
+    def get_nowait(self):
+        return self.get(block=False)
+
+    def pop(self, now):
+        # Returns ((enqueue time, data), ok_to_drop), or (None, False) if the
+        # queue is empty.
+        if not self.packets:
+            self.first_above_time = 0
+            return None, False
+
+        enqueued, data = self.packets.popleft()
+        self.bytes -= len(data)
+
+        sojourn = now - enqueued
+        ok_to_drop = False
+        if sojourn < self.target or self.bytes <= MTU:
+            self.first_above_time = 0
+        elif self.first_above_time == 0:
+            self.first_above_time = now + self.interval
+        elif now >= self.first_above_time:
+            ok_to_drop = True
+
+        return (enqueued, data), ok_to_drop
+
+    def control_law(self, t):
+        return t + self.interval / math.sqrt(self.count)
+
+    def dequeue(self):
+        # CoDel's dequeue (RFC 8289, section 5). Returns None if the queue got
+        # empty because of the drops.
+        now = time.monotonic()
+        packet, ok_to_drop = self.pop(now)
+
+        if self.dropping:
+            if not ok_to_drop:
+                self.dropping = False
+            while self.dropping and now >= self.drop_next:
+                self.dropped += 1
+                self.dropped_counter.inc()
+                self.count += 1
+                packet, ok_to_drop = self.pop(now)
+                if not ok_to_drop:
+                    self.dropping = False
+                else:
+                    self.drop_next = self.control_law(self.drop_next)
+
+        elif ok_to_drop:
+            self.dropped += 1
+            self.dropped_counter.inc()
+            packet, ok_to_drop = self.pop(now)
+            self.dropping = True
+            delta = self.count - self.last_count
+            if delta > 1 and now - self.drop_next < 16 * self.interval:
+                self.count = delta
+            else:
+                self.count = 1
+            self.drop_next = self.control_law(now)
+            self.last_count = self.count
+
+        if packet is None:
+            return None
+
+        enqueued, data = packet
+        delay = now - enqueued
+        self.delivered += 1
+        self.delay_total += delay
+        self.delay_max = max(self.delay_max, delay)
+        self.delay_histogram.observe(delay)
+        self.report(now)
+        return data
+
+    def stats(self):
+        # Queue delay statistics since the last report.
+        return {
+            "queued": len(self.packets),
+            "queued_bytes": self.bytes,
+            "delivered": self.delivered,
+            "dropped": self.dropped,
+            "overflows": self.overflows,
+            "delay_avg": (
+                self.delay_total / self.delivered if self.delivered else 0
+            ),
+            "delay_max": self.delay_max,
+        }
+
+    def report(self, now):
+        if not self.logger or now - self.stats_time < STATS_INTERVAL:
+            return
+
+        stats = self.stats()
+        self.logger.info(
+            f"{self.name}: {stats['queued']} packets "
+            f"({stats['queued_bytes']} bytes) waiting, {stats['delivered']} sent, {stats['dropped']} dropped "
+            f"(delay), {stats['overflows']} dropped (full), delay avg "
+            f"{stats['delay_avg'] * 1000:.0f} ms, max "
+            f"{stats['delay_max'] * 1000:.0f} ms"
+        )
+
+        self.stats_time = now
+        self.delivered = 0
+        self.dropped = 0
+        self.overflows = 0
+        self.delay_total = 0
+        self.delay_max = 0
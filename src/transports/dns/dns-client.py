@@ -3,7 +3,6 @@
 import os
 import select
 import threading
-from scapy.all import *
 import argparse
 import logging
 import queue
@@ -12,37 +11,66 @@ import time
 import dns.resolver
 import re
 import random
-import traceback
 
-MAX_QUEUE_SIZE=1472
+# Shared by all the transports.
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+import codel
+import framing
+import hdrcomp
+import ipowwriter
+import lanes
+import metrics
+import tracing
+
 MAX_DOMAIN_LENGTH=128
 MAX_SUBDOMAIN_LENGTH=32
 
 logger = logging.getLogger("dns-client")
 
-fifo_queue = queue.Queue(maxsize=MAX_QUEUE_SIZE)
+# Outbound packets, interactive ones first; never blocks the FIFO reader,
+# drops what waited too long.
+fifo_queue = lanes.LaneQueue(logger=logger)
+
+compressor = None
+decompressor = hdrcomp.HeaderDecompressor()
+
+stats = metrics.LinkMetrics()
+polls_data = metrics.counter("ipow_polls_total", "Polls (requests) whose reply carried data, or not", result="data")
+polls_empty = metrics.counter("ipow_polls_total", "Polls (requests) whose reply carried data, or not", result="empty")
+poll_seconds = metrics.histogram("ipow_poll_seconds", "Time until a poll got its reply")
+fifo_opens = metrics.counter("ipow_fifo_opens_total", "Times the inbound FIFO was (re)opened")
 
-def handle_dns(mode_in, mode_out, server, domain, fifo_out, keep_alive):
+def handle_dns(mode_in, mode_out, server, port, domain, fifo_out, keep_alive):
     serial = random.randint(1000000, 9999999)
     no = 0
 
     resolver = dns.resolver.Resolver()
     resolver.nameservers = [server]
+    resolver.port = port
 
     if mode_out:
-        fifo_out_fd = os.open(fifo_out, os.O_WRONLY)
+        ipow = ipowwriter.IPOWWriter(fifo_out, logger=logger, background=True)
 
     last_empty = True
 
     while True:
+        if mode_out and ipow.backlogged():
+            # No more polls (and so no more data) until IPOW takes what's
+            # there.
+            ipow.wait(ipowwriter.HOLD_OFF)
 
+        packet = None
         if mode_in:
             try:
-                data = fifo_queue.get(block=last_empty, timeout=keep_alive)
+                data = packet = fifo_queue.get(block=last_empty, timeout=keep_alive)
                 last_empty = False
-                logger.info(f"Received {len(data)} from queue")
+                logger.debug("Received %d from queue", len(data))
+                tracing.mark("dequeued", packet)
+                if compressor:
+                    data = compressor.compress(data)
+                stats.sent(data)
             except queue.Empty:
-                logger.info(f"Queue empty")
+                logger.debug("Queue empty")
                 last_empty = True
                 data = b""
         else:
@@ -52,6 +80,8 @@ def handle_dns(mode_in, mode_out, server, domain, fifo_out, keep_alive):
         data = data.hex()
         if data == '':
             data = 'ZZ'
+        if packet:
+            tracing.mark("encoded", packet)
 
         try:
             chunks = [data[i:i + MAX_DOMAIN_LENGTH] for i in range(0, len(data), MAX_DOMAIN_LENGTH)]
@@ -61,23 +91,39 @@ def handle_dns(mode_in, mode_out, server, domain, fifo_out, keep_alive):
                 subdomain = '.'.join(chunk[i:i+MAX_SUBDOMAIN_LENGTH] for i in range(0, len(chunk), MAX_SUBDOMAIN_LENGTH))
                 query_domain = f"{no}.{serial}.{domain}"
                 query_domain = subdomain.strip('.') + '.' + query_domain
-                print(f"Resolving {query_domain}")
-                answers = resolver.resolve(query_domain)
+                logger.debug("Resolving %s", query_domain)
+                if packet:
+                    tracing.mark("sent", packet)
+                started = time.monotonic()
+                # TXT, as that's what the server puts the data in (and only
+                # then looks at what we sent).
+                answers = resolver.resolve(query_domain, 'TXT')
+                poll_seconds.observe(time.monotonic() - started)
+                if packet:
+                    tracing.mark("reply", packet)
                 for a in answers:
                     if a.rdtype.value == 16:
                         records.append(str(a))
                 records.sort()
+                got_data = False
                 for r in records:
-                    re.sub(r'^\d+\.', '', r)
+                    r = re.sub(r'^\d+\.', '', r.strip('"'))
                     try:
-                        b = bytes.fromhex(r)
-                        os.wrte(fifo_out_fd, b)
-                    except Exception as e:
-                        print(traceback.format_exc())
-
-
-        except Exception as e:
-            print(traceback.format_exc())
+                        b = decompressor.decompress(bytes.fromhex(r))
+                        if b:
+                            got_data = True
+                            stats.received(b)
+                            tracing.mark("received", b)
+                            if mode_out:
+                                ipow.write(b)
+                                tracing.mark("ipow_out", b)
+                    except Exception:
+                        logger.exception(f"Can't decode record {r}")
+                (polls_data if got_data else polls_empty).inc()
+
+
+        except Exception:
+            logger.exception(f"Poll #{no} failed")
 
 def handle_fifo(mode_in, mode_out, fifo_in):
     if not mode_in:
@@ -86,20 +132,25 @@ def handle_fifo(mode_in, mode_out, fifo_in):
     while True:
         try:
             fifo_fd = os.open(fifo_in, os.O_RDONLY | os.O_NONBLOCK)
-            print(fifo_fd)
+            splitter = framing.Splitter()
+            logger.info(f"FIFO {fifo_in} opened for reading (in)")
+            fifo_opens.inc()
             while True:
-                #r, r1, r2 = select.select([fifo_fd], [], [])
-                r, r1, r2 = select([fifo_fd], [], [])
+                r, r1, r2 = select.select([fifo_fd], [], [])
                 if r:
                     data = os.read(fifo_fd, 1024)
                     if data:
-                        logger.info(f"Received '{len(data)} from fifo_in")
-                        fifo_queue.put(data)
+                        logger.debug("Received %d from fifo_in", len(data))
+                        # Whole packets into the queue, the lanes and drops
+                        # work on packets.
+                        for packet in splitter.feed(data):
+                            tracing.mark("ipow_in", packet)
+                            fifo_queue.put(packet)
                     else:
                         os.close(fifo_fd)
                         break
-        except OSError:
-            print("os error")
+        except OSError as e:
+            logger.warning(f"FIFO {fifo_in}: {e}")
             continue
 
 if __name__ == "__main__":
@@ -109,18 +160,36 @@ if __name__ == "__main__":
     parser.add_argument("-m", "--mode", type=str, help='Mode: in/out/inout', default='inout')
     parser.add_argument('-d', '--domain', type=str, help='Domain to resolve', required=True)
     parser.add_argument('-s', '--server', type=str, help='Remote DNS server', required=True)
+    parser.add_argument('-P', '--server-port', type=int, help='Remote DNS server port (default 53)', default=53)
     parser.add_argument('-k', '--keep-alive', type=float, help='Keep alive in seconds (default 1.0)', default=1.0)
+    parser.add_argument('-z', '--compress-headers', action='store_true', help='Compress IPv4/TCP/UDP/ICMP headers (the other side always decompresses)')
+    parser.add_argument('--queue-bytes', type=int, help=f'Outbound queue size in bytes (default {codel.MAX_BYTES})', default=codel.MAX_BYTES)
+    parser.add_argument('--queue-target', type=float, help=f'Outbound queue delay target in seconds (default {codel.TARGET})', default=codel.TARGET)
+    parser.add_argument('-v', '--verbose', action='store_true', help='Log every packet')
+    parser.add_argument('--metrics', type=str, help='Serve metrics on this UNIX socket path or [host:]port (HTTP)')
+    parser.add_argument('--trace', type=str, help='Trace packets through the stages into this file (.json: Chrome trace format; written on exit and SIGUSR1)')
     args = parser.parse_args()
 
     logging.basicConfig(
-        level=logging.DEBUG,
+        level=logging.DEBUG if args.verbose else logging.INFO,
         format='[%(asctime)s] [%(levelname)s] %(funcName)s: %(message)s',
         datefmt='%Y-%m-%d %H:%M:%S',
     )
 
+    if args.metrics:
+        metrics.serve(args.metrics, "dns-client")
+
+    if args.trace:
+        tracing.start(args.trace, "dns-client")
+
     mode_in = args.mode.lower().find('i') != -1
     mode_out = args.mode.lower().find('o') != -1
 
+    fifo_queue.configure(args.queue_bytes, args.queue_target)
+
+    if args.compress_headers:
+        compressor = hdrcomp.HeaderCompressor()
+
     if mode_in:
         if not os.path.exists(args.fifo_in):
             logger.info(f"Fifo in '{args.fifo_in}' doesn't exist")
@@ -132,7 +201,7 @@ if __name__ == "__main__":
             sys.exit()
 
 
-    dns_thread = threading.Thread(target=handle_dns, args=(mode_in, mode_out, args.server, args.domain, args.fifo_out, args.keep_alive))
+    dns_thread = threading.Thread(target=handle_dns, args=(mode_in, mode_out, args.server, args.server_port, args.domain, args.fifo_out, args.keep_alive))
     fifo_thread = threading.Thread(target=handle_fifo, args=(mode_in, mode_out, args.fifo_in,))
 
     dns_thread.start()
@@ -3,36 +3,58 @@
 import os
 import select
 import threading
-from scapy.all import *
+# Only what's used, scapy.all takes seconds (and a lot of memory) to import.
+from scapy.layers.dns import DNS, DNSQR, DNSRR
+from scapy.layers.inet import IP, UDP
+from scapy.sendrecv import send, sniff
 import argparse
 import logging
 import queue
 import sys
 import re
 
-MAX_QUEUE_SIZE=1472
+# Shared by all the transports.
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+import codel
+import framing
+import hdrcomp
+import ipowwriter
+import lanes
+import metrics
+import tracing
+
 MAX_TXT_RECORD=200
 
 logger = logging.getLogger("dns-listener")
 
-fifo_queue = queue.Queue(maxsize=MAX_QUEUE_SIZE)
+# Outbound packets, interactive ones first; never blocks the FIFO reader,
+# drops what waited too long.
+fifo_queue = lanes.LaneQueue(logger=logger)
+
+compressor = None
+decompressor = hdrcomp.HeaderDecompressor()
+
+stats = metrics.LinkMetrics()
+replies_data = metrics.counter("ipow_replies_total", "Replies which carried data, or not", result="data")
+replies_empty = metrics.counter("ipow_replies_total", "Replies which carried data, or not", result="empty")
+fifo_opens = metrics.counter("ipow_fifo_opens_total", "Times the inbound FIFO was (re)opened")
 
 def handle_dns(server_ip, mode, fifo_out):
     mode_in = mode.lower().find('i') != -1
     mode_out = mode.lower().find('o') != -1
 
-    fifo_out_fd = None
+    ipow = None
 
     if mode_out:
         if not os.path.exists(fifo_out):
             logger.info(f"Fifo out '{fifo_out}' doesn't exist")
             return
-        fifo_out_fd = os.open(fifo_out, os.O_WRONLY)
+        ipow = ipowwriter.IPOWWriter(fifo_out, logger=logger, background=True)
         logger.info(f"FIFO {fifo_out} opened for writing (out)")
 
-    sniff(filter=f"udp and port 53 and ip dst {server_ip}", prn=handle_dns_reply(mode, fifo_out_fd))
+    sniff(filter=f"udp and port 53 and ip dst {server_ip}", prn=handle_dns_reply(mode, ipow))
 
-def handle_dns_reply(mode, fifo_out_fd):
+def handle_dns_reply(mode, ipow):
     mode_in = mode.lower().find('i') != -1
     mode_out = mode.lower().find('o') != -1
 
@@ -40,7 +62,7 @@ def handle_dns_reply(mode, fifo_out_fd):
         if qtype == 1:  # 1 oznacza rekord typu A
             return DNSRR(rrname=qname, type='A', ttl=10, rdata='127.0.0.1')
         elif qtype == 16:  # 16 oznacza rekord typu TXT
-            print(f"query for: {qname}")
+            logger.debug("Query for: %s", qname)
             data = b""
 
             if mode_out:
@@ -51,21 +73,35 @@ def handle_dns_reply(mode, fifo_out_fd):
                         payload = payload.replace('.', '')
                         if payload and payload.upper() != 'ZZ':
                             try:
-                                payload_decoded = bytes.fromhex(payload)
-                                os.write(fifo_out_fd, payload_decoded)
+                                payload_decoded = decompressor.decompress(bytes.fromhex(payload))
+                                if payload_decoded:
+                                    stats.received(payload_decoded)
+                                    tracing.mark("received", payload_decoded)
+                                    ipow.write(payload_decoded, wait=ipowwriter.HOLD_OFF)
+                                    tracing.mark("ipow_out", payload_decoded)
+                                    if ipow.backlogged():
+                                        # Holds up the replies (and so the
+                                        # client's next polls) for a bit.
+                                        ipow.wait(ipowwriter.HOLD_OFF)
                             except Exception as e:
                                 print(f"Can't decode {payload} from hex")
                                 print(e)
                         else:
-                            print(f"Got ZZ ({payload})")
+                            logger.debug("Got ZZ (%s)", payload)
 
             if mode_in:
                 try:
-                    data = fifo_queue.get_nowait()
+                    data = packet = fifo_queue.get_nowait()
+                    tracing.mark("dequeued", packet)
+                    if compressor:
+                        data = compressor.compress(data)
+                    stats.sent(data)
+                    tracing.mark("encoded", packet)
                 except queue.Empty:
                     data = b""
 
-            print(f"data len: {len(data)}")
+            (replies_data if data else replies_empty).inc()
+            logger.debug("Data len: %d", len(data))
             data = '1.' + ''.join(f'{byte:02x}' for byte in data)
 
             return DNSRR(rrname=qname, type='TXT', ttl=10, rdata=data)
@@ -77,7 +113,7 @@ def handle_dns_reply(mode, fifo_out_fd):
             qname = pkt[DNSQR].qname.decode('ascii')
             qtype = pkt[DNSQR].qtype
 
-            print(f"Received DNS query for {qname} (Type {qtype}) from {pkt[IP].src}")
+            logger.debug("Received DNS query for %s (Type %s) from %s", qname, qtype, pkt[IP].src)
 
             dns_response = create_dns_response(qname, qtype)
 
@@ -97,13 +133,19 @@ def handle_fifo(fifo_in):
     while True:
         try:
             fifo_fd = os.open(fifo_in, os.O_RDONLY | os.O_NONBLOCK)
+            splitter = framing.Splitter()
+            fifo_opens.inc()
             while True:
                 r, _, _ = select.select([fifo_fd], [], [])
                 if r:
                     data = os.read(fifo_fd, 1024)
                     if data:
-                        logger.info(f"Received '{len(data)} from fifo_in")
-                        fifo_queue.put(data)
+                        logger.debug("Received %d from fifo_in", len(data))
+                        # Whole packets into the queue, the lanes and drops
+                        # work on packets.
+                        for packet in splitter.feed(data):
+                            tracing.mark("ipow_in", packet)
+                            fifo_queue.put(packet)
                     else:
                         os.close(fifo_fd)
                         break
@@ -117,17 +159,34 @@ if __name__ == "__main__":
     parser.add_argument("-i", "--fifo-in", type=str, help='FIFO in', default='/var/run/tun_out.fifo')
     parser.add_argument("-o", "--fifo-out", type=str, help='FIFO out', default='/var/run/tun_in.fifo')
     parser.add_argument("-m", "--mode", type=str, help='Mode: in/out/inout', default='inout')
+    parser.add_argument("-z", "--compress-headers", action='store_true', help='Compress IPv4/TCP/UDP/ICMP headers (the other side always decompresses)')
+    parser.add_argument('--queue-bytes', type=int, help=f'Outbound queue size in bytes (default {codel.MAX_BYTES})', default=codel.MAX_BYTES)
+    parser.add_argument('--queue-target', type=float, help=f'Outbound queue delay target in seconds (default {codel.TARGET})', default=codel.TARGET)
+    parser.add_argument('-v', '--verbose', action='store_true', help='Log every packet')
+    parser.add_argument('--metrics', type=str, help='Serve metrics on this UNIX socket path or [host:]port (HTTP)')
+    parser.add_argument('--trace', type=str, help='Trace packets through the stages into this file (.json: Chrome trace format; written on exit and SIGUSR1)')
     args = parser.parse_args()
 
     logging.basicConfig(
-        level=logging.DEBUG,
+        level=logging.DEBUG if args.verbose else logging.INFO,
         format='[%(asctime)s] [%(levelname)s] %(funcName)s: %(message)s',
         datefmt='%Y-%m-%d %H:%M:%S',
     )
 
+    if args.metrics:
+        metrics.serve(args.metrics, "dns-server")
+
+    if args.trace:
+        tracing.start(args.trace, "dns-server")
+
     mode_in = args.mode.lower().find('i') != -1
     mode_out = args.mode.lower().find('o') != -1
 
+    fifo_queue.configure(args.queue_bytes, args.queue_target)
+
+    if args.compress_headers:
+        compressor = hdrcomp.HeaderCompressor()
+
     if mode_in:
         if not os.path.exists(args.fifo_in):
             logger.info(f"Fifo in '{args.fifo_in}' doesn't exist")
@@ -138,7 +197,7 @@ if __name__ == "__main__":
             logger.info(f"Fifo out '{args.fifo_out}' doesn't exist")
             sys.exit()
 
-    dns_thread = threading.Thread(target=handle_dns, args=(args.interface, args.mode, args.fifo_out))
+    dns_thread = threading.Thread(target=handle_dns, args=(args.dns_server_ip, args.mode, args.fifo_out))
     fifo_thread = threading.Thread(target=handle_fifo, args=(args.fifo_in,))
 
     dns_thread.start()
@@ -0,0 +1,61 @@
+# Cutting ipowd's FIFO stream - which, being a pipe, doesn't keep packet
+# boundaries - into the IP packets it's made of, by their own headers: the
+# IPv4 header checksum and total length, or what there is of that in IPv6.
+import hdrcomp
+
+MAX_LENGTH = 9000  # Longer "packets" are taken as garbage.
+
+# Hop-by-hop, TCP, UDP, routing, fragment, ESP, AH, ICMPv6, none, options.
+IPV6_NEXT_HEADERS = {0, 6, 17, 43, 44, 50, 51, 58, 59, 60}
+
+
+def packet_length(buffer):
+    # Length of the IP packet at the start of buffer, None if there isn't
+    # enough of it yet, 0 if it's not an IP packet at all.
+    if len(buffer) < 20:
+        return None
+    version = buffer[0] >> 4
+    if version == 4:
+        header = (buffer[0] & 0x0f) * 4
+        length = int.from_bytes(buffer[2:4], "big")
+        if header < 20 or not header <= length <= MAX_LENGTH:
+            return 0
+        if len(buffer) < header:
+            return None
+        return length if hdrcomp.checksum(buffer[:header]) == 0 else 0
+    if version == 6:
+        # No checksum to go by, so at least the length and next header
+        # have to make sense.
+        if len(buffer) < 40:
+            return None
+        length = 40 + int.from_bytes(buffer[4:6], "big")
+        if length > MAX_LENGTH or buffer[6] not in IPV6_NEXT_HEADERS:
+            return 0
+        return length
+    return 0
+
+
+class Splitter:
+    # Cuts the stream into packets for whatever needs whole packets
+    # (lanes.py's classifier, the queues' drops) and not just the right bytes
+    # in the right order.
+    def __init__(self):
+        self.buffer = b""
+
+    def feed(self, data):
+        # Returns the packets completed by data. Anything that's not a packet
+        # comes out as it is, with everything after it (there's no telling
+        # where the next packet starts).
+        self.buffer += data
+        packets = []
+        while True:
+            length = packet_length(self.buffer)
+            if length is None or len(self.buffer) < length:
+                break
+            if length == 0:
+                packets.append(self.buffer)
+                self.buffer = b""
+                break
+            packets.append(self.buffer[:length])
+            self.buffer = self.buffer[length:]
+        return packets
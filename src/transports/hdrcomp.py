@@ -0,0 +1,472 @@
+# Header compression for low-bandwidth transports, loosely modelled after
+# ROHC's unidirectional mode (RFC 3095, RFC 6846).
+#
+# The compressor keeps a context for each flow (IPv4 + TCP, UDP or ICMP echo)
+# and, once the other side knows the context, only sends what changed:
+#
+#   IR packet:  [0xc0 | cid] [msn (2 bytes)] [the whole packet]
+#   CO packet:  [0x80 | cid] [msn (4 bits) | CRC (4 bits)] [size codes] [fields]
+#               [checksum (2 bytes)] [TCP options (if not the usual ones)]
+#               [payload]
+#
+# Anything else (i.e. IPv4/IPv6 packets which can't be compressed) is sent as
+# is - it always starts with 0x4? or 0x6?, so a decompressor can tell.
+#
+# The dynamic fields (IP ID, TCP seq/ack/window/flags/timestamps, ICMP seq)
+# are sent as their least significant bits, just enough for the decompressor
+# to figure out the value from any of the last WINDOW values the compressor
+# sent (W-LSB). So losing up to WINDOW - 1 packets in a row doesn't break the
+# context. IP total length, IP checksum and UDP length are recomputed; the
+# TCP/UDP/ICMP checksum is always sent, which (along with a 4-bit CRC of the
+# headers) lets the decompressor verify what it rebuilt. If that fails, the context is dropped until the compressor
+# refreshes it with an IR packet (which it does for new flows, every
+# IR_REFRESH packets and after IR_IDLE seconds of a flow being idle).
+import collections
+import struct
+import time
+import zlib
+
+MAX_CONTEXTS = 64
+WINDOW = 4
+IR_REPEAT = 2
+IR_REFRESH = 64
+IR_IDLE = 5.0
+
+PACKET_CO = 0x80
+PACKET_IR = 0xc0
+PACKET_TYPE_MASK = 0xc0
+CID_MASK = 0x3f
+
+PROTO_ICMP = 1
+PROTO_TCP = 6
+PROTO_UDP = 17
+
+IP_HEADER_SIZE = 20
+TCP_HEADER_SIZE = 20
+UDP_HEADER_SIZE = 8
+ICMP_HEADER_SIZE = 8
+
+TCP_FLAG_SYN = 0x02
+TCP_FLAG_RST = 0x04
+TCP_FLAG_URG = 0x20
+
+TCP_OPTION_END = 0
+TCP_OPTION_NOP = 1
+TCP_OPTION_TIMESTAMP = 8
+
+# How many bytes of LSBs each size code stands for (None - the whole field).
+CODE_SIZES = (0, 1, 2, None)
+
+TIMESTAMP_FIELDS = ("tsval", "tsecr")
+
+
+def checksum(data):
+    if len(data) & 1:
+        data = bytes(data) + b"\0"
+    total = sum(struct.unpack(f"!{len(data) // 2}H", data))
+    while total >> 16:
+        total = (total & 0xffff) + (total >> 16)
+    return ~total & 0xffff
+
+
+def transport_checksum_ok(packet):
+    proto = packet[9]
+    segment = packet[IP_HEADER_SIZE:]
+    if proto == PROTO_ICMP:
+        return checksum(segment) == 0
+    if proto == PROTO_UDP and packet[26:28] == b"\0\0":
+        return True  # No checksum.
+    pseudo_header = packet[12:20] + struct.pack("!BBH", 0, proto, len(segment))
+    return checksum(pseudo_header + segment) == 0
+
+
+def header_crc(header):
+    # The IP ID isn't covered by any checksum, so this is the only way to tell
+    # if it was rebuilt right.
+    return zlib.crc32(header) & 0xf
+
+
+def lsb_fits(value, ref, bits, width):
+    # Can value be decoded from its bits LSBs given ref?
+    if bits == 0:
+        return value == ref
+    offset = 1 << (bits - 3)
+    return ((value - ref + offset) % (1 << width)) < (1 << bits)
+
+
+def lsb_decode(lsbs, ref, bits, width):
+    offset = 1 << (bits - 3)
+    base = (ref - offset) % (1 << width)
+    return (base + ((lsbs - base) % (1 << bits))) % (1 << width)
+
+
+class Flow:
+    # What parse() figured out about a packet.
+    def __init__(self, key, template, fields, options_template, checksum_offset,
+                 header_size):
+        self.key = key
+        self.template = template  # Static parts of the header.
+        self.fields = fields  # [(name, offset, width in bits), ...]
+        self.options_template = options_template
+        self.checksum_offset = checksum_offset
+        self.header_size = header_size
+
+
+def find_timestamp(options):
+    # Returns the offset of the TCP timestamp option, or None.
+    i = 0
+    while i < len(options):
+        kind = options[i]
+        if kind == TCP_OPTION_END:
+            return None
+        if kind == TCP_OPTION_NOP:
+            i += 1
+            continue
+        if i + 1 >= len(options) or options[i + 1] < 2:
+            return None
+        if kind == TCP_OPTION_TIMESTAMP and options[i + 1] == 10:
+            return i
+        i += options[i + 1]
+    return None
+
+
+def parse(packet):
+    # Returns a Flow for packets we know how to compress, None otherwise.
+    if len(packet) < IP_HEADER_SIZE or packet[0] != 0x45:
+        return None  # Not IPv4, or has IP options.
+
+    total_length, flags_fragment = struct.unpack("!H2xH", packet[2:8])
+    if total_length != len(packet) or flags_fragment & 0xbfff:
+        return None  # Truncated/padded, or a fragment.
+
+    proto = packet[9]
+    fields = [("ip_id", 4, 16)]
+    options_template = b""
+    template = bytearray(packet[:IP_HEADER_SIZE])
+    template[2:6] = b"\0\0\0\0"  # Total length, IP ID.
+    template[10:12] = b"\0\0"  # Header checksum.
+
+    if proto == PROTO_TCP:
+        if len(packet) < IP_HEADER_SIZE + TCP_HEADER_SIZE:
+            return None
+        header_size = IP_HEADER_SIZE + (packet[32] >> 4) * 4
+        tcp_flags = packet[33]
+        if (header_size < IP_HEADER_SIZE + TCP_HEADER_SIZE or
+                header_size > len(packet) or tcp_flags & TCP_FLAG_URG):
+            return None
+
+        key = packet[9:10] + packet[12:24]
+        checksum_offset = 36
+        template += packet[20:40]
+        template[24:36] = bytes(12)  # seq, ack, data offset, flags, window.
+        template[32] = packet[32] & 0x0f
+        template[36:38] = b"\0\0"  # Checksum.
+        fields += [
+            ("seq", 24, 32), ("ack", 28, 32), ("flags", 33, 8),
+            ("window", 34, 16),
+        ]
+
+        options = packet[40:header_size]
+        timestamp = find_timestamp(options)
+        options_template = bytearray(options)
+        if timestamp is not None:
+            options_template[timestamp + 2:timestamp + 10] = bytes(8)
+            offset = 40 + timestamp
+            fields += [("tsval", offset + 2, 32), ("tsecr", offset + 6, 32)]
+        options_template = bytes(options_template)
+
+    elif proto == PROTO_UDP:
+        header_size = IP_HEADER_SIZE + UDP_HEADER_SIZE
+        if (len(packet) < header_size or
+                struct.unpack("!H", packet[24:26])[0] != len(packet) - 20):
+            return None
+
+        key = packet[9:10] + packet[12:24]
+        checksum_offset = 26
+        template += packet[20:28]
+        template[24:28] = b"\0\0\0\0"  # Length, checksum.
+
+    elif proto == PROTO_ICMP:
+        header_size = IP_HEADER_SIZE + ICMP_HEADER_SIZE
+        if len(packet) < header_size or packet[20] not in (0, 8):
+            return None  # Only echo request/reply.
+
+        key = packet[9:10] + packet[12:22] + packet[24:26]
+        checksum_offset = 22
+        template += packet[20:28]
+        template[22:24] = b"\0\0"  # Checksum.
+        template[26:28] = b"\0\0"  # Sequence number.
+        fields += [("seq", 26, 16)]
+
+    else:
+        return None
+
+    return Flow(bytes(key), bytes(template), fields, options_template,
+                checksum_offset, header_size)
+
+
+def read_fields(packet, flow, msn):
+    values = {}
+    for name, offset, width in flow.fields:
+        values[name] = int.from_bytes(packet[offset:offset + width // 8], "big")
+    # The IP ID usually goes up by one with every packet, just like the MSN.
+    values["ip_id"] = (values["ip_id"] - msn) & 0xffff
+    return values
+
+
+class CompressorContext:
+    def __init__(self, cid, flow):
+        self.cid = cid
+        self.flow = flow
+        self.last_options = flow.options_template
+        self.msn = 0
+        self.refs = collections.deque(maxlen=WINDOW)
+        self.ir_left = IR_REPEAT
+        self.since_ir = 0
+        self.last_used = time.monotonic()
+
+
+class HeaderCompressor:
+    def __init__(self):
+        self.contexts = collections.OrderedDict()  # Flow key -> context.
+        self.bytes_in = 0
+        self.bytes_out = 0
+
+    def context_for(self, flow):
+        context = self.contexts.get(flow.key)
+        if context is not None:
+            self.contexts.move_to_end(flow.key)
+            if context.flow.template != flow.template:
+                # Something static changed (e.g. TTL), start over.
+                context.flow = flow
+                context.refs.clear()
+                context.ir_left = IR_REPEAT
+            return context
+
+        if len(self.contexts) < MAX_CONTEXTS:
+            used = {context.cid for context in self.contexts.values()}
+            cid = min(set(range(MAX_CONTEXTS)) - used)
+        else:
+            # Reuse the least recently used context.
+            _, old = self.contexts.popitem(last=False)
+            cid = old.cid
+
+        context = CompressorContext(cid, flow)
+        self.contexts[flow.key] = context
+        return context
+
+    def compress(self, packet):
+        self.bytes_in += len(packet)
+        compressed = self.compress_packet(packet)
+        self.bytes_out += len(compressed)
+        return compressed
+
+    def compress_packet(self, packet):
+        flow = parse(packet)
+        if flow is None:
+            return packet
+
+        context = self.context_for(flow)
+        now = time.monotonic()
+        refresh = (now - context.last_used > IR_IDLE or
+                   context.since_ir >= IR_REFRESH)
+        control = (flow.key[0] == PROTO_TCP and
+                   packet[33] & (TCP_FLAG_SYN | TCP_FLAG_RST))
+        # TCP options different than the context's are either a one-off (e.g.
+        # SACK), or the new normal (e.g. after the SYN) once they repeat.
+        new_options = flow.options_template != context.flow.options_template
+        if (control or (refresh and not new_options) or
+                (new_options and
+                 flow.options_template == context.last_options)):
+            context.ir_left = max(context.ir_left, 1)
+        context.last_options = flow.options_template
+        context.last_used = now
+
+        context.msn = (context.msn + 1) & 0xffff
+        values = read_fields(packet, flow, context.msn)
+
+        if context.ir_left:
+            if new_options:
+                # The other side might miss this one, so start over.
+                context.refs.clear()
+                context.ir_left = IR_REPEAT
+            context.ir_left -= 1
+            context.since_ir = 0
+            context.flow = flow
+            context.refs.append(values)
+            return (bytes([PACKET_IR | context.cid]) +
+                    context.msn.to_bytes(2, "big") + packet)
+
+        context.since_ir += 1
+
+        # Unusual TCP options (e.g. SACK) are sent as they are. The timestamps
+        # are then taken from there (if they're there at all).
+        raw_options = flow.options_template != context.flow.options_template
+        fields = context.flow.fields
+
+        codes = 0
+        encoded = bytearray()
+        for name, _, width in fields:
+            if raw_options and name in TIMESTAMP_FIELDS:
+                if name not in values:
+                    values[name] = context.refs[-1][name]
+                codes <<= 2
+                continue
+
+            value = values[name]
+            refs = [ref[name] for ref in context.refs]
+            for code, size in enumerate(CODE_SIZES):
+                if size is None:
+                    size = width // 8
+                    break
+                if size * 8 >= width:
+                    continue
+                if all(lsb_fits(value, ref, size * 8, width) for ref in refs):
+                    break
+            codes = (codes << 2) | code
+            encoded += (value & ((1 << (size * 8)) - 1)).to_bytes(size, "big")
+
+        context.refs.append(values)
+
+        codes_size = (2 * len(fields) + 1 + 7) // 8
+        codes = (codes << 1) | raw_options
+        codes <<= codes_size * 8 - 2 * len(fields) - 1
+
+        compressed = bytearray([
+            PACKET_CO | context.cid,
+            (context.msn & 0xf) << 4 | header_crc(packet[:flow.header_size])
+        ])
+        compressed += codes.to_bytes(codes_size, "big")
+        compressed += encoded
+        compressed += packet[flow.checksum_offset:flow.checksum_offset + 2]
+        if raw_options:
+            options = packet[40:flow.header_size]
+            compressed.append(len(options))
+            compressed += options
+        compressed += packet[flow.header_size:]
+        return bytes(compressed)
+
+
+class DecompressorContext:
+    def __init__(self, flow, msn, values):
+        self.flow = flow
+        self.msn = msn
+        self.values = values
+
+
+class HeaderDecompressor:
+    def __init__(self):
+        self.contexts = {}  # CID -> context.
+        self.dropped = 0
+
+    def decompress(self, data):
+        # Returns the original packet, or None if it had to be dropped (e.g.
+        # because its context is gone).
+        if not data or not data[0] & PACKET_CO:
+            return data  # Not compressed.
+
+        cid = data[0] & CID_MASK
+
+        if data[0] & PACKET_TYPE_MASK == PACKET_IR:
+            msn = int.from_bytes(data[1:3], "big")
+            packet = data[3:]
+            flow = parse(packet)
+            if flow is None:
+                self.dropped += 1
+                return None
+            self.contexts[cid] = DecompressorContext(
+                flow, msn, read_fields(packet, flow, msn)
+            )
+            return packet
+
+        context = self.contexts.get(cid)
+        if context is None:
+            self.dropped += 1
+            return None
+
+        try:
+            packet, header_size, msn, values = self.rebuild(context, data)
+        except (IndexError, ValueError):
+            packet = None
+
+        if (packet is None or not transport_checksum_ok(packet) or
+                header_crc(packet[:header_size]) != data[1] & 0xf):
+            # The context isn't in sync anymore. Wait for an IR packet.
+            del self.contexts[cid]
+            self.dropped += 1
+            return None
+
+        context.msn = msn
+        context.values = values
+        return packet
+
+    def rebuild(self, context, data):
+        flow = context.flow
+        msn = lsb_decode(data[1] >> 4, context.msn, 4, 16)
+        pos = 2
+
+        codes_size = (2 * len(flow.fields) + 1 + 7) // 8
+        codes = int.from_bytes(data[pos:pos + codes_size], "big")
+        pos += codes_size
+        codes >>= codes_size * 8 - 2 * len(flow.fields) - 1
+        raw_options = bool(codes & 1)
+        codes >>= 1
+
+        fields = flow.fields
+        values = dict(context.values)
+        for i, (name, _, width) in enumerate(fields):
+            if raw_options and name in TIMESTAMP_FIELDS:
+                continue  # See below.
+            code = (codes >> (2 * (len(fields) - 1 - i))) & 3
+            size = CODE_SIZES[code]
+            if size is None or size * 8 >= width:
+                size = width // 8 if size is None else size
+                values[name] = int.from_bytes(data[pos:pos + size], "big")
+            elif size:
+                lsbs = int.from_bytes(data[pos:pos + size], "big")
+                values[name] = lsb_decode(lsbs, values[name], size * 8, width)
+            pos += size
+
+        transport_checksum = data[pos:pos + 2]
+        pos += 2
+        if len(transport_checksum) != 2:
+            raise ValueError
+
+        options = flow.options_template
+        if raw_options:
+            options_size = data[pos]
+            options = data[pos + 1:pos + 1 + options_size]
+            pos += 1 + options_size
+            if len(options) != options_size or options_size & 3:
+                raise ValueError
+
+            timestamp = find_timestamp(options)
+            if timestamp is not None:
+                values["tsval"], values["tsecr"] = struct.unpack(
+                    "!II", options[timestamp + 2:timestamp + 10]
+                )
+
+        header = bytearray(flow.template) + options
+        header[flow.checksum_offset:flow.checksum_offset + 2] = (
+            transport_checksum
+        )
+        for name, offset, width in fields:
+            if raw_options and name in TIMESTAMP_FIELDS:
+                continue
+            value = values[name]
+            if name == "ip_id":
+                value = (value + msn) & 0xffff
+            header[offset:offset + width // 8] = value.to_bytes(
+                width // 8, "big"
+            )
+
+        payload = data[pos:]
+        total_length = len(header) + len(payload)
+        header[2:4] = struct.pack("!H", total_length)
+        if flow.key[0] == PROTO_TCP:
+            header[32] |= (len(header) - IP_HEADER_SIZE) // 4 << 4
+        elif flow.key[0] == PROTO_UDP:
+            header[24:26] = struct.pack("!H", total_length - IP_HEADER_SIZE)
+        header[10:12] = struct.pack("!H", checksum(header[:IP_HEADER_SIZE]))
+
+        return bytes(header) + payload, len(header), msn, values
@@ -3,47 +3,108 @@
 import os
 import select
 import threading
-from scapy.all import *
+# Only what's used, scapy.all takes seconds (and a lot of memory) to import.
+from scapy.layers.inet import ICMP, IP
+from scapy.sendrecv import sr1
 import argparse
 import logging
 import queue
 import sys
 import time
 
-MAX_ICMP_PAYLOAD_SIZE=1472
+# Shared by all the transports.
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+import arq
+import codel
+import framing
+import ipowwriter
+import lanes
+import metrics
+import tracing
 
 logger = logging.getLogger("icmp-client")
 
-fifo_queue = queue.Queue(maxsize=MAX_ICMP_PAYLOAD_SIZE)
+# Outbound packets, interactive ones first; never blocks the FIFO reader,
+# drops what waited too long.
+fifo_queue = lanes.LaneQueue(logger=logger)
+
+# Optional retransmissions (--arq); frames it wants sent wait in arq_pending.
+link = None
+arq_pending = []
+
+stats = metrics.LinkMetrics()
+polls_data = metrics.counter("ipow_polls_total", "Polls (requests) whose reply carried data, or not", result="data")
+polls_empty = metrics.counter("ipow_polls_total", "Polls (requests) whose reply carried data, or not", result="empty")
+poll_seconds = metrics.histogram("ipow_poll_seconds", "Time until a poll got its reply")
+fifo_opens = metrics.counter("ipow_fifo_opens_total", "Times the inbound FIFO was (re)opened")
 
 def handle_icmp(mode_in, mode_out, addr, fifo_out, keep_alive):
     if mode_out:
-        fifo_out_fd = os.open(fifo_out, os.O_WRONLY)
+        ipow = ipowwriter.IPOWWriter(fifo_out, logger=logger, background=True)
 
     last_empty = True
 
     while True:
+        if mode_out and ipow.backlogged():
+            # No more polls (and so no more data) until IPOW takes what's
+            # there.
+            ipow.wait(ipowwriter.HOLD_OFF)
+
+        packet = None
         if mode_in:
-            try:
-                data = fifo_queue.get(block=last_empty, timeout=keep_alive)
-                last_empty = False
-                logger.info(f"Received '{len(data)} from queue")
-            except queue.Empty:
-                logger.info(f"Queue empty")
-                last_empty = True
-                data = b""
+            if link and not arq_pending:
+                arq_pending.extend(link.poll())
+
+            timeout = keep_alive
+            arq_timeout = link.next_timeout() if link else None
+            if arq_timeout is not None:
+                timeout = min(timeout, arq_timeout)
+
+            if arq_pending:
+                data = arq_pending.pop(0)
+            else:
+                try:
+                    data = packet = fifo_queue.get(block=last_empty, timeout=timeout)
+                    last_empty = False
+                    logger.debug("Received %d from queue", len(data))
+                    tracing.mark("dequeued", packet)
+                    if link:
+                        data = link.wrap(data)
+                    tracing.mark("encoded", packet)
+                except queue.Empty:
+                    logger.debug("Queue empty")
+                    last_empty = True
+                    if link:
+                        arq_pending.extend(link.poll())
+                    data = arq_pending.pop(0) if arq_pending else b""
         else:
             time.sleep(keep_alive)
             data = b""
 
+        if data:
+            stats.sent(data)
+        if packet:
+            tracing.mark("sent", packet)
+        started = time.monotonic()
         reply = sr1(IP(dst=addr)/ICMP()/data, verbose=False)
+        poll_seconds.observe(time.monotonic() - started)
+        if packet:
+            tracing.mark("reply", packet)
+        has_data = bool(reply and 'Raw' in reply and reply['Raw'].load)
+        (polls_data if has_data else polls_empty).inc()
         if reply and 'Raw' in reply:
             payload = reply['Raw'].load
-            logger.info(f"Sent {len(data)} bytes, got {len(payload)} bytes in reply")
+            if payload:
+                stats.received(payload)
+            logger.debug("Sent %d bytes, got %d bytes in reply", len(data), len(payload))
+            if link:
+                payload = link.unwrap(payload)
             if mode_out:
                 if mode_out and payload:
-                    logger.info(f"Sending {len(payload)} to fifo_out_fd={fifo_out_fd}")
-                    os.write(fifo_out_fd, payload)
+                    logger.debug("Sending %d to IPOW", len(payload))
+                    tracing.mark("received", payload)
+                    ipow.write(payload)
+                    tracing.mark("ipow_out", payload)
 
 
 
@@ -54,13 +115,19 @@ def handle_fifo(mode_in, mode_out, fifo_in):
     while True:
         try:
             fifo_fd = os.open(fifo_in, os.O_RDONLY | os.O_NONBLOCK)
+            splitter = framing.Splitter()
+            fifo_opens.inc()
             while True:
                 r, _, _ = select.select([fifo_fd], [], [])
                 if r:
                     data = os.read(fifo_fd, 1024)
                     if data:
-                        logger.info(f"Received '{len(data)} from fifo_in")
-                        fifo_queue.put(data)
+                        logger.debug("Received %d from fifo_in", len(data))
+                        # Whole packets into the queue, the lanes and drops
+                        # work on packets.
+                        for packet in splitter.feed(data):
+                            tracing.mark("ipow_in", packet)
+                            fifo_queue.put(packet)
                     else:
                         os.close(fifo_fd)
                         break
@@ -75,17 +142,37 @@ if __name__ == "__main__":
     parser.add_argument("-m", "--mode", type=str, help='Mode: in/out/inout', default='inout')
     parser.add_argument('-c', '--connect-addr', type=str, help='Remote host')
     parser.add_argument('-k', '--keep-alive', type=float, help='Keep alive in seconds (default 1.0)', default=1.0)
+    parser.add_argument('--queue-bytes', type=int, help=f'Outbound queue size in bytes (default {codel.MAX_BYTES})', default=codel.MAX_BYTES)
+    parser.add_argument('--queue-target', type=float, help=f'Outbound queue delay target in seconds (default {codel.TARGET})', default=codel.TARGET)
+    parser.add_argument('--arq', action='store_true', help='Retransmit lost packets (selective repeat ARQ, the other side has to use it too)')
+    parser.add_argument('-v', '--verbose', action='store_true', help='Log every packet')
+    parser.add_argument('--metrics', type=str, help='Serve metrics on this UNIX socket path or [host:]port (HTTP)')
+    parser.add_argument('--trace', type=str, help='Trace packets through the stages into this file (.json: Chrome trace format; written on exit and SIGUSR1)')
     args = parser.parse_args()
 
     logging.basicConfig(
-        level=logging.DEBUG,
+        level=logging.DEBUG if args.verbose else logging.INFO,
         format='[%(asctime)s] [%(levelname)s] %(funcName)s: %(message)s',
         datefmt='%Y-%m-%d %H:%M:%S',
     )
 
+    if args.metrics:
+        metrics.serve(args.metrics, "icmp-client")
+
+    if args.trace:
+        tracing.start(args.trace, "icmp-client")
+
     mode_in = args.mode.lower().find('i') != -1
     mode_out = args.mode.lower().find('o') != -1
 
+    fifo_queue.configure(args.queue_bytes, args.queue_target)
+
+    if args.arq:
+        if not (mode_in and mode_out):
+            logger.info(f"ARQ needs both directions (-m inout)")
+            sys.exit()
+        link = arq.ARQ(logger=logger)
+
     if mode_in:
         if not os.path.exists(args.fifo_in):
             logger.info(f"Fifo in '{args.fifo_in}' doesn't exist")
@@ -5,35 +5,56 @@
 import os
 import select
 import threading
-from scapy.all import *
+# Only what's used, scapy.all takes seconds (and a lot of memory) to import.
+from scapy.layers.inet import ICMP, IP
+from scapy.sendrecv import send, sniff
 import argparse
 import logging
 import queue
 import sys
 
-MAX_ICMP_PAYLOAD_SIZE=1472
+# Shared by all the transports.
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+import arq
+import codel
+import framing
+import ipowwriter
+import lanes
+import metrics
+import tracing
 
 logger = logging.getLogger("icmp-listener")
 
-fifo_queue = queue.Queue(maxsize=MAX_ICMP_PAYLOAD_SIZE)
+# Outbound packets, interactive ones first; never blocks the FIFO reader,
+# drops what waited too long.
+fifo_queue = lanes.LaneQueue(logger=logger)
+
+# Optional retransmissions (--arq); frames it wants sent wait in arq_pending.
+link = None
+arq_pending = []
+
+stats = metrics.LinkMetrics()
+replies_data = metrics.counter("ipow_replies_total", "Replies which carried data, or not", result="data")
+replies_empty = metrics.counter("ipow_replies_total", "Replies which carried data, or not", result="empty")
+fifo_opens = metrics.counter("ipow_fifo_opens_total", "Times the inbound FIFO was (re)opened")
 
 def handle_icmp(interface, mode, fifo_out):
     mode_in = mode.lower().find('i') != -1
     mode_out = mode.lower().find('o') != -1
 
-    fifo_out_fd = None
+    ipow = None
 
     if mode_out:
         if not os.path.exists(fifo_out):
             logger.info(f"Fifo out '{fifo_out}' doesn't exist")
             return
-        fifo_out_fd = os.open(fifo_out, os.O_WRONLY)
+        ipow = ipowwriter.IPOWWriter(fifo_out, logger=logger, background=True)
         logger.info(f"FIFO {fifo_out} opened for writing (out)")
 
 
-    sniff(prn=handle_icmp_reply(mode, fifo_out_fd), filter="icmp and icmp[icmptype] == icmp-echo", store=0, iface=interface) 
+    sniff(prn=handle_icmp_reply(mode, ipow), filter="icmp and icmp[icmptype] == icmp-echo", store=0, iface=interface) 
 
-def handle_icmp_reply(mode, fifo_out_fd):
+def handle_icmp_reply(mode, ipow):
     mode_in = mode.lower().find('i') != -1
     mode_out = mode.lower().find('o') != -1
 
@@ -43,27 +64,55 @@ def handle_icmp_reply(mode, fifo_out_fd):
         except:
             payload = b""
 
-        logger.info(f"Got {len(payload)} bytes from client")
+        logger.debug("Got %d bytes from client", len(payload))
+        if payload:
+            stats.received(payload)
+
+        if link and payload:
+            payload = link.unwrap(payload)
 
         if mode_out:
             if mode_out and payload:
-                os.write(fifo_out_fd, payload)
-
+                tracing.mark("received", payload)
+                ipow.write(payload, wait=ipowwriter.HOLD_OFF)
+                tracing.mark("ipow_out", payload)
+                if ipow.backlogged():
+                    # Holds up the reply (and so the client's next poll) for
+                    # a bit.
+                    ipow.wait(ipowwriter.HOLD_OFF)
+
+        packet = None
         if mode_in:
-            try:
-                data = fifo_queue.get_nowait()
-            except queue.Empty:
-                data = b""
+            if link and not arq_pending:
+                arq_pending.extend(link.poll())
+
+            if arq_pending:
+                data = arq_pending.pop(0)
+            else:
+                try:
+                    data = packet = fifo_queue.get_nowait()
+                    tracing.mark("dequeued", packet)
+                    if link:
+                        data = link.wrap(data)
+                    tracing.mark("encoded", packet)
+                except queue.Empty:
+                    data = b""
         else:
             data = payload
 
+        (replies_data if data else replies_empty).inc()
+        if data:
+            stats.sent(data)
+
         ip = IP(dst=pkt[IP].src, src=pkt[IP].dst)
         icmp = ICMP(type=0, id=pkt[ICMP].id, seq=pkt[ICMP].seq)
         reply_pkt = ip/icmp/data
 
-        logger.info(f"sending answer to {pkt[IP].src}: {data}")
+        logger.debug("Sending answer to %s: %d bytes", pkt[IP].src, len(data))
 
         send(reply_pkt, verbose=False)
+        if packet:
+            tracing.mark("sent", packet)
 
     return icmp_reply
 
@@ -74,13 +123,19 @@ def handle_fifo(fifo_in):
     while True:
         try:
             fifo_fd = os.open(fifo_in, os.O_RDONLY | os.O_NONBLOCK)
+            splitter = framing.Splitter()
+            fifo_opens.inc()
             while True:
                 r, _, _ = select.select([fifo_fd], [], [])
                 if r:
                     data = os.read(fifo_fd, 1024)
                     if data:
-                        logger.info(f"Received '{len(data)} from fifo_in")
-                        fifo_queue.put(data)
+                        logger.debug("Received %d from fifo_in", len(data))
+                        # Whole packets into the queue, the lanes and drops
+                        # work on packets.
+                        for packet in splitter.feed(data):
+                            tracing.mark("ipow_in", packet)
+                            fifo_queue.put(packet)
                     else:
                         os.close(fifo_fd)
                         break
@@ -94,17 +149,37 @@ if __name__ == "__main__":
     parser.add_argument("-i", "--fifo-in", type=str, help='FIFO in', default='/var/run/tun_out.fifo')
     parser.add_argument("-o", "--fifo-out", type=str, help='FIFO out', default='/var/run/tun_in.fifo')
     parser.add_argument("-m", "--mode", type=str, help='Mode: in/out/inout', default='inout')
+    parser.add_argument('--queue-bytes', type=int, help=f'Outbound queue size in bytes (default {codel.MAX_BYTES})', default=codel.MAX_BYTES)
+    parser.add_argument('--queue-target', type=float, help=f'Outbound queue delay target in seconds (default {codel.TARGET})', default=codel.TARGET)
+    parser.add_argument('--arq', action='store_true', help='Retransmit lost packets (selective repeat ARQ, the other side has to use it too)')
+    parser.add_argument('-v', '--verbose', action='store_true', help='Log every packet')
+    parser.add_argument('--metrics', type=str, help='Serve metrics on this UNIX socket path or [host:]port (HTTP)')
+    parser.add_argument('--trace', type=str, help='Trace packets through the stages into this file (.json: Chrome trace format; written on exit and SIGUSR1)')
     args = parser.parse_args()
 
     logging.basicConfig(
-        level=logging.DEBUG,
+        level=logging.DEBUG if args.verbose else logging.INFO,
         format='[%(asctime)s] [%(levelname)s] %(funcName)s: %(message)s',
         datefmt='%Y-%m-%d %H:%M:%S',
     )
 
+    if args.metrics:
+        metrics.serve(args.metrics, "icmp-server")
+
+    if args.trace:
+        tracing.start(args.trace, "icmp-server")
+
     mode_in = args.mode.lower().find('i') != -1
     mode_out = args.mode.lower().find('o') != -1
 
+    fifo_queue.configure(args.queue_bytes, args.queue_target)
+
+    if args.arq:
+        if not (mode_in and mode_out):
+            logger.info(f"ARQ needs both directions (-m inout)")
+            sys.exit()
+        link = arq.ARQ(logger=logger)
+
     if mode_in:
         if not os.path.exists(args.fifo_in):
             logger.info(f"Fifo in '{args.fifo_in}' doesn't exist")
@@ -0,0 +1,94 @@
+#!/usr/bin/env python3
+# One entry point for all the transports:
+#
+#   ipow-transport udp -c box1 -t SECRET
+#   ipow-transport dns-client -s 192.0.2.1 -d c.example.com
+#   ipow-transport list
+#
+# Every transport is a plugin: a name, the script which implements it (run as
+# if it was started itself, with the rest of the command line) and the
+# modules it can't do without. Nothing of a transport - and none of its heavy
+# dependencies (scapy, dnspython, numpy) - is imported until it's the one
+# picked, so starting e.g. the UDP transport never loads scapy. That's also
+# why this imports next to nothing itself.
+#
+# More plugins (or other versions of these) can be given in
+# IPOW_TRANSPORT_PLUGINS, as NAME=SCRIPT[,NAME=SCRIPT...].
+#
+# See loopbench/startup.py for how long each takes to start, and how much
+# memory that takes.
+import importlib.util
+import os
+import sys
+import types
+
+HERE = os.path.dirname(os.path.realpath(__file__))
+
+# Name -> (script, description, modules it needs)
+PLUGINS = {}
+
+
+def register(name, script, description="", requires=()):
+    PLUGINS[name] = (os.path.join(HERE, script), description, tuple(requires))
+
+
+register("tcp-client", "tcp/tcp-client.py", "TCP, connecting to tcp-server")
+register("tcp-server", "tcp/tcp-server.py", "TCP, taking connections from tcp-client")
+register("udp", "udp/udp.py", "UDP, one packet per datagram (ipowd2)")
+register("dns-client", "dns/dns-client.py", "DNS queries to dns-server", ["dns"])
+register("dns-server", "dns/dns-server.py", "DNS replies to dns-client", ["scapy"])
+register("icmp-client", "icmp/icmp-client.py", "ICMP echo requests to icmp-server", ["scapy"])
+register("icmp-server", "icmp/icmp-server.py", "ICMP echo replies to icmp-client", ["scapy"])
+register("audio", "audio/audio.py", "Sound, through a sound card or a cable", ["numpy"])
+register("bond", "bond/bond.py", "Several transports bonded into one link (ipowd2)")
+register("capture", "capture/capture.py", "Records what goes between IPOW and a transport")
+
+
+def load_plugins(spec):
+    for entry in filter(None, spec.split(",")):
+        name, _, script = entry.partition("=")
+        if not name or not script:
+            sys.exit(f"ipow-transport: bad plugin '{entry}' in IPOW_TRANSPORT_PLUGINS")
+        PLUGINS[name] = (os.path.abspath(script), "(IPOW_TRANSPORT_PLUGINS)", ())
+
+
+def usage(out):
+    out.write("usage: ipow-transport NAME [ARGS...]   (NAME -h for its options)\n\n")
+    width = max(len(name) for name in PLUGINS)
+    for name, (_, description, requires) in PLUGINS.items():
+        needs = f" [needs {', '.join(requires)}]" if requires else ""
+        out.write(f"  {name:<{width}}  {description}{needs}\n")
+
+
+def main():
+    load_plugins(os.environ.get("IPOW_TRANSPORT_PLUGINS", ""))
+
+    if len(sys.argv) < 2 or sys.argv[1] in ("-h", "--help", "list"):
+        usage(sys.stdout)
+        return
+    name = sys.argv[1]
+    if name not in PLUGINS:
+        usage(sys.stderr)
+        sys.exit(f"\nipow-transport: unknown transport '{name}'")
+
+    script, _, requires = PLUGINS[name]
+    missing = [module for module in requires if importlib.util.find_spec(module) is None]
+    if missing:
+        sys.exit(f"ipow-transport: {name} needs {', '.join(missing)}, which isn't installed")
+
+    # As if the script was started itself: it's __main__ (for
+    # multiprocessing's spawn, which audio.py uses), and argv[0] is what
+    # argparse shows. (runpy.run_path() would put the script's path there.)
+    sys.argv = [f"ipow-transport {name}"] + sys.argv[2:]
+    sys.path.insert(0, os.path.dirname(script))
+    module = types.ModuleType("__main__")
+    module.__file__ = script
+    module.__builtins__ = __builtins__
+    sys.modules["__main__"] = module
+    with open(script, "rb") as f:
+        code = compile(f.read(), script, "exec")
+    exec(code, module.__dict__)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,224 @@
+# Delivery into IPOW (what it then writes to TUN) for the transports, without
+# either blocking the whole transport when IPOW can't keep up, or silently
+# losing packets. Writes are non-blocking; whatever IPOW doesn't take right
+# away waits in a small retry queue (a byte budget, like codel.py's), which
+# is flushed as soon as IPOW can take more. Only once that's full are packets
+# dropped, and counted.
+#
+# The transport is supposed to stop taking data off the wire while
+# backlogged() - stop reading its socket, stop polling - so that the other
+# end (TCP's window, the DNS/ICMP polls) slows down instead of losing data.
+#
+# Transports with a select() loop add the writer to the write list while
+# pending() and call flush() once it's writable; the others (scapy callbacks,
+# poll loops) get a thread which does that (background=True), and can wait()
+# for room.
+#
+# Either ipowd's FIFO or ipowd2's datagram socket (told apart by what's at the
+# path). The socket is connect()ed, so that it's writable exactly when
+# ipowd2's receive queue has room.
+import collections
+import errno
+import os
+import select
+import socket
+import stat
+import threading
+import time
+
+import metrics
+
+MAX_BYTES = 65536
+HIGH_WATER = MAX_BYTES // 2  # backlogged() above this.
+RECONNECT_INTERVAL = 1.0  # Seconds, when ipowd2 isn't there.
+WAIT_STEP = 0.01  # Seconds between flush() attempts in wait().
+HOLD_OFF = 1.0  # Seconds, what transports without a loop wait() at most.
+
+dropped_full = metrics.counter(
+    "ipow_delivery_dropped_total", "Packets IPOW couldn't take, dropped",
+    reason="full"
+)
+dropped_gone = metrics.counter(
+    "ipow_delivery_dropped_total", "Packets IPOW couldn't take, dropped",
+    reason="gone"
+)
+stalls = metrics.counter(
+    "ipow_delivery_stalls_total",
+    "Times IPOW couldn't take a packet right away (and the retry queue started)"
+)
+stall_seconds = metrics.histogram(
+    "ipow_delivery_stall_seconds", "Time until the retry queue was empty again"
+)
+
+
+class IPOWWriter:
+    def __init__(self, path, max_bytes=MAX_BYTES, logger=None, background=False):
+        self.path = path
+        self.max_bytes = max_bytes
+        self.high_water = min(HIGH_WATER, max_bytes // 2)
+        self.logger = logger
+
+        self.packets = collections.deque()  # The first one may be partly written.
+        self.offset = 0  # How much of the first one was written (FIFOs only).
+        self.bytes = 0
+        self.stalled_since = None
+        self.lock = threading.Condition()
+
+        self.fifo = os.path.exists(path) and stat.S_ISFIFO(os.stat(path).st_mode)
+        self.sock = None
+        self.fd = None
+        self.next_connect = 0
+        if self.fifo:
+            # Blocks until IPOW has it open, as before.
+            self.fd = os.open(path, os.O_WRONLY)
+            os.set_blocking(self.fd, False)
+        else:
+            self.connect()
+
+        metrics.gauge(
+            "ipow_delivery_queue_bytes", "Bytes waiting for IPOW to take them",
+            lambda: self.bytes
+        )
+
+        if background:
+            threading.Thread(target=self.flusher, daemon=True).start()
+
+    def connect(self):
+        now = time.monotonic()
+        if now < self.next_connect:
+            return False
+        self.next_connect = now + RECONNECT_INTERVAL
+        if self.sock is None:
+            self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM)
+            self.sock.setblocking(False)
+        try:
+            self.sock.connect(self.path)
+        except OSError as e:
+            if self.logger:
+                self.logger.info(f"Can't connect to IPOW's '{self.path}': {e}")
+            self.sock.close()
+            self.sock = None
+            return False
+        return True
+
+    def fileno(self):
+        # For select(), while pending().
+        return self.fd if self.fifo else self.sock.fileno()
+
+    def pending(self):
+        return bool(self.packets) and (self.fifo or self.sock is not None)
+
+    def backlogged(self):
+        return self.bytes >= self.high_water
+
+    def send(self, data):
+        # How much went (a datagram goes whole or not at all), None if IPOW
+        # is gone.
+        try:
+            if self.fifo:
+                return os.write(self.fd, data)
+            if self.sock is None and not self.connect():
+                return None
+            self.sock.send(data)
+            return len(data)
+        except BlockingIOError:
+            return 0
+        except (BrokenPipeError, ConnectionRefusedError, FileNotFoundError) as e:
+            if self.logger:
+                self.logger.info(f"IPOW went away: {e}")
+            if self.sock is not None:
+                self.sock.close()
+                self.sock = None
+            return None
+        except OSError as e:
+            if e.errno != errno.ENOTCONN:
+                raise
+            self.sock.close()
+            self.sock = None
+            return None
+
+    def write(self, data, wait=0.0):
+        # Returns False if it had to be dropped. With wait, waits (up to that
+        # many seconds) for room instead of dropping right away.
+        with self.lock:
+            if not self.packets:
+                sent = self.send(data)
+                if sent is None:
+                    dropped_gone.inc()
+                    return False
+                if sent == len(data):
+                    return True
+                self.offset = sent
+                self.stalled_since = time.monotonic()
+                stalls.inc()
+            elif self.bytes + len(data) > self.max_bytes:
+                deadline = time.monotonic() + wait
+                while not self.flush_locked() and self.bytes + len(data) > self.max_bytes:
+                    remaining = deadline - time.monotonic()
+                    if remaining <= 0:
+                        break
+                    self.lock.wait(min(remaining, WAIT_STEP))
+                if self.bytes + len(data) > self.max_bytes:
+                    if self.logger:
+                        self.logger.debug("IPOW busy, dropping %d bytes", len(data))
+                    dropped_full.inc()
+                    return False
+
+            self.packets.append(bytes(data))  # Could be a reused buffer.
+            self.bytes += len(data)
+            self.lock.notify_all()
+            return True
+
+    def flush(self):
+        # Returns True if there's nothing left.
+        with self.lock:
+            return self.flush_locked()
+
+    def flush_locked(self):
+        while self.packets:
+            data = self.packets[0]
+            sent = self.send(memoryview(data)[self.offset:] if self.offset else data)
+            if sent is None:
+                # Gone; a FIFO's stream can't be resumed in the middle of a
+                # packet anyway.
+                dropped_gone.inc(len(self.packets))
+                self.packets.clear()
+                self.bytes = 0
+                self.offset = 0
+                break
+            if self.offset + sent < len(data):
+                self.offset += sent
+                return False
+            self.packets.popleft()
+            self.bytes -= len(data)
+            self.offset = 0
+
+        if self.stalled_since is not None:
+            stall_seconds.observe(time.monotonic() - self.stalled_since)
+            self.stalled_since = None
+        self.lock.notify_all()
+        return True
+
+    def wait(self, timeout):
+        # Until there's room again (not backlogged()), or timeout.
+        deadline = time.monotonic() + timeout
+        with self.lock:
+            while not self.flush_locked() and self.backlogged():
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    return False
+                self.lock.wait(min(remaining, WAIT_STEP))
+        return True
+
+    def flusher(self):
+        while True:
+            with self.lock:
+                while not self.packets:
+                    self.lock.wait()
+                fd = self.fileno() if self.pending() else None
+            if fd is None:
+                # ipowd2 isn't there (yet).
+                time.sleep(RECONNECT_INTERVAL)
+            else:
+                select.select([], [fd], [], RECONNECT_INTERVAL)
+            self.flush()
@@ -0,0 +1,177 @@
+# Priority lanes for the transports' outbound packets. Packets from IPOW are
+# classified by their IPv4/IPv6 + TCP/UDP headers:
+#
+#   interactive - ICMP, DNS, TCP without much payload (ACKs, keystrokes,
+#                 SYN/FIN/RST)
+#   default     - everything else (other UDP, anything we can't parse)
+#   bulk        - TCP segments with more than SMALL_PAYLOAD bytes of payload
+#
+# Each lane is a CoDelQueue of its own, and lanes take turns with deficit
+# round robin (like fq_codel): a lane can send as long as it has credit left,
+# and gets its quantum (weight * MTU bytes) of credit each round. So small
+# packets don't wait behind bulk data, but bulk data doesn't starve either.
+# And getting ACKs through quickly is what keeps bulk transfers going in the
+# first place.
+import queue
+import threading
+import time
+
+import codel
+
+LANE_INTERACTIVE = 0
+LANE_DEFAULT = 1
+LANE_BULK = 2
+
+LANE_NAMES = ("interactive", "default", "bulk")
+LANE_WEIGHTS = (4, 2, 1)
+
+SMALL_PAYLOAD = 128
+
+PROTO_ICMP = 1
+PROTO_TCP = 6
+PROTO_UDP = 17
+PROTO_ICMPV6 = 58
+
+TCP_FLAG_FIN = 0x01
+TCP_FLAG_SYN = 0x02
+TCP_FLAG_RST = 0x04
+
+DNS_PORT = 53
+
+
+def classify(packet):
+    if len(packet) < 20:
+        return LANE_DEFAULT
+
+    version = packet[0] >> 4
+    if version == 4:
+        header_size = (packet[0] & 0x0f) * 4
+        if int.from_bytes(packet[6:8], "big") & 0x1fff:
+            return LANE_DEFAULT  # Not the first fragment, no ports here.
+        proto = packet[9]
+    elif version == 6 and len(packet) >= 40:
+        header_size = 40
+        proto = packet[6]  # Extension headers end up in the default lane.
+    else:
+        return LANE_DEFAULT
+
+    if proto in (PROTO_ICMP, PROTO_ICMPV6):
+        return LANE_INTERACTIVE
+
+    transport = packet[header_size:]
+
+    if proto == PROTO_UDP and len(transport) >= 8:
+        ports = (
+            int.from_bytes(transport[0:2], "big"),
+            int.from_bytes(transport[2:4], "big"),
+        )
+        return LANE_INTERACTIVE if DNS_PORT in ports else LANE_DEFAULT
+
+    if proto == PROTO_TCP and len(transport) >= 20:
+        payload = len(transport) - (transport[12] >> 4) * 4
+        flags = transport[13]
+        if (payload <= SMALL_PAYLOAD or
+                flags & (TCP_FLAG_SYN | TCP_FLAG_FIN | TCP_FLAG_RST)):
+            return LANE_INTERACTIVE
+        return LANE_BULK
+
+    return LANE_DEFAULT
+
+
+class Lane:
+    def __init__(self, name, weight, max_bytes, target, interval, logger):
+        self.quantum = weight * codel.MTU
+        self.deficit = 0
+        self.queue = codel.CoDelQueue(
+            max_bytes, target, interval, logger=logger, name=name
+        )
+
+
+class LaneQueue:
+    # Same interface as CoDelQueue (and queue.Queue, as far as the transports
+    # are concerned).
+    def __init__(self, max_bytes=codel.MAX_BYTES, target=codel.TARGET,
+                 interval=codel.INTERVAL, logger=None):
+        self.lanes = [
+            Lane(name, weight, max_bytes, target, interval, logger)
+            for name, weight in zip(LANE_NAMES, LANE_WEIGHTS)
+        ]
+        self.current = 0
+        self.lock = threading.Condition()
+
+    def configure(self, max_bytes, target):
+        for lane in self.lanes:
+            lane.queue.max_bytes = max_bytes
+            lane.queue.target = target
+
+    def __len__(self):
+        return sum(len(lane.queue) for lane in self.lanes)
+
+    def qsize(self):
+        return len(self)
+
+    def empty(self):
+        return all(lane.queue.empty() for lane in self.lanes)
+
+    def put(self, data):
+        with self.lock:
+            queued = self.lanes[classify(data)].queue.put(data)
+            self.lock.notify()
+            return queued
+
+    def put_nowait(self, data):
+        return self.put(data)
+
+    def get(self, block=True, timeout=None):
+        deadline = None if timeout is None else time.monotonic() + timeout
+
+        with self.lock:
+            while True:
+                data = self.dequeue()
+                if data is not None:
+                    return data
+
+                if not block:
+                    raise queue.Empty
+
+                if deadline is None:
+                    self.lock.wait()
+                else:
+                    remaining = deadline - time.monotonic()
+                    if remaining <= 0:
+                        raise queue.Empty
+                    self.lock.wait(remaining)
+
+    def get_nowait(self):
+        return self.get(block=False)
+
+    def dequeue(self):
+        # Deficit round robin. Returns None if all the lanes are empty.
+        while not self.empty():
+            lane = self.lanes[self.current]
+
+            if lane.queue.empty():
+                lane.deficit = 0  # No saving up credit while idle.
+                self.current = (self.current + 1) % len(self.lanes)
+                continue
+
+            if lane.deficit <= 0:
+                lane.deficit += lane.quantum
+                self.current = (self.current + 1) % len(self.lanes)
+                continue
+
+            try:
+                data = lane.queue.get_nowait()
+            except queue.Empty:
+                continue  # CoDel dropped everything that was there.
+
+            lane.deficit -= len(data)
+            return data
+
+        return None
+
+    def stats(self):
+        return {
+            name: lane.queue.stats()
+            for name, lane in zip(LANE_NAMES, self.lanes)
+        }
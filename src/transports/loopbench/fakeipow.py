@@ -0,0 +1,213 @@
+# In-process stand-in for ipowd, so transports can be run (and measured)
+# without a TUN device: packets are written to the transport the way ipowd
+# would write what it read from TUN, and whatever the transport hands back is
+# timestamped instead of going to TUN.
+#
+# Two flavours, same as bond.py's paths:
+#   socket - ipowd2's datagram sockets: "tun_out" (packets for the transport,
+#            sent to whoever said "hi" last) and "tun_in" (packets from it),
+#            used by audio.py and bond.py
+#   fifo   - ipowd's named pipes tun_out.fifo / tun_in.fifo, used by the TCP,
+#            DNS and ICMP transports
+#
+# Pipes (and the TCP transport's stream, and the DNS transport's chunks) don't
+# keep packet boundaries, so a Receiver cuts what it gets into packets using
+# the IPv4/IPv6 length fields, like the kernel would have to (and if it loses
+# track, it skips ahead to the next IPv4 header with a valid checksum).
+import collections
+import os
+import select
+import socket
+import threading
+import time
+
+from framing import packet_length
+
+MAX_PACKET = 65536
+
+
+class Receiver:
+    # Matches packets coming back against the ones sent (expect()), records
+    # their latency (time.perf_counter, seconds) and the order they came in.
+    # The same packet can be on its way more than once (e.g. in a capture).
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.buffer = b""
+        self.expected = {}  # Packet -> deque of (time sent, number)
+        self.outstanding = 0
+        self.latencies = []
+        self.order = []  # Numbers of the packets, as they arrived.
+        self.received_bytes = 0
+        self.last_received = None
+        self.newest_arrived = None  # When the last sent of those arrived was sent.
+        self.unexpected = 0  # Packets which weren't sent (or twice).
+        self.garbled = 0  # Bytes which weren't a packet at all.
+        self.arrived = threading.Condition(self.lock)
+
+    def expect(self, packet, number=None):
+        # Returns when it was sent (i.e. now).
+        with self.lock:
+            sent = time.perf_counter()
+            self.expected.setdefault(packet, collections.deque()).append(
+                (sent, number)
+            )
+            self.outstanding += 1
+            return sent
+
+    def waiting(self, packet, sent):
+        # Is the packet (sent at sent) still on its way? Not if it arrived,
+        # or if something sent after it did (it's lost, or overtaken).
+        with self.lock:
+            if self.newest_arrived is not None and self.newest_arrived > sent:
+                return False
+            return any(t == sent for t, _ in self.expected.get(packet, ()))
+
+    def pending(self, packet):
+        with self.lock:
+            return packet in self.expected
+
+    def reset(self):
+        # Forgets everything sent so far (e.g. the warm-up packets).
+        with self.lock:
+            self.expected.clear()
+            self.outstanding = 0
+            self.latencies = []
+            self.order = []
+            self.received_bytes = 0
+            self.last_received = None
+            self.newest_arrived = None
+            self.unexpected = 0
+            self.garbled = 0
+
+    def feed(self, data):
+        now = time.perf_counter()
+        with self.lock:
+            self.buffer += data
+            while True:
+                length = packet_length(self.buffer)
+                if length is None:
+                    break
+                if length == 0:
+                    # Lost track (something got lost or reordered on the
+                    # way); look for the next IPv4 header that checks out.
+                    self.garbled += 1
+                    self.buffer = self.buffer[1:]
+                    continue
+                if len(self.buffer) < length:
+                    break
+                packet, self.buffer = self.buffer[:length], self.buffer[length:]
+                waiting = self.expected.get(packet)
+                if not waiting:
+                    self.unexpected += 1
+                    continue
+                sent, number = waiting.popleft()
+                if not waiting:
+                    del self.expected[packet]
+                self.outstanding -= 1
+                self.latencies.append(now - sent)
+                self.order.append(number)
+                self.received_bytes += len(packet)
+                self.last_received = now
+                if self.newest_arrived is None or sent > self.newest_arrived:
+                    self.newest_arrived = sent
+            self.arrived.notify_all()
+
+    def wait(self, timeout):
+        # Waits for anything to arrive; returns how many are still expected.
+        with self.lock:
+            self.arrived.wait(timeout)
+            return self.outstanding
+
+
+class FakeIPOW:
+    def __init__(self, directory, name, kind="socket", receiver=None):
+        self.kind = kind
+        self.receiver = receiver or Receiver()
+        self.closed = threading.Event()
+        self.client = None  # For sockets, who said "hi".
+        self.registered = threading.Event()
+
+        if kind == "socket":
+            # Named from ipowd's point of view, like ipowd2 does.
+            self.outbound = os.path.join(directory, f"{name}_out")
+            self.inbound = os.path.join(directory, f"{name}_in")
+            self.out_sock = socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM)
+            self.out_sock.bind(self.outbound)
+            self.in_sock = socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM)
+            self.in_sock.bind(self.inbound)
+            self.in_sock.settimeout(0.5)
+            self.out_sock.settimeout(0.5)
+            threads = [self.read_socket, self.read_hi]
+        elif kind == "fifo":
+            self.outbound = os.path.join(directory, f"{name}_out.fifo")
+            self.inbound = os.path.join(directory, f"{name}_in.fifo")
+            os.mkfifo(self.outbound)
+            os.mkfifo(self.inbound)
+            # Read-write, so neither open blocks waiting for the transport,
+            # and the transport never sees EOF.
+            self.out_fd = os.open(self.outbound, os.O_RDWR)
+            self.in_fd = os.open(self.inbound, os.O_RDWR | os.O_NONBLOCK)
+            self.registered.set()
+            threads = [self.read_fifo]
+        else:
+            raise ValueError(f"Unknown IPOW kind '{kind}'")
+
+        for target in threads:
+            threading.Thread(target=target, daemon=True).start()
+
+    def read_hi(self):
+        while not self.closed.is_set():
+            try:
+                data, client = self.out_sock.recvfrom(MAX_PACKET)
+            except socket.timeout:
+                continue
+            except OSError:
+                return
+            if data == b"hi":
+                self.client = client
+                self.registered.set()
+
+    def read_socket(self):
+        while not self.closed.is_set():
+            try:
+                self.receiver.feed(self.in_sock.recv(MAX_PACKET))
+            except socket.timeout:
+                continue
+            except OSError:
+                return
+
+    def read_fifo(self):
+        while not self.closed.is_set():
+            r, _, _ = select.select([self.in_fd], [], [], 0.5)
+            if not r:
+                continue
+            try:
+                data = os.read(self.in_fd, MAX_PACKET)
+            except BlockingIOError:
+                continue
+            except OSError:
+                return
+            self.receiver.feed(data)
+
+    def send(self, packet):
+        # Like a packet read from TUN. Returns False if there's no one to
+        # send it to (yet).
+        if self.kind == "fifo":
+            os.write(self.out_fd, packet)
+            return True
+        if self.client is None:
+            return False
+        try:
+            self.out_sock.sendto(packet, self.client)
+        except OSError:
+            return False
+        return True
+
+    def close(self):
+        self.closed.set()
+        if self.kind == "fifo":
+            os.close(self.out_fd)
+            os.close(self.in_fd)
+        else:
+            self.out_sock.close()
+            self.in_sock.close()
@@ -0,0 +1,616 @@
+#!/usr/bin/env python3
+# Loopback benchmark for the transports: each one is run on this box against a
+# fake IPOW (fakeipow.py, no TUN needed), with stand-ins for the far end where
+# the real one needs a second box (standins.py):
+#
+#   tcp   - tcp-client.py -> tcp-server.py over 127.0.0.1
+#   udp   - udp.py -> udp.py over 127.0.0.1
+#   dns   - dns-client.py -> a local DNS server decoding what dns-server.py
+#           would
+#   icmp  - icmp-client.py -> a local echo responder (raw socket, so root;
+#           icmp-client.py needs it anyway)
+#   audio - audio.py sending to itself over the in-memory loopback cable
+#
+# A synthetic packet mix (--mix) goes in on one end, and what comes out on the
+# other is matched against it. Reported are packets and Mbit per second,
+# latency percentiles (from the packet going into IPOW to it coming out on the
+# other side) and the transports' CPU time per packet (user + system, of the
+# transport processes and whatever they started).
+#
+# Packets are sent as fast as the transport takes them with at most --window
+# of them on the way (or at --rate per second). Packets not there after --idle
+# seconds without anything arriving are counted as lost.
+#
+# The numbers only mean something compared to the same box, so baselines are
+# per host: --save-baseline writes baselines/<hostname>.json (or the given
+# file), --check compares against it and exits with 1 if anything got worse
+# by more than --threshold, e.g.:
+#
+#   python loopbench.py tcp audio --save-baseline
+#   (change things)
+#   python loopbench.py tcp audio --check
+#
+# Except for what gets through: nothing should get lost on a loopback, so
+# delivery going down by more than DELIVERY_THRESHOLD, or any more unexpected
+# packets or garbage than in the baseline, is a regression whatever
+# --threshold says. baselines/box1.json (and box2.json) is there for the
+# Docker boxes (docker-compose.yml); it was measured on a one-CPU host ("host"
+# in it says which), with every scenario at 100% delivery, audio included.
+# Re-save it from inside a box for timings of the box's own.
+import argparse
+import collections
+import json
+import os
+import random
+import shlex
+import shutil
+import signal
+import socket
+import struct
+import subprocess
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+import hdrcomp
+import tracing
+
+import fakeipow
+import standins
+
+TRANSPORTS = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')
+BASELINES = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'baselines')
+
+SOURCE = bytes([10, 0, 0, 1])
+DESTINATION = bytes([10, 0, 0, 2])
+WARM_UP_SOURCE = bytes([10, 0, 0, 3])
+
+PROTO_ICMP = 1
+PROTO_TCP = 6
+PROTO_UDP = 17
+
+# (weight, kind, IP packet size); "tcp" with a size of 40 is a bare ACK.
+MIXES = {
+    "mixed": [(4, "tcp", 40), (2, "icmp", 84), (1, "udp", 100), (1, "tcp", 300)],
+    "ping": [(1, "icmp", 84)],
+    "ack": [(1, "tcp", 40)],
+    "bulk": [(1, "tcp", 1400)],
+    "imix": [(7, "tcp", 40), (4, "tcp", 576), (1, "tcp", 1500)],
+}
+
+# Higher is better, or not.
+METRICS = (
+    ("pps", "pps", True),
+    ("mbps", "Mbit/s", True),
+    ("delivered", "delivered", True),
+    ("p50_ms", "p50 ms", False),
+    ("p99_ms", "p99 ms", False),
+    ("cpu_us", "CPU us/pkt", False),
+)
+
+DELIVERY_THRESHOLD = 0.005
+
+# What came out that shouldn't have (lower is better, and 0 is what it should
+# be).
+CORRUPTION = (
+    ("unexpected", "unexpected"),
+    ("garbled", "garbage B"),
+)
+
+
+def ipv4(proto, payload, ident, source):
+    header = bytearray(struct.pack(
+        "!BBHHHBBH4s4s", 0x45, 0, 20 + len(payload), ident, 0x4000, 64, proto,
+        0, source, DESTINATION
+    ))
+    header[10:12] = struct.pack("!H", hdrcomp.checksum(header))
+    return bytes(header) + payload
+
+
+def with_checksum(segment, proto, source, offset):
+    segment = bytearray(segment)
+    pseudo = source + DESTINATION + struct.pack("!BBH", 0, proto, len(segment))
+    segment[offset:offset + 2] = struct.pack(
+        "!H", hdrcomp.checksum(pseudo + segment)
+    )
+    return bytes(segment)
+
+
+class PacketMaker:
+    # One TCP flow, one ping, one UDP flow; every packet is different (the IP
+    # ID is the packet's number, and the sequence numbers move).
+    def __init__(self, source, rng):
+        self.source = source
+        self.rng = rng
+        self.count = 0
+        self.tcp_seq = rng.randrange(1 << 32)
+        self.tcp_ack = rng.randrange(1 << 32)
+
+    def make(self, kind, size):
+        ident = self.count & 0xffff
+        self.count += 1
+
+        if kind == "tcp":
+            payload = self.rng.randbytes(max(0, size - 40))
+            flags = 0x18 if payload else 0x10
+            segment = struct.pack(
+                "!HHIIBBHHH", 40000, 22, self.tcp_seq, self.tcp_ack, 5 << 4,
+                flags, 502, 0, 0
+            ) + payload
+            self.tcp_seq = (self.tcp_seq + len(payload)) & 0xffffffff
+            self.tcp_ack = (self.tcp_ack + 48) & 0xffffffff
+            return ipv4(PROTO_TCP, with_checksum(segment, PROTO_TCP, self.source, 16),
+                        ident, self.source)
+
+        if kind == "icmp":
+            message = bytearray(struct.pack("!BBHHH", 8, 0, 0, 0x1234, ident) +
+                                self.rng.randbytes(max(0, size - 28)))
+            message[2:4] = struct.pack("!H", hdrcomp.checksum(message))
+            return ipv4(PROTO_ICMP, bytes(message), ident, self.source)
+
+        payload = self.rng.randbytes(max(0, size - 28))
+        datagram = struct.pack("!HHHH", 40000, 5000, 8 + len(payload), 0) + payload
+        return ipv4(PROTO_UDP, with_checksum(datagram, PROTO_UDP, self.source, 6),
+                    ident, self.source)
+
+
+def make_packets(mix, count, rng):
+    maker = PacketMaker(SOURCE, rng)
+    weights = [weight for weight, _, _ in MIXES[mix]]
+    return [
+        maker.make(kind, size)
+        for _, kind, size in rng.choices(MIXES[mix], weights, k=count)
+    ]
+
+
+def free_port():
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+
+def cpu_seconds(pids):
+    # utime + stime of the processes and all their descendants, from /proc.
+    children = collections.defaultdict(list)
+    times = {}
+    for entry in os.listdir("/proc"):
+        if not entry.isdigit():
+            continue
+        try:
+            with open(f"/proc/{entry}/stat") as f:
+                fields = f.read().rsplit(")", 1)[1].split()
+        except OSError:
+            continue
+        children[int(fields[1])].append(int(entry))
+        times[int(entry)] = int(fields[11]) + int(fields[12])
+
+    total = 0
+    todo = list(pids)
+    while todo:
+        pid = todo.pop()
+        total += times.get(pid, 0)
+        todo.extend(children.get(pid, ()))
+    return total / os.sysconf("SC_CLK_TCK")
+
+
+class Run:
+    # One scenario's transports, fake IPOWs and stand-ins, in a temporary
+    # directory (which also gets the transports' logs).
+    def __init__(self, name, args):
+        self.name = name
+        self.extra_args = shlex.split(args.args)
+        self.directory = tempfile.mkdtemp(prefix=f"loopbench-{name}-")
+        self.processes = []  # (name, Popen, log path)
+        self.closers = []
+
+    def ipow(self, name, kind, receiver=None):
+        ipow = fakeipow.FakeIPOW(self.directory, name, kind, receiver)
+        self.closers.append(ipow.close)
+        return ipow
+
+    def standin(self, standin):
+        self.closers.append(standin.close)
+        return standin
+
+    def spawn(self, name, script, *argv):
+        log = os.path.join(self.directory, f"{name}.log")
+        process = subprocess.Popen(
+            [sys.executable, os.path.join(TRANSPORTS, script), *argv,
+             *self.extra_args],
+            stdin=subprocess.DEVNULL, stdout=open(log, "w"),
+            stderr=subprocess.STDOUT, env=dict(os.environ, PYTHONUNBUFFERED="1")
+        )
+        self.processes.append((name, process, log))
+        return process
+
+    def problem(self):
+        # Why a transport isn't running anymore, if it isn't.
+        for name, process, log in self.processes:
+            if process.poll() is None:
+                continue
+            with open(log) as f:
+                lines = [line.strip() for line in f if line.strip()]
+            last = lines[-1] if lines else "no output"
+            return f"{name} exited with {process.returncode}: {last}"
+        return None
+
+    def cpu(self):
+        return cpu_seconds([process.pid for _, process, _ in self.processes])
+
+    def close(self, keep=False):
+        for _, process, _ in self.processes:
+            if process.poll() is None:
+                process.send_signal(signal.SIGINT)
+        for _, process, _ in self.processes:
+            try:
+                process.wait(5)
+            except subprocess.TimeoutExpired:
+                process.kill()
+                process.wait()
+        for close in self.closers:
+            close()
+        if keep:
+            print(f"  logs in {self.directory}")
+        else:
+            shutil.rmtree(self.directory, ignore_errors=True)
+
+
+# Each returns the IPOW packets go into, and the Receiver they come out at.
+
+def setup_tcp(run):
+    port = str(free_port())
+    server = run.ipow("server", "fifo")
+    client = run.ipow("client", "fifo")
+    run.spawn("tcp-server", "tcp/tcp-server.py", "-l", "127.0.0.1", "-p", port,
+              "-i", server.outbound, "-o", server.inbound)
+    run.spawn("tcp-client", "tcp/tcp-client.py", "-c", "127.0.0.1", "-p", port,
+              "-i", client.outbound, "-o", client.inbound)
+    return client, server.receiver
+
+
+def setup_udp(run):
+    port = str(free_port())
+    server = run.ipow("server", "socket")
+    client = run.ipow("client", "socket")
+    run.spawn("udp-server", "udp/udp.py", "-l", "127.0.0.1", "-p", port,
+              "-t", "loopbench", "-i", server.outbound, "-o", server.inbound)
+    run.spawn("udp-client", "udp/udp.py", "-l", "127.0.0.1", "-p", "0",
+              "-c", f"127.0.0.1:{port}", "-t", "loopbench",
+              "-i", client.outbound, "-o", client.inbound)
+    return client, server.receiver
+
+
+def setup_dns(run):
+    server = run.standin(standins.DNSServer(fakeipow.Receiver()))
+    host, port = server.address
+    client = run.ipow("client", "fifo")
+    run.spawn("dns-client", "dns/dns-client.py", "-s", host, "-P", str(port),
+              "-d", "c.loopbench.test", "-i", client.outbound,
+              "-o", client.inbound)
+    return client, server.receiver
+
+
+def setup_icmp(run):
+    responder = run.standin(standins.ICMPResponder(fakeipow.Receiver()))
+    client = run.ipow("client", "fifo")
+    run.spawn("icmp-client", "icmp/icmp-client.py", "-c", responder.address,
+              "-i", client.outbound, "-o", client.inbound)
+    return client, responder.receiver
+
+
+def setup_audio(run):
+    ipow = run.ipow("tun", "socket")
+    run.spawn("audio", "audio/audio.py", "-b", "loopback", "-O", "cable",
+              "-I", "cable", "-i", ipow.outbound, "-o", ipow.inbound)
+    return ipow, ipow.receiver
+
+
+# Name -> (setup, default packet count, --window, --idle).
+SCENARIOS = {
+    "tcp": (setup_tcp, 5000, 16, 1.0),
+    "udp": (setup_udp, 5000, 16, 1.0),
+    "dns": (setup_dns, 500, 16, 3.0),
+    "icmp": (setup_icmp, 500, 16, 3.0),
+    "audio": (setup_audio, 20, 4, 10.0),
+}
+
+
+def warm_up(run, ipow, receiver, timeout, idle):
+    # Until a packet makes it through: the transports are up, connected,
+    # calibrated etc. Returns what went wrong, if anything.
+    maker = PacketMaker(WARM_UP_SOURCE, random.Random(0))
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        problem = run.problem()
+        if problem:
+            return problem
+        if not ipow.registered.wait(0.1):
+            continue
+
+        packet = maker.make("icmp", 84)
+        receiver.expect(packet)
+        ipow.send(packet)
+        wait_until = time.monotonic() + min(idle, 2.0)
+        while receiver.pending(packet) and time.monotonic() < wait_until:
+            receiver.wait(0.1)
+        if not receiver.pending(packet):
+            receiver.reset()
+            return None
+
+    return f"nothing came through in {timeout:g} s"
+
+
+def send(ipow, receiver, packets, rate, window, idle):
+    in_flight = collections.deque()  # (sent, packet)
+    start = time.perf_counter()
+    for i, packet in enumerate(packets):
+        if rate:
+            delay = start + i / rate - time.perf_counter()
+            if delay > 0:
+                time.sleep(delay)
+
+        while True:
+            now = time.perf_counter()
+            while in_flight and (not receiver.waiting(in_flight[0][1], in_flight[0][0]) or
+                                 now - in_flight[0][0] > idle):
+                in_flight.popleft()
+            if len(in_flight) < window:
+                break
+            receiver.wait(0.05)
+
+        sent = receiver.expect(packet, i)
+        ipow.send(packet)
+        in_flight.append((sent, packet))
+    return start
+
+
+def drain(receiver, idle):
+    # Until everything arrived, or nothing did for idle seconds.
+    last_left = None
+    last_progress = time.monotonic()
+    while time.monotonic() - last_progress < idle:
+        left = receiver.wait(0.1)
+        if not left:
+            return
+        if left != last_left:
+            last_left = left
+            last_progress = time.monotonic()
+
+
+def run_scenario(name, args):
+    setup, default_count, default_window, default_idle = SCENARIOS[name]
+    count = args.count or default_count
+    window = args.window or default_window
+    idle = args.idle or default_idle
+    packets = make_packets(args.mix, count, random.Random(args.seed))
+
+    run = Run(name, args)
+    try:
+        try:
+            ipow, receiver = setup(run)
+        except OSError as e:
+            return None, f"can't set up: {e}"
+
+        problem = warm_up(run, ipow, receiver, args.startup_timeout, idle)
+        if problem:
+            return None, problem
+
+        cpu = run.cpu()
+        start = send(ipow, receiver, packets, args.rate, window, idle)
+        drain(receiver, idle)
+        cpu = run.cpu() - cpu
+
+        with receiver.lock:
+            latencies = sorted(receiver.latencies)
+            received_bytes = receiver.received_bytes
+            seconds = (receiver.last_received or start) - start
+            unexpected = receiver.unexpected
+            garbled = receiver.garbled
+    finally:
+        run.close(args.keep)
+
+    delivered = len(latencies)
+    result = {
+        "mix": args.mix,
+        "count": count,
+        "delivered": delivered / count,
+        "pps": delivered / seconds if seconds > 0 else 0.0,
+        "mbps": received_bytes * 8 / seconds / 1e6 if seconds > 0 else 0.0,
+        "p50_ms": tracing.percentile(latencies, 50) * 1000 if latencies else None,
+        "p99_ms": tracing.percentile(latencies, 99) * 1000 if latencies else None,
+        "cpu_us": cpu / delivered * 1e6 if delivered else None,
+        "unexpected": unexpected,
+        "garbled": garbled,
+    }
+    notes = []
+    if unexpected:
+        notes.append(f"{unexpected} unexpected packets")
+    if garbled:
+        notes.append(f"{garbled} bytes of garbage")
+    return result, ", ".join(notes)
+
+
+def format_value(key, value):
+    if value is None:
+        return "-"
+    if key == "delivered":
+        return f"{value * 100:.1f}%"
+    if key == "mbps":
+        return f"{value:.3f}"
+    return f"{value:.1f}"
+
+
+def print_results(results):
+    header = f"{'scenario':<10}{'mix':<8}{'packets':>8}"
+    header += "".join(f"{label:>12}" for _, label, _ in METRICS)
+    print(header)
+    for name, result in results.items():
+        line = f"{name:<10}{result['mix']:<8}{result['count']:>8}"
+        line += "".join(
+            f"{format_value(key, result[key]):>12}" for key, _, _ in METRICS
+        )
+        print(line)
+
+
+def check(results, baseline, threshold):
+    # Prints what changed compared to the baseline; returns True if anything
+    # got worse by more than threshold (relative).
+    regressed = False
+    for name, result in results.items():
+        old = baseline.get(name)
+        if old is None:
+            print(f"{name}: not in the baseline")
+            continue
+        if (old["mix"], old["count"]) != (result["mix"], result["count"]):
+            print(f"{name}: baseline was {old['count']} packets of "
+                  f"'{old['mix']}', not comparable")
+            continue
+
+        for key, label, higher_is_better in METRICS:
+            before, after = old.get(key), result[key]
+            if not before or after is None:
+                continue
+            change = (after - before) / before
+            worse = -change if higher_is_better else change
+            limit = DELIVERY_THRESHOLD if key == "delivered" else threshold
+            verdict = "REGRESSION" if worse > limit else ""
+            regressed = regressed or bool(verdict)
+            print(f"{name:<10}{label:<12}{format_value(key, before):>10} -> "
+                  f"{format_value(key, after):<10}{change * 100:+7.1f}%  {verdict}")
+
+        for key, label in CORRUPTION:
+            before, after = old.get(key, 0), result[key]
+            if after or before:
+                verdict = "REGRESSION" if after > before else ""
+                regressed = regressed or bool(verdict)
+                print(f"{name:<10}{label:<12}{before:>10} -> {after:<10}"
+                      f"{'':>8}  {verdict}")
+
+    for name in baseline:
+        if name not in results:
+            print(f"{name}: in the baseline, but didn't run")
+    return regressed
+
+
+def baseline_path(path):
+    return path or os.path.join(BASELINES, f"{socket.gethostname()}.json")
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Loopback benchmark for the transports"
+    )
+    parser.add_argument(
+        "scenarios", nargs="*",
+        help=f"What to run (default: all of {', '.join(SCENARIOS)})"
+    )
+    parser.add_argument(
+        "--mix", choices=MIXES.keys(), default="mixed",
+        help="Packet mix: " + "; ".join(
+            f"{name}: " + ", ".join(f"{w}x {kind} {size}" for w, kind, size in mix)
+            for name, mix in MIXES.items()
+        )
+    )
+    parser.add_argument(
+        "-n", "--count", type=int,
+        help="Packets to send (default: " + ", ".join(
+            f"{name} {count}" for name, (_, count, _, _) in SCENARIOS.items()
+        ) + ")"
+    )
+    parser.add_argument(
+        "--rate", type=float, default=0,
+        help="Packets per second (default: as fast as they're taken)"
+    )
+    parser.add_argument(
+        "--window", type=int,
+        help="At most this many packets on the way (default: 4 for audio, "
+             "16 for the rest)"
+    )
+    parser.add_argument(
+        "--idle", type=float,
+        help="Seconds without anything arriving after which the rest counts "
+             "as lost (default: 1 for tcp, 10 for audio, 3 for the rest)"
+    )
+    parser.add_argument(
+        "--startup-timeout", type=float, default=30.0,
+        help="Seconds to wait for the first packet to make it through "
+             "(default 30)"
+    )
+    parser.add_argument(
+        "--args", type=str, default="",
+        help='More arguments for every transport, e.g. --args="-z"'
+    )
+    parser.add_argument("--seed", type=int, default=1, help="Random seed")
+    parser.add_argument(
+        "--keep", action="store_true",
+        help="Keep the temporary directories (with the transports' logs)"
+    )
+    parser.add_argument(
+        "--save-baseline", nargs="?", const="", metavar="FILE",
+        help="Save the results as the baseline (default: "
+             "baselines/<hostname>.json)"
+    )
+    parser.add_argument(
+        "--check", nargs="?", const="", metavar="FILE",
+        help="Compare with the baseline, exit with 1 on a regression"
+    )
+    parser.add_argument(
+        "--threshold", type=float, default=0.2,
+        help="How much worse (relative) counts as a regression (default 0.2)"
+    )
+    args = parser.parse_args()
+
+    for name in args.scenarios:
+        if name not in SCENARIOS:
+            parser.error(f"unknown scenario '{name}'")
+
+    # Before spending minutes on the scenarios.
+    if args.check is not None and not os.path.exists(baseline_path(args.check)):
+        parser.error(
+            f"no baseline at {baseline_path(args.check)}, make one with "
+            f"--save-baseline first (or give one to --check)"
+        )
+
+    results = {}
+    for name in args.scenarios or SCENARIOS:
+        print(f"{name}: running", flush=True)
+        result, note = run_scenario(name, args)
+        if result is None:
+            print(f"{name}: skipped ({note})")
+            continue
+        if note:
+            print(f"{name}: {note}")
+        results[name] = result
+
+    if results:
+        print()
+        print_results(results)
+
+    regressed = False
+    if args.check is not None:
+        path = baseline_path(args.check)
+        with open(path) as f:
+            baseline = json.load(f)["results"]
+        print()
+        print(f"Compared with {path} (threshold {args.threshold * 100:g}%):")
+        regressed = check(results, baseline, args.threshold)
+
+    if args.save_baseline is not None and results:
+        path = baseline_path(args.save_baseline)
+        os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+        baseline = {"host": socket.gethostname(), "results": {}}
+        if os.path.exists(path):
+            with open(path) as f:
+                baseline = json.load(f)
+        # Only the scenarios which ran are replaced.
+        baseline["results"].update(results)
+        with open(path, "w") as f:
+            json.dump(baseline, f, indent=2, sort_keys=True)
+        print(f"Baseline saved to {path}")
+
+    sys.exit(1 if regressed else 0)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,159 @@
+#!/usr/bin/env python3
+# Replays a capture (../capture/capture.py, or any pcap/pcapng of raw IP or
+# Ethernet, e.g. from "tcpdump -i tun0") through one of loopbench.py's
+# transport setups, and checks what comes out on the other side:
+#
+#   python replay.py audio.pcapng tcp               # original speed
+#   python replay.py audio.pcapng tcp --speed 10    # 10x faster
+#   python replay.py audio.pcapng audio --max       # as fast as it goes
+#
+# Only one direction is replayed (--direction, default "out", i.e. what went
+# from IPOW to the transport; captures without directions are taken as a
+# whole). Every packet has to come out byte for byte; reported are the lost
+# ones, the ones which came out of order, anything which came out but wasn't
+# sent (i.e. corrupted), and the latency the transport added (from the packet
+# going into IPOW on one side to coming out on the other).
+import argparse
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+import pcap
+import tracing
+
+import loopbench
+
+
+def load(path, direction):
+    # [(timestamp in nanoseconds, packet)]
+    packets = []
+    for timestamp, packet_direction, packet in pcap.read(path):
+        if packet_direction in (None, direction):
+            packets.append((timestamp, packet))
+    return packets
+
+
+def replay(ipow, receiver, packets, speed):
+    # Sends the packets at their times (relative to the first), speed times
+    # faster. Returns how late (seconds) the latest one was sent.
+    start = time.perf_counter()
+    first = packets[0][0]
+    late = 0.0
+    for number, (timestamp, packet) in enumerate(packets):
+        if timestamp is not None and first is not None:
+            due = start + (timestamp - first) / 1e9 / speed
+            delay = due - time.perf_counter()
+            if delay > 0:
+                time.sleep(delay)
+            late = max(late, time.perf_counter() - due)
+        receiver.expect(packet, number)
+        ipow.send(packet)
+    return late
+
+
+def reordered(order):
+    # Packets which came after one sent later than them.
+    count = 0
+    highest = -1
+    for number in order:
+        if number < highest:
+            count += 1
+        highest = max(highest, number)
+    return count
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Replays a capture through a transport"
+    )
+    parser.add_argument("capture", help="pcap/pcapng file")
+    parser.add_argument("scenario", choices=loopbench.SCENARIOS.keys(),
+                        help="Transport setup (see loopbench.py)")
+    parser.add_argument(
+        "--direction", choices=[pcap.OUTBOUND, pcap.INBOUND],
+        default=pcap.OUTBOUND,
+        help='Which packets to replay: "out" (IPOW to transport, default) '
+             'or "in"'
+    )
+    parser.add_argument("--speed", type=float, default=1.0,
+                        help="Replay this many times faster (default 1)")
+    parser.add_argument(
+        "--max", action="store_true",
+        help="As fast as the transport takes them (with at most --window on "
+             "the way)"
+    )
+    parser.add_argument("--window", type=int,
+                        help="For --max (default: as for loopbench.py)")
+    parser.add_argument(
+        "--idle", type=float,
+        help="Seconds without anything arriving after which the rest counts "
+             "as lost (default: as for loopbench.py)"
+    )
+    parser.add_argument("--startup-timeout", type=float, default=30.0,
+                        help="Seconds to wait for the transport to come up")
+    parser.add_argument("--args", type=str, default="",
+                        help="More arguments for the transports")
+    parser.add_argument("--keep", action="store_true",
+                        help="Keep the temporary directory (with the logs)")
+    args = parser.parse_args()
+
+    packets = load(args.capture, args.direction)
+    if not packets:
+        print(f"No '{args.direction}' packets in {args.capture}")
+        sys.exit(1)
+    if packets[0][0] is not None:
+        duration = (packets[-1][0] - packets[0][0]) / 1e9
+        print(f"{len(packets)} packets, {duration:.1f} s in the capture")
+
+    setup, _, default_window, default_idle = loopbench.SCENARIOS[args.scenario]
+    idle = args.idle or default_idle
+
+    run = loopbench.Run(args.scenario, args)
+    try:
+        ipow, receiver = setup(run)
+        problem = loopbench.warm_up(run, ipow, receiver, args.startup_timeout,
+                                    idle)
+        if problem:
+            print(f"{args.scenario}: {problem}")
+            sys.exit(1)
+
+        started = time.perf_counter()
+        late = 0.0
+        if args.max:
+            loopbench.send(ipow, receiver, [packet for _, packet in packets], 0,
+                           args.window or default_window, idle)
+        else:
+            late = replay(ipow, receiver, packets, args.speed)
+        loopbench.drain(receiver, idle)
+
+        with receiver.lock:
+            latencies = sorted(receiver.latencies)
+            order = list(receiver.order)
+            lost = receiver.outstanding
+            unexpected = receiver.unexpected
+            garbled = receiver.garbled
+            last = receiver.last_received or started
+    finally:
+        run.close(args.keep)
+
+    count = len(packets)
+    print(f"Replayed {count} packets in {last - started:.1f} s"
+          + (f" (sent up to {late * 1000:.0f} ms late)" if late > 0.001 else ""))
+    print(f"  delivered:  {len(latencies)} ({len(latencies) / count * 100:.1f}%)")
+    print(f"  lost:       {lost}")
+    print(f"  reordered:  {reordered(order)}")
+    print(f"  corrupted:  {unexpected} packets, {garbled} bytes of garbage")
+    if latencies:
+        print(
+            "  latency:    " + ", ".join(
+                f"p{p} {tracing.percentile(latencies, p) * 1000:.1f} ms"
+                for p in (50, 90, 99)
+            ) + f", max {latencies[-1] * 1000:.1f} ms"
+        )
+
+    sys.exit(0 if not lost and not unexpected and not garbled else 1)
+
+
+if __name__ == "__main__":
+    main()
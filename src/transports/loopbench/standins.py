@@ -0,0 +1,130 @@
+# Stand-ins for the far end of the DNS and ICMP transports. The real servers
+# sniff with scapy on an interface and answer with raw packets, which doesn't
+# work on a single box (or without scapy); these do the same decoding in plain
+# sockets and hand the packets straight to a Receiver, i.e. they stand in for
+# the server transport and the IPOW behind it.
+#
+# Neither has anything to send back, so they answer with empty replies.
+import re
+import socket
+import struct
+import sys
+import threading
+
+import hdrcomp
+
+DNS_TYPE_A = 1
+DNS_TYPE_TXT = 16
+
+ICMP_ECHO_REPLY = 0
+ICMP_ECHO_REQUEST = 8
+
+
+class DNSServer:
+    # What dns-server.py does with a query: <hex payload labels>.<no>.<serial>
+    # .c.<domain>, "ZZ" if there's nothing. A queries get 127.0.0.1, TXT
+    # queries get "1." (no data this way).
+    def __init__(self, receiver, host="127.0.0.1", port=0):
+        self.receiver = receiver
+        self.decompressor = hdrcomp.HeaderDecompressor()
+        self.sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        self.sock.bind((host, port))
+        self.address = self.sock.getsockname()
+        self.queries = 0
+        threading.Thread(target=self.serve, daemon=True).start()
+
+    def serve(self):
+        while True:
+            try:
+                query, client = self.sock.recvfrom(4096)
+            except OSError:
+                return
+            reply = self.answer(query)
+            if reply:
+                self.sock.sendto(reply, client)
+
+    def answer(self, query):
+        if len(query) < 12:
+            return None
+        query_id, flags, qdcount = struct.unpack("!HHH", query[:6])
+        if flags & 0x8000 or qdcount != 1:
+            return None
+
+        labels = []
+        i = 12
+        while i < len(query) and query[i]:
+            labels.append(query[i + 1:i + 1 + query[i]].decode("ascii", "replace"))
+            i += 1 + query[i]
+        i += 1
+        if i + 4 > len(query):
+            return None
+        qtype, _ = struct.unpack("!HH", query[i:i + 4])
+        question = query[12:i + 4]
+        self.queries += 1
+
+        if qtype == DNS_TYPE_TXT:
+            m = re.match(r'^(.*)\.[\d]+\.[\d]+\.c\..*$', ".".join(labels))
+            if m:
+                payload = m.group(1).replace(".", "")
+                if payload and payload.upper() != "ZZ":
+                    try:
+                        packet = self.decompressor.decompress(bytes.fromhex(payload))
+                    except ValueError:
+                        packet = None
+                    if packet:
+                        self.receiver.feed(packet)
+            txt = b"1."
+            rdata = bytes([len(txt)]) + txt
+        elif qtype == DNS_TYPE_A:
+            rdata = socket.inet_aton("127.0.0.1")
+        else:
+            return struct.pack("!HHHHHH", query_id, 0x8180, 1, 0, 0, 0) + question
+
+        answer = struct.pack("!HHHIH", 0xc00c, qtype, 1, 10, len(rdata)) + rdata
+        return struct.pack("!HHHHHH", query_id, 0x8400, 1, 1, 0, 0) + question + answer
+
+    def close(self):
+        self.sock.close()
+
+
+class ICMPResponder:
+    # What icmp-server.py does: the payload of every echo request is a packet
+    # (or nothing), the echo reply carries whatever goes back (here: nothing).
+    # Needs a raw socket, i.e. root. If the kernel answers pings as well
+    # (net.ipv4.icmp_echo_ignore_all=0) the client gets its own packets back
+    # half the time; they only show up on its side, which isn't measured.
+    def __init__(self, receiver, address="127.0.0.1"):
+        self.receiver = receiver
+        self.address = address
+        self.sock = socket.socket(
+            socket.AF_INET, socket.SOCK_RAW, socket.IPPROTO_ICMP
+        )
+        self.requests = 0
+        threading.Thread(target=self.serve, daemon=True).start()
+
+    def serve(self):
+        while True:
+            try:
+                packet, (source, _) = self.sock.recvfrom(65536)
+            except OSError:
+                return
+            header = (packet[0] & 0x0f) * 4
+            icmp = packet[header:]
+            if (len(icmp) < 8 or icmp[0] != ICMP_ECHO_REQUEST or
+                    socket.inet_ntoa(packet[16:20]) != self.address):
+                continue
+            self.requests += 1
+
+            payload = icmp[8:]
+            if payload:
+                self.receiver.feed(payload)
+
+            reply = bytearray(struct.pack("!BBH", ICMP_ECHO_REPLY, 0, 0) + icmp[4:8])
+            reply[2:4] = struct.pack("!H", hdrcomp.checksum(reply))
+            try:
+                self.sock.sendto(bytes(reply), (source, 0))
+            except OSError as e:
+                print(f"ICMP responder: {e}", file=sys.stderr)
+
+    def close(self):
+        self.sock.close()
@@ -0,0 +1,164 @@
+#!/usr/bin/env python3
+# How long each transport takes to start, and how much memory that takes -
+# i.e. what a supervisor restart costs before a single packet flows. Each one
+# is started through ipow-transport with -h, which gets through all of its
+# imports and its argument parser, and exits right there:
+#
+#   python startup.py                    # all of them
+#   python startup.py udp icmp-client
+#   python startup.py --save-baseline    # then, after changes:
+#   python startup.py --check
+#
+# Reported are the median and the best wall time of --runs starts, and the
+# peak RSS of the process. Baselines are per host like loopbench.py's
+# (baselines/<hostname>-startup.json); --check exits with 1 if anything got
+# worse by more than --threshold. Transports whose dependencies aren't
+# installed are skipped.
+import argparse
+import importlib.util
+import json
+import os
+import socket
+import statistics
+import subprocess
+import sys
+import time
+
+CLI = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'ipow-transport.py')
+BASELINES = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'baselines')
+
+# Higher is worse for all of them.
+METRICS = (
+    ("median_ms", "median ms"),
+    ("best_ms", "best ms"),
+    ("rss_mb", "RSS MB"),
+)
+
+
+def plugins():
+    # Name -> modules it needs, from ipow-transport itself.
+    spec = importlib.util.spec_from_file_location("ipow_transport", CLI)
+    cli = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(cli)
+    return {name: requires for name, (_, _, requires) in cli.PLUGINS.items()}
+
+
+def start(argv):
+    # Returns (seconds, peak RSS in bytes) of one start.
+    started = time.perf_counter()
+    process = subprocess.Popen(argv, stdout=subprocess.DEVNULL,
+                               stderr=subprocess.DEVNULL)
+    _, status, usage = os.wait4(process.pid, 0)
+    seconds = time.perf_counter() - started
+    process.returncode = os.waitstatus_to_exitcode(status)
+    if process.returncode != 0:
+        raise RuntimeError(f"exited with {process.returncode}")
+    return seconds, usage.ru_maxrss * 1024
+
+
+def measure(argv, runs):
+    results = [start(argv) for _ in range(runs)]
+    times = [seconds for seconds, _ in results]
+    return {
+        "median_ms": statistics.median(times) * 1000,
+        "best_ms": min(times) * 1000,
+        "rss_mb": max(rss for _, rss in results) / 1e6,
+    }
+
+
+def print_results(results):
+    print(f"{'transport':<14}" + "".join(f"{label:>12}" for _, label in METRICS))
+    for name, result in results.items():
+        print(f"{name:<14}" + "".join(f"{result[key]:>12.1f}" for key, _ in METRICS))
+
+
+def check(results, baseline, threshold):
+    # Returns True if anything got worse by more than threshold (relative).
+    regressed = False
+    for name, result in results.items():
+        old = baseline.get(name)
+        if old is None:
+            print(f"{name}: not in the baseline")
+            continue
+        for key, label in METRICS:
+            before, after = old.get(key), result[key]
+            if not before:
+                continue
+            change = (after - before) / before
+            verdict = "REGRESSION" if change > threshold else ""
+            regressed = regressed or bool(verdict)
+            print(f"{name:<14}{label:<11}{before:>9.1f} -> {after:<9.1f}"
+                  f"{change * 100:+7.1f}%  {verdict}")
+    return regressed
+
+
+def baseline_path(path):
+    return path or os.path.join(BASELINES, f"{socket.gethostname()}-startup.json")
+
+
+def main():
+    available = plugins()
+    parser = argparse.ArgumentParser(
+        description="Startup time and memory of the transports"
+    )
+    parser.add_argument(
+        "transports", nargs="*",
+        help=f"What to start (default: all of {', '.join(available)})"
+    )
+    parser.add_argument("--runs", type=int, default=5,
+                        help="Starts per transport (default 5)")
+    parser.add_argument(
+        "--save-baseline", nargs="?", const="", metavar="FILE",
+        help="Save the results as the baseline (default: "
+             "baselines/<hostname>-startup.json)"
+    )
+    parser.add_argument(
+        "--check", nargs="?", const="", metavar="FILE",
+        help="Compare with the baseline, exit with 1 on a regression"
+    )
+    parser.add_argument(
+        "--threshold", type=float, default=0.3,
+        help="How much worse (relative) counts as a regression (default 0.3)"
+    )
+    args = parser.parse_args()
+
+    for name in args.transports:
+        if name not in available:
+            parser.error(f"unknown transport '{name}'")
+
+    # The interpreter alone, for comparison.
+    results = {"(python)": measure([sys.executable, "-c", "pass"], args.runs)}
+    for name in args.transports or available:
+        missing = [module for module in available[name]
+                   if importlib.util.find_spec(module) is None]
+        if missing:
+            print(f"{name}: skipped ({', '.join(missing)} not installed)")
+            continue
+        try:
+            results[name] = measure([sys.executable, CLI, name, "-h"], args.runs)
+        except RuntimeError as e:
+            print(f"{name}: skipped ({e})")
+
+    print()
+    print_results(results)
+
+    regressed = False
+    if args.check is not None:
+        with open(baseline_path(args.check)) as f:
+            baseline = json.load(f)["results"]
+        print()
+        regressed = check(results, baseline, args.threshold)
+
+    if args.save_baseline is not None:
+        path = baseline_path(args.save_baseline)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with open(path, "w") as f:
+            json.dump({"host": socket.gethostname(), "runs": args.runs,
+                       "results": results}, f, indent=2)
+        print(f"\nBaseline saved to {path}")
+
+    sys.exit(1 if regressed else 0)
+
+
+if __name__ == "__main__":
+    main()
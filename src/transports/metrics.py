@@ -0,0 +1,242 @@
+# Counters, gauges and histograms for the transports, in the Prometheus text
+# format. Either on a UNIX socket (the metrics are written to whoever connects,
+# e.g. "socat - UNIX-CONNECT:/var/run/dns-client.metrics", the same as
+# ipowd2's -m), or over HTTP on host:port/metrics (for Prometheus itself).
+#
+# Counting is meant to be cheap enough for the per-packet paths: every thread
+# updates its own shard (a plain dict), so there are no locks, and nothing is
+# formatted until someone asks for the metrics. Gauges are functions called
+# at that point (e.g. a queue's qsize).
+#
+# The servers' modules are only imported by serve(): http.server alone takes
+# longer to import than the rest of a transport's start, and most runs don't
+# serve metrics at all.
+import bisect
+import os
+import threading
+
+# Seconds.
+LATENCY_BUCKETS = (
+    0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0
+)
+
+
+def format_labels(labels):
+    if not labels:
+        return ""
+    return "{" + ",".join(
+        f'{name}="{value}"' for name, value in sorted(labels.items())
+    ) + "}"
+
+
+class Counter:
+    def __init__(self, registry, key):
+        self.registry = registry
+        self.key = key
+
+    def inc(self, value=1):
+        shard = self.registry.shard()
+        shard[self.key] = shard.get(self.key, 0) + value
+
+
+class Histogram:
+    def __init__(self, registry, key, buckets):
+        self.registry = registry
+        self.key = key
+        self.buckets = buckets
+
+    def observe(self, value):
+        shard = self.registry.shard()
+        counts = shard.get(self.key)
+        if counts is None:
+            # Per bucket (the last one is +Inf), then the sum and the count.
+            counts = shard[self.key] = [0] * (len(self.buckets) + 3)
+        counts[bisect.bisect_left(self.buckets, value)] += 1
+        counts[-2] += value
+        counts[-1] += 1
+
+
+class Registry:
+    def __init__(self):
+        self.labels = {}  # Added to everything, e.g. the transport's name.
+        self.metrics = {}  # Name -> (type, help, {labels key -> handle})
+        self.local = threading.local()
+        self.shards = []
+        self.lock = threading.Lock()  # Only for adding shards and metrics.
+
+    def shard(self):
+        try:
+            return self.local.shard
+        except AttributeError:
+            shard = self.local.shard = {}
+            with self.lock:
+                self.shards.append(shard)
+            return shard
+
+    def add(self, kind, name, help_text, labels, make):
+        with self.lock:
+            _, _, handles = self.metrics.setdefault(name, (kind, help_text, {}))
+            key = (name, tuple(sorted(labels.items())))
+            if key not in handles:
+                handles[key] = make(key)
+            return handles[key]
+
+    def counter(self, name, help_text, **labels):
+        return self.add(
+            "counter", name, help_text, labels, lambda key: Counter(self, key)
+        )
+
+    def histogram(self, name, help_text, buckets=LATENCY_BUCKETS, **labels):
+        return self.add(
+            "histogram", name, help_text, labels,
+            lambda key: Histogram(self, key, buckets)
+        )
+
+    def gauge(self, name, help_text, function, **labels):
+        return self.add("gauge", name, help_text, labels, lambda key: function)
+
+    def collect(self, key):
+        # Sums up a counter/histogram over all the threads' shards.
+        total = None
+        with self.lock:
+            shards = list(self.shards)
+        for shard in shards:
+            value = shard.get(key)
+            if value is None:
+                continue
+            if isinstance(value, list):
+                value = list(value)
+                total = value if total is None else [
+                    a + b for a, b in zip(total, value)
+                ]
+            else:
+                total = value if total is None else total + value
+        return total
+
+    def render(self):
+        lines = []
+        with self.lock:
+            metrics = sorted(
+                (name, kind, help_text, list(handles.items()))
+                for name, (kind, help_text, handles) in self.metrics.items()
+            )
+
+        for name, kind, help_text, handles in metrics:
+            lines.append(f"# HELP {name} {help_text}")
+            lines.append(f"# TYPE {name} {kind}")
+            for (_, labels), handle in handles:
+                labels = dict(self.labels, **dict(labels))
+
+                if kind == "gauge":
+                    try:
+                        value = handle()
+                    except Exception:
+                        continue
+                    lines.append(f"{name}{format_labels(labels)} {value}")
+                    continue
+
+                value = self.collect(handle.key)
+                if kind == "counter":
+                    lines.append(f"{name}{format_labels(labels)} {value or 0}")
+                    continue
+
+                counts = value or [0] * (len(handle.buckets) + 3)
+                cumulative = 0
+                for bound, count in zip(handle.buckets + (float("inf"),), counts):
+                    cumulative += count
+                    le = "+Inf" if bound == float("inf") else f"{bound:g}"
+                    lines.append(
+                        f"{name}_bucket{format_labels(dict(labels, le=le))} "
+                        f"{cumulative}"
+                    )
+                lines.append(f"{name}_sum{format_labels(labels)} {counts[-2]}")
+                lines.append(f"{name}_count{format_labels(labels)} {counts[-1]}")
+
+        return "\n".join(lines) + "\n"
+
+
+class LinkMetrics:
+    # What every transport counts: packets and bytes going over the link
+    # ("out") and coming from it ("in").
+    def __init__(self, registry=None):
+        registry = registry or REGISTRY
+        packets = "Packets sent (out) / received (in) over the link"
+        octets = "Bytes sent (out) / received (in) over the link"
+        self.packets_out = registry.counter(
+            "ipow_link_packets_total", packets, direction="out"
+        )
+        self.packets_in = registry.counter(
+            "ipow_link_packets_total", packets, direction="in"
+        )
+        self.bytes_out = registry.counter(
+            "ipow_link_bytes_total", octets, direction="out"
+        )
+        self.bytes_in = registry.counter(
+            "ipow_link_bytes_total", octets, direction="in"
+        )
+
+    def sent(self, data):
+        self.packets_out.inc()
+        self.bytes_out.inc(len(data))
+
+    def received(self, data):
+        self.packets_in.inc()
+        self.bytes_in.inc(len(data))
+
+
+def serve(address, transport=None, registry=None):
+    # address is either a UNIX socket path, or [host:]port for HTTP. Returns
+    # the server (running in a daemon thread).
+    registry = registry or REGISTRY
+    if transport:
+        registry.labels["transport"] = transport
+
+    if "/" in address:
+        import socketserver
+
+        class MetricsDumpHandler(socketserver.BaseRequestHandler):
+            def handle(self):
+                self.request.sendall(self.server.registry.render().encode())
+
+        class UnixMetricsServer(socketserver.ThreadingMixIn,
+                                socketserver.UnixStreamServer):
+            daemon_threads = True
+
+        if os.path.exists(address):
+            os.unlink(address)
+        server = UnixMetricsServer(address, MetricsDumpHandler)
+        os.chmod(address, 0o666)
+    else:
+        import http.server
+
+        class MetricsHandler(http.server.BaseHTTPRequestHandler):
+            def do_GET(self):
+                if self.path.split("?")[0] not in ("/", "/metrics"):
+                    self.send_error(404)
+                    return
+                body = self.server.registry.render().encode()
+                self.send_response(200)
+                self.send_header("Content-Type", "text/plain; version=0.0.4")
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, format, *args):
+                pass  # No log line per scrape.
+
+        host, _, port = address.rpartition(":")
+        server = http.server.ThreadingHTTPServer(
+            (host or "127.0.0.1", int(port)), MetricsHandler
+        )
+        server.daemon_threads = True
+
+    server.registry = registry
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+
+# The one everything uses by default.
+REGISTRY = Registry()
+counter = REGISTRY.counter
+histogram = REGISTRY.histogram
+gauge = REGISTRY.gauge
@@ -0,0 +1,195 @@
+# Captures of IPOW traffic: raw IP packets (LINKTYPE_RAW) with nanosecond
+# timestamps and the direction they went in - "out" from IPOW to the transport
+# (i.e. leaving this box), "in" from the transport to IPOW. Plain pcap has no
+# place for the direction, so captures are written as pcapng (which Wireshark
+# and tcpdump read just the same). Reading also takes plain pcap (e.g.
+# "tcpdump -i tun0 -w ..."), with Ethernet, raw or IPv4/IPv6 link types;
+# packets in those have no direction (None).
+import struct
+import time
+
+OUTBOUND = "out"
+INBOUND = "in"
+
+LINKTYPE_ETHERNET = 1
+LINKTYPE_RAW = 101
+LINKTYPE_IPV4 = 228
+LINKTYPE_IPV6 = 229
+
+PCAPNG_SECTION_HEADER = 0x0a0d0d0a
+PCAPNG_INTERFACE_DESCRIPTION = 1
+PCAPNG_SIMPLE_PACKET = 3
+PCAPNG_ENHANCED_PACKET = 6
+PCAPNG_BYTE_ORDER_MAGIC = 0x1a2b3c4d
+
+OPTION_END = 0
+OPTION_IF_NAME = 2
+OPTION_IF_TSRESOL = 9
+OPTION_EPB_FLAGS = 2
+
+# epb_flags bits 0-1.
+DIRECTION_FLAGS = {INBOUND: 1, OUTBOUND: 2}
+FLAG_DIRECTIONS = {1: INBOUND, 2: OUTBOUND}
+
+# Plain pcap magic -> nanoseconds per timestamp fraction unit.
+PCAP_MAGIC = {0xa1b2c3d4: 1000, 0xa1b23c4d: 1}
+
+
+def pad(data):
+    return data + b"\0" * (-len(data) % 4)
+
+
+def block(block_type, body):
+    length = 12 + len(body)
+    return struct.pack("<II", block_type, length) + body + struct.pack("<I", length)
+
+
+def option(code, value):
+    return struct.pack("<HH", code, len(value)) + pad(value)
+
+
+class Writer:
+    def __init__(self, path, interface="ipow"):
+        self.file = open(path, "wb")
+        self.packets = 0
+        self.file.write(block(PCAPNG_SECTION_HEADER, struct.pack(
+            "<IHHq", PCAPNG_BYTE_ORDER_MAGIC, 1, 0, -1
+        )))
+        self.file.write(block(PCAPNG_INTERFACE_DESCRIPTION, struct.pack(
+            "<HHI", LINKTYPE_RAW, 0, 0
+        ) + option(OPTION_IF_NAME, interface.encode()) +
+            option(OPTION_IF_TSRESOL, bytes([9])) +  # Nanoseconds.
+            option(OPTION_END, b"")))
+
+    def write(self, packet, direction, timestamp=None):
+        # timestamp is in nanoseconds since the epoch (default: now).
+        if timestamp is None:
+            timestamp = time.time_ns()
+        self.file.write(block(PCAPNG_ENHANCED_PACKET, struct.pack(
+            "<IIIII", 0, timestamp >> 32, timestamp & 0xffffffff, len(packet),
+            len(packet)
+        ) + pad(packet) + option(
+            OPTION_EPB_FLAGS, struct.pack("<I", DIRECTION_FLAGS[direction])
+        ) + option(OPTION_END, b"")))
+        self.packets += 1
+
+    def flush(self):
+        self.file.flush()
+
+    def close(self):
+        self.file.close()
+
+
+def link_payload(linktype, data):
+    # The IP packet in a captured frame, or None.
+    if linktype in (LINKTYPE_RAW, LINKTYPE_IPV4, LINKTYPE_IPV6):
+        return data
+    if linktype == LINKTYPE_ETHERNET and len(data) >= 14:
+        if data[12:14] in (b"\x08\x00", b"\x86\xdd"):
+            return data[14:]
+    return None
+
+
+def read_pcap(f, header):
+    magic = struct.unpack("<I", header[:4])[0]
+    endian = "<" if magic in PCAP_MAGIC else ">"
+    magic = struct.unpack(endian + "I", header[:4])[0]
+    if magic not in PCAP_MAGIC:
+        raise ValueError("Not a pcap/pcapng file")
+    unit = PCAP_MAGIC[magic]
+    header += f.read(24 - len(header))
+    linktype = struct.unpack(endian + "I", header[20:24])[0] & 0xffff
+
+    while True:
+        record = f.read(16)
+        if len(record) < 16:
+            return
+        seconds, fraction, captured, _ = struct.unpack(endian + "IIII", record)
+        packet = link_payload(linktype, f.read(captured))
+        if packet:
+            yield seconds * 1000000000 + fraction * unit, None, packet
+
+
+def options(data, endian):
+    # {code: value}, of the options in data.
+    found = {}
+    while len(data) >= 4:
+        code, length = struct.unpack(endian + "HH", data[:4])
+        if code == OPTION_END:
+            break
+        found[code] = data[4:4 + length]
+        data = data[4 + length + (-length % 4):]
+    return found
+
+
+def read_pcapng(f):
+    endian = "<"
+    interfaces = []  # (linktype, (multiplier, divisor) from units to nanoseconds)
+    while True:
+        header = f.read(8)
+        if len(header) < 8:
+            return
+        block_type = struct.unpack(endian + "I", header[:4])[0]
+        if block_type == PCAPNG_SECTION_HEADER:
+            magic = f.read(4)
+            endian = "<" if struct.unpack("<I", magic)[0] == PCAPNG_BYTE_ORDER_MAGIC else ">"
+            length = struct.unpack(endian + "I", header[4:8])[0]
+            f.read(length - 12)
+            interfaces = []
+            continue
+
+        length = struct.unpack(endian + "I", header[4:8])[0]
+        body = f.read(length - 8)[:-4]
+
+        if block_type == PCAPNG_INTERFACE_DESCRIPTION:
+            linktype = struct.unpack(endian + "H", body[:2])[0]
+            unit = (1000, 1)  # Microseconds, unless said otherwise.
+            resolution = options(body[8:], endian).get(OPTION_IF_TSRESOL)
+            if resolution:
+                # Integers all the way, floats can't do current nanosecond
+                # timestamps exactly.
+                r = resolution[0]
+                if r & 0x80:
+                    unit = (1000000000, 1 << (r & 0x7f))
+                elif r <= 9:
+                    unit = (10 ** (9 - r), 1)
+                else:
+                    unit = (1, 10 ** (r - 9))
+            interfaces.append((linktype, unit))
+
+        elif block_type == PCAPNG_ENHANCED_PACKET:
+            interface, high, low, captured, _ = struct.unpack(
+                endian + "IIIII", body[:20]
+            )
+            linktype, (multiplier, divisor) = interfaces[interface]
+            packet = link_payload(linktype, body[20:20 + captured])
+            flags = options(body[20 + captured + (-captured % 4):], endian).get(
+                OPTION_EPB_FLAGS
+            )
+            direction = None
+            if flags:
+                direction = FLAG_DIRECTIONS.get(
+                    struct.unpack(endian + "I", flags)[0] & 3
+                )
+            if packet:
+                yield ((high << 32) | low) * multiplier // divisor, direction, packet
+
+        elif block_type == PCAPNG_SIMPLE_PACKET:
+            linktype, _ = interfaces[0]
+            original = struct.unpack(endian + "I", body[:4])[0]
+            packet = link_payload(linktype, body[4:4 + original])
+            if packet:
+                yield None, None, packet
+
+
+def read(path):
+    # Yields (timestamp in nanoseconds or None, direction or None, packet).
+    with open(path, "rb") as f:
+        header = f.read(4)
+        if len(header) < 4:
+            return
+        if struct.unpack("<I", header)[0] == PCAPNG_SECTION_HEADER:
+            f.seek(0)
+            yield from read_pcapng(f)
+        else:
+            yield from read_pcap(f, header)
@@ -0,0 +1,167 @@
+# Packets to and from IPOW (ipowd2) through shared memory instead of its
+# sockets: no sendto/recvfrom and no copying through the kernel per packet,
+# the packets from TUN are memoryviews straight into the ring. See the top of
+# ../ipowd2.c for how the rings work; in short, there's a memfd with two
+# rings (from IPOW, to IPOW), each with one producer and one consumer, and an
+# eventfd per direction which is only written to when a ring goes from empty
+# to not empty.
+#
+#   ring = shmring.RingClient('/var/run/tun_out.fifo')
+#   while True:
+#       select.select([ring], [], [], shmring.POLL_INTERVAL)
+#       for packet in ring.receive():
+#           ...                 # memoryview, good until release()
+#       ring.release()
+#       ring.send(b"...")       # False if the ring is full
+#
+# Python can't do memory fences, so a wakeup can (rarely) get lost either way;
+# both sides look at the rings every POLL_INTERVAL anyway, which is what the
+# select() timeout above is for. Plain stores of aligned 64-bit words (the
+# ring positions) are atomic on x86-64 and arm64, which is what this is for.
+import array
+import mmap
+import os
+import socket
+import struct
+import tempfile
+
+HEADER_SIZE = 192  # head, tail and size, each on its own cache line.
+HEAD = 0  # As 64-bit words.
+TAIL = 8
+SIZE_OFFSET = 128
+WRAP = 0xffffffff
+LENGTH = struct.Struct("=I")
+
+DEFAULT_SIZE = 4 << 20  # Of each ring.
+POLL_INTERVAL = 0.05  # ipowd2's RING_POLL_MS.
+
+
+class Ring:
+    def __init__(self, buffer, offset, size):
+        view = memoryview(buffer)[offset:offset + HEADER_SIZE + size]
+        self.header = view[:HEADER_SIZE]
+        self.words = self.header.cast("Q")
+        self.data = view[HEADER_SIZE:]
+        self.size = size
+        self.mask = size - 1
+        self.position = self.words[HEAD]  # Our own head or tail.
+
+    def init(self):
+        LENGTH.pack_into(self.header, SIZE_OFFSET, self.size)
+
+    # Consumer.
+    def take(self, limit):
+        # Up to limit packets (memoryviews), which stay put until commit().
+        packets = []
+        tail = self.position
+        head = self.words[HEAD]
+        while tail != head and len(packets) < limit:
+            offset = tail & self.mask
+            length = LENGTH.unpack_from(self.data, offset)[0]
+            if length == WRAP:
+                tail += self.size - offset
+                continue
+            packets.append(self.data[offset + 4:offset + 4 + length])
+            tail += (4 + length + 7) & ~7
+        self.position = tail
+        return packets
+
+    def commit(self):
+        self.words[TAIL] = self.position
+
+    # Producer.
+    def put(self, packet):
+        # Returns None if there's no room, otherwise whether the ring was
+        # empty (and the consumer needs waking up).
+        head = self.position
+        need = (4 + len(packet) + 7) & ~7
+        offset = head & self.mask
+        skip = self.size - offset if self.size - offset < need else 0
+        if need + skip > self.size - (head - self.words[TAIL]):
+            return None
+        if skip:
+            LENGTH.pack_into(self.data, offset, WRAP)
+            offset = 0
+        LENGTH.pack_into(self.data, offset, len(packet))
+        self.data[offset + 4:offset + 4 + len(packet)] = packet
+        self.position = head + skip + need
+        self.words[HEAD] = self.position
+        return self.words[TAIL] == head
+
+
+class RingClient:
+    def __init__(self, tun_outbound_path, size=DEFAULT_SIZE, gso=False):
+        if size & (size - 1) or size < 4096:
+            raise ValueError("Ring size has to be a power of two, 4096 or more")
+
+        # ipowd2 tells clients apart by their socket (and checks whether
+        # they're still there by it).
+        self.tmp_dir = tempfile.TemporaryDirectory()
+        self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM)
+        self.sock.bind(f"{self.tmp_dir.name}/ring_client")
+        self.sock.setblocking(False)
+
+        memfd = os.memfd_create("ipow-ring")
+        try:
+            os.ftruncate(memfd, 2 * (HEADER_SIZE + size))
+            self.map = mmap.mmap(memfd, 2 * (HEADER_SIZE + size))
+            self.inbound = Ring(self.map, 0, size)  # From IPOW.
+            self.outbound = Ring(self.map, HEADER_SIZE + size, size)
+            self.inbound.init()
+            self.outbound.init()
+
+            self.wakeup = os.eventfd(0, os.EFD_NONBLOCK | os.EFD_CLOEXEC)
+            self.kick = os.eventfd(0, os.EFD_NONBLOCK | os.EFD_CLOEXEC)
+            # (Not socket.send_fds(), which ignores address before 3.12.)
+            fds = array.array("i", [memfd, self.wakeup, self.kick])
+            self.sock.sendmsg(
+                [b"ring gso" if gso else b"ring"],
+                [(socket.SOL_SOCKET, socket.SCM_RIGHTS, fds)],
+                0, tun_outbound_path
+            )
+        finally:
+            os.close(memfd)
+
+        self.sent = 0
+        self.received = 0
+        self.dropped = 0
+
+    def fileno(self):
+        # Readable when there's something to receive() (mostly, see above).
+        return self.wakeup
+
+    def receive(self, limit=64):
+        try:
+            os.eventfd_read(self.wakeup)
+        except BlockingIOError:
+            pass
+        packets = self.inbound.take(limit)
+        self.received += len(packets)
+        if len(packets) == limit:
+            # There may be more; ipowd2 won't say so, the ring isn't empty.
+            os.eventfd_write(self.wakeup, 1)
+        return packets
+
+    def release(self):
+        # The packets from receive() are gone after this.
+        self.inbound.commit()
+        if self.inbound.words[HEAD] != self.inbound.position:
+            # Came in meanwhile, maybe without a wakeup (ipowd2 saw the
+            # old tail).
+            os.eventfd_write(self.wakeup, 1)
+
+    def send(self, packet):
+        was_empty = self.outbound.put(packet)
+        if was_empty is None:
+            self.dropped += 1
+            return False
+        self.sent += 1
+        if was_empty:
+            os.eventfd_write(self.kick, 1)
+        return True
+
+    def close(self):
+        os.close(self.wakeup)
+        os.close(self.kick)
+        self.sock.close()
+        self.tmp_dir.cleanup()
@@ -3,14 +3,30 @@
 import argparse
 import socket
 import os
+import queue
 import select
+import sys
 import time
 import logging
 
+# Shared by all the transports.
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+import framing
+import ipowwriter
+import lanes
+import metrics
+import tracing
+
 READ_BUFFER_SIZE = 1024
 
 logger = logging.getLogger("tcp-client")
 
+# Outbound packets, interactive ones first.
+fifo_queue = lanes.LaneQueue(logger=logger)
+
+stats = metrics.LinkMetrics()
+reconnects = metrics.counter("ipow_reconnects_total", "Connections made to the server")
+
 def tcp_connect(host, port, mode, fifo_in, fifo_out):
     mode_in = mode.lower().find('i') != -1
     mode_out = mode.lower().find('o') != -1
@@ -20,13 +36,14 @@ def tcp_connect(host, port, mode, fifo_in, fifo_out):
             logger.info(f"FIFO '{fifo_in}' doesn't exist")
             return
         fifo_in_fd = os.open(fifo_in, os.O_RDONLY | os.O_NONBLOCK)
+        splitter = framing.Splitter()
         logger.info(f"FIFO {fifo_in} opened for reading (in)")
 
     if mode_out:
         if not os.path.exists(fifo_out):
             logger.info(f"FIFO '{fifo_out}' doesn't exist")
             return
-        fifo_out_fd = os.open(fifo_out, os.O_WRONLY)
+        ipow = ipowwriter.IPOWWriter(fifo_out, logger=logger)
         logger.info(f"FIFO {fifo_out} opened for writing (out)")
 
     while True:
@@ -35,29 +52,57 @@ def tcp_connect(host, port, mode, fifo_in, fifo_out):
             client_socket = socket.socket()
             client_socket.connect((host, port))
             logger.info("Connected")
+            reconnects.inc()
 
             inputs = [client_socket]
             if mode_in:
                 inputs.append(fifo_in_fd)
 
             while True:
-                readable, _, _ = select.select(inputs, [], [])
+                outputs = [] if fifo_queue.empty() else [client_socket]
+                reading = inputs
+                if mode_out and ipow.pending():
+                    outputs = outputs + [ipow]
+                    if ipow.backlogged():
+                        # Leave it in the socket, TCP's window does the rest.
+                        reading = [fd for fd in inputs if fd is not client_socket]
+                readable, writable, _ = select.select(reading, outputs, [])
+
+                if mode_out and ipow in writable:
+                    ipow.flush()
 
                 for fd in readable:
                     if mode_in and fd == fifo_in_fd:
                         fifo_data = os.read(fifo_in_fd, READ_BUFFER_SIZE)
-                        if fifo_data:
-                            try:
-                                client_socket.sendall(fifo_data)
-                            except Exception as e:
-                                logger.info(inputs)
-                                logger.info(client_socket)
-                                inputs.remove(client_socket)
-                                client_socket.close()
+                        # Whole packets into the queue, the lanes work on
+                        # packets.
+                        for packet in splitter.feed(fifo_data):
+                            tracing.mark("ipow_in", packet)
+                            fifo_queue.put(packet)
                     else:
                         client_data = fd.recv(READ_BUFFER_SIZE)
                         if mode_out and client_data:
-                            os.write(fifo_out_fd, client_data)
+                            logger.debug("Got %d from server", len(client_data))
+                            stats.received(client_data)
+                            tracing.mark("received", client_data)
+                            ipow.write(client_data)
+                            tracing.mark("ipow_out", client_data)
+
+                if client_socket in writable:
+                    try:
+                        fifo_data = fifo_queue.get_nowait()
+                        tracing.mark("dequeued", fifo_data)
+                        client_socket.sendall(fifo_data)
+                        tracing.mark("sent", fifo_data)
+                        logger.debug("Sent %d to server", len(fifo_data))
+                        stats.sent(fifo_data)
+                    except queue.Empty:
+                        pass
+                    except Exception as e:
+                        logger.info(inputs)
+                        logger.info(client_socket)
+                        inputs.remove(client_socket)
+                        client_socket.close()
         except Exception as e:
             logger.info(e)
             time.sleep(1)
@@ -69,14 +114,23 @@ if __name__ == '__main__':
     parser.add_argument('-i', '--fifo-in', type=str, help='FIFO in', default='/var/run/tun_out.fifo')
     parser.add_argument('-o', '--fifo-out', type=str, help='FIFO out', default='/var/run/tun_in.fifo')
     parser.add_argument("-m", "--mode", type=str, help='Mode: in/out/inout', default='inout')
+    parser.add_argument('-v', '--verbose', action='store_true', help='Log every packet')
+    parser.add_argument('--metrics', type=str, help='Serve metrics on this UNIX socket path or [host:]port (HTTP)')
+    parser.add_argument('--trace', type=str, help='Trace packets through the stages into this file (.json: Chrome trace format; written on exit and SIGUSR1)')
     args = parser.parse_args()
 
     logging.basicConfig(
-        level=logging.DEBUG,
+        level=logging.DEBUG if args.verbose else logging.INFO,
         format='[%(asctime)s] [%(levelname)s] %(funcName)s: %(message)s',
         datefmt='%Y-%m-%d %H:%M:%S',
     )
 
+    if args.metrics:
+        metrics.serve(args.metrics, "tcp-client")
+
+    if args.trace:
+        tracing.start(args.trace, "tcp-client")
+
     if args.connect_addr is None or args.port is None:
         parser.error("Remote address and port needed")
 
@@ -1,16 +1,32 @@
 #!/usr/bin/env python3
 
 import os
+import queue
 import select
 import socket
+import sys
 import argparse
 
+# Shared by all the transports.
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+import framing
+import ipowwriter
+import lanes
+import metrics
+import tracing
+
 READ_BUFFER_SIZE = 1024
 
 import logging
 
 logger = logging.getLogger("tcp-client")
 
+# Outbound packets, interactive ones first.
+fifo_queue = lanes.LaneQueue(logger=logger)
+
+stats = metrics.LinkMetrics()
+connections = metrics.counter("ipow_connections_total", "Connections accepted from clients")
+
 def tcp_serve(host, port, mode, fifo_in, fifo_out):
     mode_in = mode.lower().find('i') != -1
     mode_out = mode.lower().find('o') != -1
@@ -28,13 +44,14 @@ def tcp_serve(host, port, mode, fifo_in, fifo_out):
             logger.info(f"Fifo in '{fifo_in}' doesn't exist")
             return
         fifo_in_fd = os.open(fifo_in, os.O_RDONLY | os.O_NONBLOCK)
+        splitter = framing.Splitter()
         logger.info(f"FIFO {fifo_in} opened for reading (in)")
 
     if mode_out:
         if not os.path.exists(fifo_out):
             logger.info(f"Fifo out '{fifo_out}' doesn't exist")
             return
-        fifo_out_fd = os.open(fifo_out, os.O_WRONLY)
+        ipow = ipowwriter.IPOWWriter(fifo_out, logger=logger)
         logger.info(f"FIFO {fifo_out} opened for writing (out)")
 
     inputs = [server_socket]
@@ -42,32 +59,60 @@ def tcp_serve(host, port, mode, fifo_in, fifo_out):
         inputs.append(fifo_in_fd)
 
     while True:
-        readable, _, _ = select.select(inputs, [], [])
+        clients = [fd for fd in inputs if isinstance(fd, socket.socket) and fd != server_socket]
+        outputs = [] if fifo_queue.empty() else clients
+        reading = inputs
+        if mode_out and ipow.pending():
+            outputs = outputs + [ipow]
+            if ipow.backlogged():
+                # Leave it in the sockets, TCP's window does the rest.
+                reading = [fd for fd in inputs if fd not in clients]
+        readable, writable, _ = select.select(reading, outputs, [])
+
+        if mode_out and ipow in writable:
+            ipow.flush()
+            writable.remove(ipow)
 
         for fd in readable:
             if fd == server_socket:
                 client_socket, client_address = server_socket.accept()
                 logger.info(f"Connection from {client_address}, appending fd:{client_socket.fileno()} to inputs")
                 inputs.append(client_socket)
+                connections.inc()
             elif mode_in and fd == fifo_in_fd:
                 fifo_data = os.read(fifo_in_fd, READ_BUFFER_SIZE)
-                logger.info(f"Got {len(fifo_data)} from fifo_in (fd:{fifo_in_fd})")
-                if fifo_data:
-                    for client_socket in inputs:
-                        if client_socket != server_socket and client_socket != fifo_in_fd:
-                            try:
-                                client_socket.sendall(fifo_data)
-                                logger.info(f"Sent {len(fifo_data)} to client_socket (fd:{client_socket.fileno()})")
-                            except Exception as e:
-                                logger.info(e)
-                                logger.info(f"Removing {client_socket.fileno()}")
-                                inputs.remove(client_socket)
+                logger.debug("Got %d from fifo_in (fd:%d)", len(fifo_data), fifo_in_fd)
+                # Whole packets into the queue, the lanes work on packets.
+                for packet in splitter.feed(fifo_data):
+                    tracing.mark("ipow_in", packet)
+                    fifo_queue.put(packet)
 
             else:
                 client_data = fd.recv(READ_BUFFER_SIZE)
                 if mode_out and client_data:
-                    logger.info(f"Got {len(client_data)} from client (fd:{fd.fileno()})")
-                    os.write(fifo_out_fd, client_data)
+                    logger.debug("Got %d from client (fd:%d)", len(client_data), fd.fileno())
+                    stats.received(client_data)
+                    tracing.mark("received", client_data)
+                    ipow.write(client_data)
+                    tracing.mark("ipow_out", client_data)
+
+        if writable:
+            try:
+                fifo_data = fifo_queue.get_nowait()
+            except queue.Empty:
+                continue
+            tracing.mark("dequeued", fifo_data)
+
+            for client_socket in clients:
+                try:
+                    client_socket.sendall(fifo_data)
+                    logger.debug("Sent %d to client_socket (fd:%d)", len(fifo_data), client_socket.fileno())
+                    stats.sent(fifo_data)
+                    tracing.mark("sent", fifo_data)
+                except Exception as e:
+                    logger.info(e)
+                    logger.info(f"Removing {client_socket.fileno()}")
+                    inputs.remove(client_socket)
 
 if __name__ == "__main__":
     parser = argparse.ArgumentParser(description="TCP server")
@@ -76,12 +121,21 @@ if __name__ == "__main__":
     parser.add_argument("-i", "--fifo-in", type=str, help='FIFO in', default='/var/run/tun_out.fifo')
     parser.add_argument("-o", "--fifo-out", type=str, help='FIFO out', default='/var/run/tun_in.fifo')
     parser.add_argument("-m", "--mode", type=str, help='Mode: in/out/inout', default='inout')
+    parser.add_argument('-v', '--verbose', action='store_true', help='Log every packet')
+    parser.add_argument('--metrics', type=str, help='Serve metrics on this UNIX socket path or [host:]port (HTTP)')
+    parser.add_argument('--trace', type=str, help='Trace packets through the stages into this file (.json: Chrome trace format; written on exit and SIGUSR1)')
     args = parser.parse_args()
 
     logging.basicConfig(
-        level=logging.DEBUG,
+        level=logging.DEBUG if args.verbose else logging.INFO,
         format='[%(asctime)s] [%(levelname)s] %(funcName)s: %(message)s',
         datefmt='%Y-%m-%d %H:%M:%S',
     )
 
+    if args.metrics:
+        metrics.serve(args.metrics, "tcp-server")
+
+    if args.trace:
+        tracing.start(args.trace, "tcp-server")
+
     tcp_serve(args.listen_addr, args.port, args.mode, args.fifo_in, args.fifo_out)
@@ -0,0 +1,184 @@
+#!/usr/bin/env python3
+# Per-packet stage tracing, to see where a packet's time goes. Opt-in: with
+# --trace FILE a transport timestamps (time.perf_counter_ns) each packet at
+# every stage it goes through, e.g. for the DNS client:
+#
+#   ipow_in -> dequeued -> encoded -> sent -> reply -> decoded -> ipow_out
+#
+# The events go into a ring buffer (the last CAPACITY ones are kept), which is
+# written to FILE when the transport exits, or on SIGUSR1 (the DNS/ICMP
+# transports don't really exit, so "kill -USR1" is the way there). FILE is in
+# Chrome's trace format if it ends with .json (chrome://tracing or Perfetto
+# show each packet as a row of stages), JSON lines otherwise.
+#
+# A packet is identified by a hash of its IP header fields and first transport
+# header bytes, so it's the same packet on both ends of the link. As
+# perf_counter_ns is CLOCK_MONOTONIC (i.e. system-wide) on Linux, traces of
+# several processes on the same box can be put together too. Running this
+# file analyzes the traces:
+#
+#   python tracing.py dns-client.jsonl dns-server.jsonl [--end-to-end]
+#
+# which prints percentiles of the time between consecutive stages, per
+# transport (or, with --end-to-end, across all the traces given).
+import argparse
+import atexit
+import collections
+import json
+import os
+import signal
+import time
+import zlib
+
+CAPACITY = 1 << 16  # Events.
+
+tracer = None
+
+
+def packet_id(packet):
+    version = packet[0] >> 4 if packet else 0
+    if version == 4 and len(packet) >= 28:
+        header_size = (packet[0] & 0x0f) * 4
+        key = (packet[4:6] + packet[9:10] + packet[12:20] +
+               packet[header_size:header_size + 8])
+    elif version == 6 and len(packet) >= 48:
+        key = packet[1:4] + packet[6:7] + packet[8:48]
+    else:
+        key = packet[:64]
+    return zlib.crc32(key)
+
+
+class Tracer:
+    def __init__(self, path, transport, capacity=CAPACITY):
+        self.path = path
+        self.transport = transport
+        # deque's append is atomic, so the transports' threads can all mark
+        # without any locking.
+        self.events = collections.deque(maxlen=capacity)
+
+    def mark(self, stage, packet):
+        self.events.append((time.perf_counter_ns(), packet_id(packet), stage))
+
+    def dump(self, *_):
+        events = list(self.events)
+        tmp_path = f"{self.path}.tmp"
+        with open(tmp_path, "w") as f:
+            if self.path.endswith(".json"):
+                json.dump(self.chrome_trace(events), f)
+            else:
+                for ts, packet, stage in events:
+                    f.write(json.dumps({
+                        "ts_ns": ts, "packet": packet, "stage": stage,
+                        "transport": self.transport,
+                    }) + "\n")
+        os.replace(tmp_path, self.path)
+
+    def chrome_trace(self, events):
+        # One row (thread) per packet, with a slice per stage (from the
+        # previous stage to this one). The raw events go along as instant
+        # events, so the analyzer can read these too.
+        trace_events = []
+        last = {}
+        for ts, packet, stage in events:
+            trace_events.append({
+                "name": stage, "ph": "i", "s": "t", "ts": ts / 1000,
+                "pid": self.transport, "tid": packet,
+                "args": {"ts_ns": ts, "packet": packet, "stage": stage},
+            })
+            if packet in last:
+                last_ts, last_stage = last[packet]
+                trace_events.append({
+                    "name": f"{last_stage} -> {stage}", "ph": "X",
+                    "ts": last_ts / 1000, "dur": (ts - last_ts) / 1000,
+                    "pid": self.transport, "tid": packet,
+                })
+            last[packet] = (ts, stage)
+        return {"traceEvents": trace_events, "displayTimeUnit": "ms"}
+
+
+def start(path, transport, capacity=CAPACITY):
+    # Has to be called from the main thread (because of the signal handler).
+    global tracer
+    tracer = Tracer(path, transport, capacity)
+    atexit.register(tracer.dump)
+    signal.signal(signal.SIGUSR1, tracer.dump)
+    return tracer
+
+
+def mark(stage, packet):
+    if tracer is not None:
+        tracer.mark(stage, packet)
+
+
+def load(path):
+    # Returns [(ts_ns, packet, stage, transport)].
+    with open(path) as f:
+        text = f.read()
+
+    if text.lstrip().startswith("{\"traceEvents\""):
+        return [
+            (e["args"]["ts_ns"], e["args"]["packet"], e["args"]["stage"], e["pid"])
+            for e in json.loads(text)["traceEvents"] if e["ph"] == "i"
+        ]
+
+    events = []
+    for line in text.splitlines():
+        if line.strip():
+            e = json.loads(line)
+            events.append((e["ts_ns"], e["packet"], e["stage"], e["transport"]))
+    return events
+
+
+def percentile(values, p):
+    # values have to be sorted.
+    return values[min(len(values) - 1, int(len(values) * p / 100))]
+
+
+def analyze(events, end_to_end=False):
+    # Returns {group: {(stage, next stage): [nanoseconds]}}, where group is the
+    # transport (or "end-to-end").
+    packets = collections.defaultdict(list)
+    for ts, packet, stage, transport in events:
+        group = "end-to-end" if end_to_end else transport
+        packets[(group, packet)].append((ts, stage, transport))
+
+    stages = collections.defaultdict(lambda: collections.defaultdict(list))
+    for (group, _), packet_events in packets.items():
+        packet_events.sort()
+        for (ts, stage, transport), (next_ts, next_stage, next_transport) in zip(
+                packet_events, packet_events[1:]):
+            if end_to_end and transport != next_transport:
+                stage = f"{transport}:{stage}"
+                next_stage = f"{next_transport}:{next_stage}"
+            stages[group][(stage, next_stage)].append(next_ts - ts)
+    return stages
+
+
+def report(stages):
+    for group in sorted(stages):
+        print(group)
+        rows = sorted(
+            stages[group].items(), key=lambda item: -len(item[1])
+        )
+        width = max(len(f"{a} -> {b}") for (a, b), _ in rows)
+        for (stage, next_stage), values in rows:
+            values.sort()
+            ms = [percentile(values, p) / 1e6 for p in (50, 90, 99)]
+            print(
+                f"  {f'{stage} -> {next_stage}':<{width}}  n={len(values):<6} "
+                f"p50 {ms[0]:9.3f} ms  p90 {ms[1]:9.3f} ms  "
+                f"p99 {ms[2]:9.3f} ms  max {values[-1] / 1e6:9.3f} ms"
+            )
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Per-stage latency of traced packets")
+    parser.add_argument("traces", nargs="+", help="Trace files (JSON lines or Chrome trace)")
+    parser.add_argument("-e", "--end-to-end", action="store_true",
+                        help="Follow packets across all the traces (same box only)")
+    args = parser.parse_args()
+
+    events = []
+    for path in args.traces:
+        events.extend(load(path))
+    report(analyze(events, args.end_to_end))
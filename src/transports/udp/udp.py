@@ -0,0 +1,418 @@
+#!/usr/bin/env python3
+# UDP transport: one tunnel packet per datagram, so unlike tcp-client.py there
+# is no TCP under the tunnelled TCP, and a lost datagram is just a lost packet.
+# Both ends run the same thing, one (or both) with the other's address:
+#
+#   box1$ udp.py -t SECRET
+#   box2$ udp.py -t SECRET -c box1
+#
+# It talks to ipowd2 (datagram sockets, or its shared memory rings with -r,
+# see ../shmring.py) - not to ipowd, its FIFOs don't keep packet boundaries.
+#
+# Peers are keyed by their address: any number of them can send to us (with
+# the right token, if there's one), and packets from IPOW go to the peer
+# which the destination address was last seen coming from (the most recently
+# heard peer if it's unknown yet). Peers given with -c are kept forever and
+# get keepalives, so NATs on the way keep the mapping and the other end learns
+# where we are; others are forgotten after PEER_TIMEOUT of silence. An empty
+# datagram (after the token) is a keepalive.
+#
+# With -t every datagram starts with a session token (8 bytes of a hash of
+# the secret); anything else is dropped. It's not encryption, just enough to
+# keep random packets (and scans) out of the tunnel.
+#
+# Packets from IPOW are taken in batches of up to BATCH. Runs of them going to
+# the same peer, of the same size (the last one can be shorter), are sent with
+# one sendmsg() and UDP_SEGMENT (GSO), where the kernel has it, and the kernel
+# cuts them into datagrams. On the receiving side UDP_GRO lets the kernel hand
+# over such runs in one go, cut up here.
+import argparse
+import errno
+import hashlib
+import logging
+import os
+import select
+import socket
+import struct
+import sys
+import tempfile
+import time
+
+# Shared by all the transports.
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+import ipowwriter
+import metrics
+import shmring
+import tracing
+
+# Not in the socket module (yet).
+SOL_UDP = 17
+UDP_SEGMENT = 103
+UDP_GRO = 104
+
+MAX_PACKET_SIZE = 65535
+BATCH = 64  # Packets taken from IPOW, or from the link, at once at most.
+GSO_MAX_SEGMENTS = 64  # The kernel's UDP_MAX_SEGMENTS.
+GSO_MAX_SIZE = 65000  # Of all the segments together.
+TOKEN_SIZE = 8
+DEFAULT_PORT = 6446
+PEER_TIMEOUT = 120.0  # Seconds.
+KEEPALIVE_INTERVAL = 10.0
+MAINTENANCE_INTERVAL = 1.0
+REGISTER_INTERVAL = 10.0  # Re-register with IPOW every now and then.
+SOCKET_BUFFER = 4 << 20
+
+logger = logging.getLogger("udp")
+
+stats = metrics.LinkMetrics()
+dropped = "Packets dropped"
+dropped_bad_token = metrics.counter("ipow_udp_dropped_total", dropped, reason="bad_token")
+dropped_no_peer = metrics.counter("ipow_udp_dropped_total", dropped, reason="no_peer")
+dropped_link_busy = metrics.counter("ipow_udp_dropped_total", dropped, reason="link_busy")
+dropped_ipow_busy = metrics.counter("ipow_udp_dropped_total", dropped, reason="ipow_busy")
+gso_sends = metrics.counter("ipow_udp_gso_sends_total", "sendmsg() calls with UDP_SEGMENT")
+gro_receives = metrics.counter("ipow_udp_gro_receives_total", "Datagrams received coalesced (UDP_GRO)")
+
+
+def destination(packet):
+    # The (inner) destination address, or None.
+    version = packet[0] >> 4 if packet else 0
+    if version == 4 and len(packet) >= 20:
+        return bytes(packet[16:20])
+    if version == 6 and len(packet) >= 40:
+        return bytes(packet[24:40])
+    return None
+
+
+def source(packet):
+    version = packet[0] >> 4 if packet else 0
+    if version == 4 and len(packet) >= 20:
+        return bytes(packet[12:16])
+    if version == 6 and len(packet) >= 40:
+        return bytes(packet[8:24])
+    return None
+
+
+def parse_peer(spec):
+    # HOST[:PORT], or [HOST]:PORT for IPv6.
+    host, port = spec, DEFAULT_PORT
+    if spec.startswith("["):
+        host, _, rest = spec[1:].partition("]")
+        if rest:
+            port = int(rest.lstrip(":"))
+    elif spec.count(":") == 1:
+        host, port = spec.split(":")
+        port = int(port)
+    return host, port
+
+
+class Peer:
+    def __init__(self, address, static=False):
+        self.address = address
+        self.static = static
+        self.last_heard = time.monotonic()
+        self.next_keepalive = 0
+
+
+class UDPTransport:
+    def __init__(self, listen_addr, port, peers, tun_outbound_path,
+                 tun_inbound_path, token=None, ring=False, gso=True):
+        self.tun_outbound_path = tun_outbound_path
+        self.tun_inbound_path = tun_inbound_path
+        self.token = token or b""
+
+        family = socket.getaddrinfo(listen_addr, port, type=socket.SOCK_DGRAM)[0][0]
+        self.sock = socket.socket(family, socket.SOCK_DGRAM)
+        self.sock.setsockopt(socket.SOL_SOCKET, socket.SO_SNDBUF, SOCKET_BUFFER)
+        self.sock.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, SOCKET_BUFFER)
+        self.sock.bind((listen_addr, port))
+        self.sock.setblocking(False)
+        logger.info(f"Listening on {listen_addr}:{self.sock.getsockname()[1]}")
+
+        self.gso = gso
+        self.gso_max_segment = MAX_PACKET_SIZE  # Larger ones don't fit the MTU.
+        self.gro = False
+        if gso:
+            try:
+                self.sock.setsockopt(SOL_UDP, UDP_GRO, 1)
+                self.gro = True
+            except OSError as e:
+                logger.info(f"No UDP_GRO: {e}")
+        self.buffer = bytearray(MAX_PACKET_SIZE)
+        self.view = memoryview(self.buffer)
+
+        self.peers = {}  # Address -> Peer
+        self.routes = {}  # Inner source address -> peer's address
+        self.last_peer = None
+        self.next_maintenance = 0
+        for host, peer_port in peers:
+            info = socket.getaddrinfo(host, peer_port, family, socket.SOCK_DGRAM)
+            address = info[0][4]
+            self.peers[address] = Peer(address, static=True)
+            self.last_peer = address
+            logger.info(f"Peer {host}:{peer_port} ({address[0]})")
+
+        # From IPOW.
+        self.tmp_dir = tempfile.TemporaryDirectory()
+        self.tun_outbound = socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM)
+        self.tun_outbound.bind(f"{self.tmp_dir.name}/tun_outbound_receiver")
+        self.tun_outbound.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, SOCKET_BUFFER)
+        self.tun_outbound.setblocking(False)
+        self.to_ipow = ipowwriter.IPOWWriter(tun_inbound_path, logger=logger)
+
+        # Registers (once, for good) by itself.
+        self.ring = shmring.RingClient(tun_outbound_path) if ring else None
+        self.next_register = 0 if not ring else float("inf")
+
+    def register(self, now):
+        # Send anything to the IPOW server so it knows where to send data to.
+        if now < self.next_register:
+            return
+        try:
+            self.tun_outbound.sendto(b"hi", self.tun_outbound_path)
+        except OSError as e:
+            logger.info(f"Can't register with IPOW: {e}")
+        self.next_register = now + REGISTER_INTERVAL
+
+    def maintain(self, now):
+        # Keepalives to the static peers, forgets the silent others.
+        if now < self.next_maintenance:
+            return
+        self.next_maintenance = now + MAINTENANCE_INTERVAL
+        for address, peer in list(self.peers.items()):
+            if peer.static:
+                if now >= peer.next_keepalive:
+                    self.send(address, [self.token])
+                    peer.next_keepalive = now + KEEPALIVE_INTERVAL
+            elif now - peer.last_heard > PEER_TIMEOUT:
+                logger.info(f"Peer {address[0]}:{address[1]} gone quiet, forgetting it")
+                del self.peers[address]
+                if self.last_peer == address:
+                    self.last_peer = None
+        for inner in [inner for inner, address in self.routes.items()
+                      if address not in self.peers]:
+            del self.routes[inner]
+
+    def pick_peer(self, packet):
+        address = self.routes.get(destination(packet))
+        return address if address is not None else self.last_peer
+
+    def send(self, address, buffers, segment=0):
+        # One datagram, or with segment several of that size (the last one
+        # can be shorter). Returns False if it didn't go.
+        try:
+            if segment:
+                self.sock.sendmsg(buffers, [(SOL_UDP, UDP_SEGMENT, struct.pack("=H", segment))],
+                                  0, address)
+                gso_sends.inc()
+            else:
+                self.sock.sendmsg(buffers, [], 0, address)
+        except BlockingIOError:
+            return False
+        except OSError as e:
+            if segment and e.errno == errno.EMSGSIZE:
+                # The kernel won't cut into datagrams larger than the MTU
+                # (single ones get fragmented instead).
+                logger.info(f"Segments of {segment} bytes don't fit the MTU, sending those one by one")
+                self.gso_max_segment = segment - 1
+                return None
+            if segment and e.errno in (errno.EINVAL, errno.EIO, errno.ENOPROTOOPT,
+                                       errno.EOPNOTSUPP):
+                # No GSO here (or on the way to that peer's interface).
+                logger.info(f"UDP_SEGMENT doesn't work ({e}), sending one by one")
+                self.gso = False
+                return None
+            logger.info(f"Can't send to {address[0]}:{address[1]}: {e}")
+            return False
+        return True
+
+    def send_run(self, address, packets):
+        # Packets of the same size (except the last), to one peer.
+        segment = len(self.token) + len(packets[0])
+        if len(packets) > 1 and self.gso and segment <= self.gso_max_segment:
+            buffers = []
+            for packet in packets:
+                if self.token:
+                    buffers.append(self.token)
+                buffers.append(packet)
+            sent = self.send(address, buffers, segment)
+            if sent is not None:
+                self.sent(packets, sent)
+                return
+        for packet in packets:
+            self.sent([packet], self.send(address, [self.token, packet]))
+
+    def sent(self, packets, ok):
+        for packet in packets:
+            if ok:
+                logger.debug("Sent %d to peer", len(packet))
+                stats.sent(packet)
+                tracing.mark("sent", packet)
+            else:
+                dropped_link_busy.inc()
+
+    def from_ipow(self):
+        if self.ring:
+            packets = self.ring.receive(BATCH)
+        else:
+            packets = []
+            while len(packets) < BATCH:
+                try:
+                    packets.append(self.tun_outbound.recv(MAX_PACKET_SIZE))
+                except BlockingIOError:
+                    break
+
+        # Runs of packets to the same peer, of the same size.
+        run, run_peer, run_size = [], None, 0
+        for packet in packets:
+            tracing.mark("ipow_in", packet)
+            address = self.pick_peer(packet)
+            if address is None:
+                logger.debug("Dropping %d bytes, no peer", len(packet))
+                dropped_no_peer.inc()
+                continue
+            if run and (address != run_peer or len(packet) > len(run[0]) or
+                        len(run) == GSO_MAX_SEGMENTS or
+                        run_size + len(packet) > GSO_MAX_SIZE):
+                self.send_run(run_peer, run)
+                run, run_size = [], 0
+            run.append(packet)
+            run_peer = address
+            run_size += len(self.token) + len(packet)
+            if len(packet) < len(run[0]):
+                # Only the last one can be shorter.
+                self.send_run(run_peer, run)
+                run, run_size = [], 0
+        if run:
+            self.send_run(run_peer, run)
+
+        if self.ring:
+            self.ring.release()
+
+    def from_link(self, now):
+        for _ in range(BATCH):
+            if self.to_ipow.backlogged():
+                return
+            try:
+                size, ancdata, _, address = self.sock.recvmsg_into(
+                    [self.buffer], socket.CMSG_SPACE(4) if self.gro else 0
+                )
+            except BlockingIOError:
+                return
+            except OSError as e:
+                # E.g. ECONNREFUSED, for something sent earlier.
+                logger.debug("recvmsg: %s", e)
+                continue
+
+            segment = size
+            for level, kind, data in ancdata:
+                if level == SOL_UDP and kind == UDP_GRO:
+                    segment = struct.unpack("=i", data[:4])[0]
+                    gro_receives.inc()
+
+            for offset in range(0, size, segment or 1):
+                self.from_peer(address, self.view[offset:min(offset + segment, size)], now)
+            if size == 0:
+                self.from_peer(address, self.view[:0], now)
+
+    def from_peer(self, address, data, now):
+        if self.token:
+            if data[:TOKEN_SIZE] != self.token:
+                logger.debug("Bad token from %s:%d", address[0], address[1])
+                dropped_bad_token.inc()
+                return
+            data = data[TOKEN_SIZE:]
+
+        peer = self.peers.get(address)
+        if peer is None:
+            logger.info(f"New peer {address[0]}:{address[1]}")
+            peer = self.peers[address] = Peer(address)
+        peer.last_heard = now
+        self.last_peer = address
+        if not data:
+            return  # Keepalive.
+
+        logger.debug("Got %d from peer", len(data))
+        stats.received(data)
+        tracing.mark("received", data)
+        inner = source(data)
+        if inner is not None:
+            self.routes[inner] = address
+
+        if self.ring:
+            if not self.ring.send(data):
+                dropped_ipow_busy.inc()
+                return
+        elif not self.to_ipow.write(data):
+            dropped_ipow_busy.inc()
+            return
+        tracing.mark("ipow_out", data)
+
+    def run(self):
+        ipow = self.ring or self.tun_outbound
+        while True:
+            now = time.monotonic()
+            self.register(now)
+            self.maintain(now)
+
+            timeout = min(self.next_register, self.next_maintenance) - now
+            if self.ring:
+                timeout = min(timeout, shmring.POLL_INTERVAL)
+            # While IPOW is behind, what comes in waits in the socket's
+            # buffer (and past that gets dropped by the kernel, not here).
+            reading = [ipow] if self.to_ipow.backlogged() else [ipow, self.sock]
+            writing = [self.to_ipow] if self.to_ipow.pending() else []
+            readable, writable, _ = select.select(reading, writing, [], max(0, timeout))
+
+            now = time.monotonic()
+            if writable:
+                self.to_ipow.flush()
+            if self.sock in readable:
+                self.from_link(now)
+            if ipow in readable or self.ring:
+                self.from_ipow()
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="UDP transport")
+    parser.add_argument('-l', '--listen-addr', type=str, help='Local address', default='0.0.0.0')
+    parser.add_argument('-p', '--port', type=int, help=f'Local port (default {DEFAULT_PORT}, 0: any)', default=DEFAULT_PORT)
+    parser.add_argument('-c', '--connect-addr', type=parse_peer, action='append', default=[],
+                        help=f'Peer as HOST[:PORT] (default port {DEFAULT_PORT}), can be given more than once')
+    parser.add_argument('-t', '--token', type=str, help='Secret which the session token is made of (the same on both ends)')
+    parser.add_argument('-i', '--tun-outbound', type=str, help="IPOW's outbound socket path", default='/var/run/tun_out.fifo')
+    parser.add_argument('-o', '--tun-inbound', type=str, help="IPOW's inbound socket path", default='/var/run/tun_in.fifo')
+    parser.add_argument('-r', '--ring', action='store_true', help='Exchange packets with IPOW (ipowd2) through shared memory rings instead of its sockets')
+    parser.add_argument('--no-gso', action='store_true', help="Don't use UDP_SEGMENT/UDP_GRO")
+    parser.add_argument('-v', '--verbose', action='store_true', help='Log every packet')
+    parser.add_argument('--metrics', type=str, help='Serve metrics on this UNIX socket path or [host:]port (HTTP)')
+    parser.add_argument('--trace', type=str, help='Trace packets through the stages into this file (.json: Chrome trace format; written on exit and SIGUSR1)')
+    args = parser.parse_args()
+
+    logging.basicConfig(
+        level=logging.DEBUG if args.verbose else logging.INFO,
+        format='[%(asctime)s] [%(levelname)s] %(funcName)s: %(message)s',
+        datefmt='%Y-%m-%d %H:%M:%S',
+    )
+
+    if not os.path.exists(args.tun_outbound):
+        logger.info(f"IPOW's outbound socket '{args.tun_outbound}' doesn't exist")
+        sys.exit()
+
+    if args.metrics:
+        metrics.serve(args.metrics, "udp")
+
+    if args.trace:
+        tracing.start(args.trace, "udp")
+
+    token = None
+    if args.token:
+        token = hashlib.sha256(b"ipow-udp " + args.token.encode()).digest()[:TOKEN_SIZE]
+
+    try:
+        UDPTransport(
+            args.listen_addr, args.port, args.connect_addr, args.tun_outbound,
+            args.tun_inbound, token, args.ring, not args.no_gso
+        ).run()
+    except KeyboardInterrupt:
+        pass